@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+"""Compare reconciling a vault inventory in JSON and in CSV format.
+
+A synthetic inventory of --rows archives is written in both formats to
+temporary files, with descriptions that need quoting in CSV. For each format
+the time to parse the file alone is reported, and then the time for
+'vault sync' to reconcile it into an empty cache of its own, as it would a
+retrieved inventory job's output. Pass --parse-only to skip reconciling,
+which takes much longer than parsing on large inventories."""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from glacier import cli, inventory
+
+
+INVENTORY_DATE = '2017-06-01T00:00:00Z'
+JOB_CREATION_DATE = '2017-06-01T00:30:00Z'
+
+
+def synthetic_archives(rows):
+    for i in range(rows):
+        if i % 10 == 0:
+            name = 'backup {}, "weekly"'.format(i)
+        else:
+            name = 'backup-{}.tar.gz'.format(i)
+        yield 'id_{:0>130}'.format(i), name, 1024 * (i % 4096 + 1)
+
+
+def write_json(path, rows):
+    with io.open(path, 'wb') as f:
+        f.write(b'{"VaultARN":"arn:aws:glacier:us-east-1:0:vaults/benchmark",'
+                b'"InventoryDate":"' + INVENTORY_DATE.encode('ascii') +
+                b'","ArchiveList":[')
+        for i, (id, name, size) in enumerate(synthetic_archives(rows)):
+            if i:
+                f.write(b',')
+            f.write(json.dumps({
+                'ArchiveId': id, 'ArchiveDescription': name,
+                'CreationDate': '2017-05-01T00:00:00Z', 'Size': size,
+                'SHA256TreeHash': '0' * 64}).encode('utf-8'))
+        f.write(b']}')
+
+
+def write_csv(path, rows):
+    with io.open(path, 'wb') as f:
+        f.write(b','.join(inventory.CSV_COLUMNS) + b'\r\n')
+        for id, name, size in synthetic_archives(rows):
+            name = name.encode('utf-8')
+            if b',' in name or b'"' in name:
+                name = b'"' + name.replace(b'"', b'""') + b'"'
+            f.write(b','.join([id.encode('ascii'), name,
+                               b'2017-05-01T00:00:00Z', str(size), b'0' * 64])
+                    + b'\r\n')
+
+
+class InventoryJob(object):
+    """Stands in for a completed boto3 inventory retrieval Job whose output
+    is read from a local file"""
+
+    def __init__(self, path, content_type):
+        self.id = 'benchmark'
+        self.creation_date = JOB_CREATION_DATE
+        self.path = path
+        self.content_type = content_type
+
+    def get_output(self):
+        return {'contentType': self.content_type,
+                'body': io.open(self.path, 'rb')}
+
+
+class Vault(object):
+    name = 'benchmark'
+
+
+def parse(path, content_type):
+    with io.open(path, 'rb') as body:
+        reader = inventory.open_inventory(body, content_type)
+        reader.read_header()
+        return sum(1 for archive in reader.archives())
+
+
+def reconcile(path, content_type, cache_dir):
+    os.environ['XDG_CACHE_HOME'] = cache_dir
+    app = cli.App(['vault', 'sync', 'benchmark'], resource=object())
+    app._vault_sync_reconcile(Vault(), InventoryJob(path, content_type))
+    app.cache.close()
+
+
+def timed(fn, *args):
+    start = time.time()
+    fn(*args)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=5000000)
+    parser.add_argument('--parse-only', action='store_true')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        os.environ.update(XDG_CONFIG_HOME=tmpdir,
+                          AWS_ACCESS_KEY_ID='AKIDBENCHMARK',
+                          AWS_SECRET_ACCESS_KEY='benchmark')
+        formats = [('JSON', 'application/json', write_json),
+                   ('CSV', 'text/csv', write_csv)]
+        for name, content_type, write in formats:
+            path = os.path.join(tmpdir, 'inventory.' + name.lower())
+            write(path, args.rows)
+            line = '{:5} {:>8.1f} MiB  parse {:7.2f}s'.format(
+                name, os.path.getsize(path) / 1024.0 / 1024,
+                timed(parse, path, content_type))
+            if not args.parse_only:
+                line += '  reconcile {:7.2f}s'.format(
+                    timed(reconcile, path, content_type,
+                          os.path.join(tmpdir, name.lower())))
+            print(line)
+            sys.stdout.flush()
+            os.unlink(path)
+        return 0
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
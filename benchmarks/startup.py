@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""Measure how long glacier takes to start up and run commands that only read
+the local cache.
+
+Each command is run repeatedly in a fresh interpreter against an empty cache
+in a temporary directory, with placeholder credentials in the environment, so
+no network access is needed. The minimum and median wall clock times are
+reported. With --max-seconds, exit with status 1 if any command's median
+exceeds that, so that this can guard against startup regressions."""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+COMMANDS = [
+    ['archive', 'list', 'benchmark'],
+    ['archive', 'ls', 'benchmark'],
+]
+
+# Modules that a cache-only command should never need to import
+HEAVY_MODULES = ['boto3', 'botocore', 'alembic', 'pkg_resources']
+
+RUN_COMMAND = """
+import sys
+from glacier.cli import App
+App(sys.argv[1:]).main()
+heavy = [name for name in {heavy!r} if name in sys.modules]
+if heavy:
+    sys.stderr.write('imported: %s\\n' % ' '.join(heavy))
+""".format(heavy=HEAVY_MODULES)
+
+
+def run(argv, env):
+    start = time.time()
+    process = subprocess.Popen([sys.executable, '-c', RUN_COMMAND] + argv,
+                               env=env, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    elapsed = time.time() - start
+    if process.returncode != 0:
+        raise RuntimeError('{} failed: {}'.format(' '.join(argv), stderr))
+    return elapsed, stderr
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--max-seconds', type=float, default=None)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        env = dict(os.environ,
+                   XDG_CACHE_HOME=tmpdir,
+                   XDG_CONFIG_HOME=tmpdir,
+                   AWS_ACCESS_KEY_ID='AKIDBENCHMARK',
+                   AWS_SECRET_ACCESS_KEY='benchmark')
+        env['PYTHONPATH'] = os.pathsep.join(
+            [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+            env.get('PYTHONPATH', '').split(os.pathsep))
+        # The first run creates the cache database, which is not what is
+        # being measured
+        run(COMMANDS[0], env)
+
+        failed = False
+        for argv in COMMANDS:
+            times = []
+            for i in range(args.runs):
+                elapsed, stderr = run(argv, env)
+                times.append(elapsed)
+            times.sort()
+            median = times[len(times) // 2]
+            print('{:20} min {:.3f}s  median {:.3f}s'.format(
+                ' '.join(argv[:2]), times[0], median))
+            if stderr.strip():
+                print('  ' + stderr.strip().decode('utf-8'))
+            if args.max_seconds is not None and median > args.max_seconds:
+                failed = True
+        return 1 if failed else 0
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
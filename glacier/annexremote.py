@@ -0,0 +1,247 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import logging
+import time
+
+from cli import RetryConsoleError, find_complete_job, has_pending_job
+
+
+logger = logging.getLogger(__name__)
+
+# Cost reported to git-annex; the same as git-annex's veryExpensiveRemoteCost,
+# since retrievals take hours and are charged for
+REMOTE_COST = 1000
+
+# Seconds for which a vault's job listing is reused before being fetched again
+JOB_LIST_TTL = 5 * 60
+
+# Seconds between attempts to bring a vault's inventory up to date when asked
+# about archives that have not been seen recently enough
+SYNC_INTERVAL = 60 * 60
+
+DEFAULT_MAX_AGE_HOURS = 80
+DEFAULT_UPLOAD_PART_SIZE = 32 * 1024 * 1024
+DEFAULT_DOWNLOAD_PART_SIZE = 8 * 1024 * 1024
+
+
+class ProtocolError(RuntimeError):
+    """git-annex sent something that the protocol does not allow"""
+
+
+class AnnexRemote(object):
+    """A git-annex external special remote backed by a Glacier vault.
+
+    git-annex starts one of these per session and talks to it over stdin and
+    stdout using the external special remote protocol. See:
+    https://git-annex.branchable.com/design/external_special_remote_protocol/
+
+    A single boto3 resource and Cache, belonging to app, serve every request,
+    and job listings and inventory sync attempts are remembered between
+    requests. Keys are stored as archives named after the key."""
+
+    def __init__(self, app, input, output):
+        self.app = app
+        self.input = input
+        self.output = output
+        self.vault_name = None
+        self.max_age_hours = DEFAULT_MAX_AGE_HOURS
+        self._jobs_fetched = 0
+        self._last_sync_attempt = 0
+
+    def send(self, *words):
+        # Messages must stay on one line
+        line = ' '.join(words).replace('\n', ' ')
+        self.output.write((line + '\n').encode('utf-8'))
+        self.output.flush()
+
+    def receive(self):
+        # readline() rather than iteration, which would block reading ahead
+        line = self.input.readline()
+        if not line:
+            return None
+        return line.decode('utf-8').rstrip('\n')
+
+    def get_config(self, name):
+        self.send('GETCONFIG', name)
+        reply = self.receive()
+        if reply is None or not reply.startswith('VALUE'):
+            raise ProtocolError('expected VALUE but got %r' % reply)
+        return reply[len('VALUE '):]
+
+    def run(self):
+        self.send('VERSION', '1')
+        while True:
+            line = self.receive()
+            if line is None:
+                return
+            request, _, rest = line.partition(' ')
+            handler = getattr(self, 'handle_' + request.replace('-', '_'),
+                              None)
+            if handler is None:
+                self.send('UNSUPPORTED-REQUEST')
+                continue
+            try:
+                handler(rest)
+            except ProtocolError as e:
+                # Tell git-annex why the remote is giving up before exiting
+                self.send('ERROR', '%s' % e)
+                raise
+
+    def _vault(self):
+        return self.app.resource.Vault('-', self.vault_name)
+
+    def _job_index(self):
+        """Return this vault's JobIndex, which app shares with inventory
+        syncs, listing the vault's jobs at most once every JOB_LIST_TTL
+        seconds"""
+        if time.time() > self._jobs_fetched + JOB_LIST_TTL:
+            self.app._forget_job_index(self.vault_name)
+            self._jobs_fetched = time.time()
+        return self.app._job_index(self._vault())
+
+    def _last_seen(self, key):
+        try:
+            return self.app.cache.get_archive_last_seen(self.vault_name, key)
+        except KeyError:
+            return None
+
+    def _recent_enough(self, last_seen):
+        return (last_seen and self.max_age_hours and
+                last_seen >= time.time() - self.max_age_hours * 60 * 60)
+
+    def _sync(self):
+        """Try to bring the cache up to date with the vault's inventory,
+        without waiting, at most once every SYNC_INTERVAL seconds"""
+        if time.time() < self._last_sync_attempt + SYNC_INTERVAL:
+            return
+        self._last_sync_attempt = time.time()
+        # Refresh a stale job listing first, or an inventory job queued by an
+        # earlier attempt would still look pending long after it completed
+        self._job_index()
+        try:
+            self.app._vault_sync(vault_name=self.vault_name,
+                                 max_age_hours=self.max_age_hours,
+                                 fix=False, wait=False)
+        except RetryConsoleError as e:
+            logger.info('%s' % e)
+
+    def handle_EXTENSIONS(self, rest):
+        self.send('EXTENSIONS')
+
+    def handle_INITREMOTE(self, rest):
+        vault_name = self.get_config('vault')
+        if not vault_name:
+            self.send('INITREMOTE-FAILURE',
+                      'set vault=<vault name> when initialising the remote')
+            return
+        try:
+            # Creating a vault that already exists succeeds
+            self.app.resource.create_vault(vaultName=vault_name)
+        except Exception as e:
+            self.send('INITREMOTE-FAILURE', '%s' % e)
+        else:
+            self.send('INITREMOTE-SUCCESS')
+
+    def handle_PREPARE(self, rest):
+        self.vault_name = self.get_config('vault')
+        max_age = self.get_config('maxage')
+        if not self.vault_name:
+            self.send('PREPARE-FAILURE', 'no vault configured')
+            return
+        if max_age:
+            try:
+                self.max_age_hours = int(max_age)
+            except ValueError:
+                self.send('PREPARE-FAILURE',
+                          'maxage must be a whole number of hours, not %r' %
+                          max_age)
+                return
+        self.send('PREPARE-SUCCESS')
+
+    def handle_GETCOST(self, rest):
+        self.send('COST', str(REMOTE_COST))
+
+    def handle_GETAVAILABILITY(self, rest):
+        self.send('AVAILABILITY', 'GLOBAL')
+
+    def handle_TRANSFER(self, rest):
+        direction, key, filename = rest.split(' ', 2)
+        try:
+            if direction == 'STORE':
+                self._store(key, filename)
+            elif direction == 'RETRIEVE':
+                self._retrieve(key, filename)
+            else:
+                raise ProtocolError('unknown transfer direction %r' % direction)
+        except Exception as e:
+            self.send('TRANSFER-FAILURE', direction, key, '%s' % e)
+        else:
+            self.send('TRANSFER-SUCCESS', direction, key)
+
+    def _store(self, key, filename):
+        with open(filename, 'rb') as f:
+            self.app._upload_archive(
+                self.vault_name, key, f,
+                multipart_size=DEFAULT_UPLOAD_PART_SIZE, resume=True)
+
+    def _retrieve(self, key, filename):
+        try:
+            archive_id = self.app.cache.get_archive_id(self.vault_name, key)
+        except KeyError:
+            raise RuntimeError('archive %r not found' % key)
+        jobs = self._job_index().for_archive(archive_id)
+        complete_job = find_complete_job(jobs)
+        if complete_job:
+            args = argparse.Namespace(
+                output_filename=filename,
+                multipart_size=DEFAULT_DOWNLOAD_PART_SIZE,
+                concurrency=1)
+            self.app._archive_retrieve_completed(args, complete_job, key)
+        elif has_pending_job(jobs):
+            raise RetryConsoleError('job still pending for archive %r' % key)
+        else:
+            vault = self._vault()
+            job = vault.Archive(archive_id).initiate_archive_retrieval(
+                jobParameters=self.app._job_parameters('archive-retrieval',
+                                                       ArchiveId=archive_id))
+            self.app._job_initiated(vault, job, 'ArchiveRetrieval', archive_id)
+            raise RetryConsoleError('queued retrieval job for archive %r' % key)
+
+    def handle_CHECKPRESENT(self, key):
+        try:
+            last_seen = self._last_seen(key)
+            if not self._recent_enough(last_seen):
+                self._sync()
+                last_seen = self._last_seen(key)
+        except Exception as e:
+            self.send('CHECKPRESENT-UNKNOWN', key, '%s' % e)
+            return
+        if last_seen is None:
+            self.send('CHECKPRESENT-FAILURE', key)
+        elif self._recent_enough(last_seen):
+            self.send('CHECKPRESENT-SUCCESS', key)
+        else:
+            self.send('CHECKPRESENT-UNKNOWN', key,
+                      'archive found, but has not been seen recently enough '
+                      'to consider it present')
+
+    def handle_REMOVE(self, key):
+        try:
+            try:
+                archive_id = self.app.cache.get_archive_id(self.vault_name,
+                                                           key)
+            except KeyError:
+                # Removing content that is not there succeeds
+                self.send('REMOVE-SUCCESS', key)
+                return
+            self._vault().Archive(archive_id).delete()
+            self.app.cache.delete_archive(self.vault_name, 'id:' + archive_id)
+        except Exception as e:
+            self.send('REMOVE-FAILURE', key, '%s' % e)
+        else:
+            self.send('REMOVE-SUCCESS', key)
+
+    def handle_ERROR(self, message):
+        raise ProtocolError('git-annex reported an error: %s' % message)
@@ -26,28 +26,60 @@ from __future__ import unicode_literals
 
 import argparse
 import calendar
+import collections
+import contextlib
 import errno
+import itertools
+import json
 import os
 import os.path
 import sys
+import tempfile
+import threading
 import time
-import json
 import logging
 from datetime import datetime
 
-import botocore
-import boto3
-import iso8601
-import sqlalchemy.exc
+# boto3, botocore, iso8601 and SQLAlchemy (through models) are imported only
+# where they are needed, as importing them dominates the run time of commands
+# that only read the cache, such as 'archive list'.
 
-from wrappedfile import WrappedFile
+from concurrent.futures import ThreadPoolExecutor
+
+from transfer import PartUploader, RangeDownloader, ChecksumMismatchError, \
+    list_uploaded_parts, run_concurrently
+import tiers
+import treehash
+from inventory import open_inventory
+from snapshots import InventorySnapshots
 from configuration import configuration, get_user_cache_dir
-from models import Cache
-from utils import validate_multipart_bytes
+from credentials import find_access_key
+from utils import validate_multipart_bytes, validate_concurrency, chunked, \
+    parse_duration
 
 
 PROGRAM_NAME = 'glacier'
 
+# Number of inventory entries to reconcile with the cache per transaction
+INVENTORY_BATCH_SIZE = 10000
+
+# Seconds to wait for a job to complete before giving up
+WAIT_TIMEOUT = 24 * 60 * 60
+
+# Seconds between polls of a job's status, starting at MIN_POLL_INTERVAL and
+# multiplied by POLL_BACKOFF after each poll up to MAX_POLL_INTERVAL. Jobs
+# are still polled when notifications are configured, in case one is lost,
+# but then rarely.
+MIN_POLL_INTERVAL = 30
+MAX_POLL_INTERVAL = 600
+MAX_NOTIFIED_POLL_INTERVAL = 60 * 60
+POLL_BACKOFF = 2
+
+# Seconds for which a listing of all of a vault's jobs is trusted. Until it
+# is listed again, only the vault's in-progress jobs are listed, and recorded
+# jobs that have left that listing are described one by one.
+JOB_LISTING_MAX_AGE = 6 * 60 * 60
+
 logger = logging.getLogger(PROGRAM_NAME)
 
 class ConsoleError(RuntimeError):
@@ -59,6 +91,7 @@ class RetryConsoleError(ConsoleError): pass
 
 
 def iso8601_to_unix_timestamp(iso8601_date_str):
+    import iso8601
     return calendar.timegm(iso8601.parse_date(iso8601_date_str).utctimetuple())
 
 
@@ -70,16 +103,56 @@ def get_cache_key():
     archives can never collide for connections that return the same key with
     this function. The cache will more more efficient if the same Glacier
     namespace sets always result in the same key.
+
+    The key is looked up without boto3 where possible, so that commands that
+    only use the cache need not import it or resolve credentials.
     """
-    # Note: the boto3 default session is used,so get the AWS access key from there
+    access_key = find_access_key()
+    if access_key is not None:
+        return access_key
+    # Note: the boto3 default session is used, so get the AWS access key from there
+    import boto3
+    if boto3.DEFAULT_SESSION is None:
+        boto3.setup_default_session()
     return boto3.DEFAULT_SESSION.get_credentials().access_key
 
 
-def find_retrieval_jobs(vault, archive_id):
-    return [job for job in vault.jobs.all() if job.archive_id == archive_id]
+class JobIndex(object):
+    """The jobs of a single vault, listed once and indexed by archive id and
+    by action, so that finding the jobs for an archive does not mean listing
+    every job in the vault again.
+
+    Jobs initiated afterwards are recorded with add_initiated() rather than
+    by listing the vault's jobs again."""
+
+    def __init__(self, jobs):
+        self._by_archive_id = collections.defaultdict(list)
+        self._by_action = collections.defaultdict(list)
+        for job in jobs:
+            self._add(job, job.action, job.archive_id)
+
+    def _add(self, job, action, archive_id):
+        self._by_action[action].append(job)
+        if archive_id is not None:
+            self._by_archive_id[archive_id].append(job)
+
+    def add_initiated(self, job, action, archive_id=None):
+        # action and archive_id are passed in, as reading them from a job
+        # that was not listed would mean describing it
+        self._add(job, action, archive_id)
+
+    def for_archive(self, archive_id):
+        return list(self._by_archive_id.get(archive_id, []))
+
+    def for_action(self, action):
+        return list(self._by_action.get(action, []))
 
 
-def find_inventory_jobs(vault, max_age_hours=0):
+def find_retrieval_jobs(job_index, archive_id):
+    return job_index.for_archive(archive_id)
+
+
+def find_inventory_jobs(job_index, max_age_hours=0):
     if max_age_hours:
         def recent_enough(job):
             if not job.completed:
@@ -91,11 +164,12 @@ def find_inventory_jobs(vault, max_age_hours=0):
         def recent_enough(job):
             return not job.completed
 
-    return [job for job in vault.jobs.all()
-            if job.action == 'InventoryRetrieval' and recent_enough(job)]
+    return [job for job in job_index.for_action('InventoryRetrieval')
+            if recent_enough(job)]
 
 
 def find_complete_job(jobs):
+    import iso8601
     for job in sorted(filter(lambda job: job.completed, jobs), key=lambda job: iso8601.parse_date(job.completion_date), reverse=True):
         return job
 
@@ -105,11 +179,13 @@ def has_pending_job(jobs):
 
 
 def update_job_list(jobs):
-    for i, job in enumerate(jobs):
-        job.reload()
+    # A job cannot change once it has completed
+    for job in jobs:
+        if not job.completed:
+            job.reload()
 
 
-def job_oneline(resource, cache, vault, job):
+def job_oneline(vault_name, job, archive_names):
     action_letter = {'ArchiveRetrieval': 'a',
                      'InventoryRetrieval': 'i'}[job.action]
     status_letter = {'InProgress': 'p',
@@ -119,32 +195,67 @@ def job_oneline(resource, cache, vault, job):
     if not date:
         date = job.creation_date
     if job.action == 'ArchiveRetrieval':
-        try:
-            name = cache.get_archive_name(vault.name, 'id:' + job.archive_id)
-        except KeyError:
-            name = None
+        name = archive_names.get(job.archive_id)
         if name is None:
             name = 'id:' + job.archive_id
     elif job.action == 'InventoryRetrieval':
         name = ''
-    return '{action_letter}/{status_letter} {date} {vault.name:10} {name}'.format(
+    return '{action_letter}/{status_letter} {date} {vault_name:10} {name}'.format(
             **locals())
 
 
-def wait_until_job_completed(jobs, sleep=600, tries=144):
-    max_tries = tries
-    update_job_list(jobs)
-    job = find_complete_job(jobs)
-    while not job:
-        tries -= 1
-        if tries < 0:
+def iter_completed_jobs(job_groups, timeout=WAIT_TIMEOUT, notifications=None,
+                        sleep=MIN_POLL_INTERVAL, max_sleep=MAX_POLL_INTERVAL):
+    """Wait for groups of jobs to complete, yielding (key, job) as soon as
+    any job of each group has completed.
+
+    job_groups is a list of (key, jobs) pairs, such as an archive name and
+    the jobs that would retrieve it; groups that complete together are
+    yielded in that order. Without notifications, the jobs are polled with
+    exponential backoff, from sleep seconds between polls up to max_sleep,
+    so that jobs which complete quickly are noticed quickly. With a
+    JobNotifications, waiting ends as soon as one of the jobs is notified as
+    complete, and only the notified jobs are described again; the jobs are
+    all still polled at the same backoff in case a notification never
+    comes."""
+    deadline = time.time() + timeout
+    pending = collections.OrderedDict(job_groups)
+    update_job_list([job for jobs in pending.values() for job in jobs])
+    while True:
+        for key, jobs in list(pending.items()):
+            job = find_complete_job(jobs)
+            if job:
+                del pending[key]
+                yield key, job
+        if not pending:
+            return
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
             raise RuntimeError('Timed out waiting for job completion')
-        logger.debug('Job not completed, sleeping for {} seconds (Wait {} of {})'.format(sleep, max_tries-tries, max_tries))
-        time.sleep(sleep)
-        update_job_list(jobs)
-        job = find_complete_job(jobs)
+        wait = min(sleep, remaining)
+        jobs = [job for jobs in pending.values() for job in jobs]
+        notified = None
+        if notifications is not None:
+            logger.debug('{} jobs not completed, waiting up to {} seconds for a notification'.format(len(jobs), wait))
+            notified = notifications.wait([job.id for job in jobs], wait)
+        else:
+            logger.debug('{} jobs not completed, sleeping for {} seconds'.format(len(jobs), wait))
+            time.sleep(wait)
+        if notified:
+            # Describing every pending job on each notification would cost
+            # quadratically many calls as a pipeline's jobs complete
+            update_job_list([job for job in jobs if job.id in notified])
+        else:
+            update_job_list(jobs)
+            sleep = min(sleep * POLL_BACKOFF, max_sleep)
+
 
-    return job
+def _name_and_duration(text):
+    name, sep, duration = text.rpartition('=')
+    if not sep or not name:
+        raise ValueError('expected NAME=DURATION')
+    return name, parse_duration(duration)
 
 
 class App(object):
@@ -155,14 +266,167 @@ class App(object):
         self.cache.upgrade_schema()
 
     def job_list(self):
-        for vault in self.resource.vaults.all():
-            job_list = [job_oneline(self.resource,
-                                    self.cache,
-                                    vault,
-                                    job)
-                        for job in vault.jobs.all()]
-            if job_list:
-                print(*job_list, sep="\n")
+        """Print the recorded jobs of every vault, a vault at a time.
+
+        With --refresh, every vault's jobs are listed from Glacier first, up
+        to --concurrency vaults at once, and each vault is printed as soon as
+        its listing arrives."""
+        if self.args.refresh:
+            validate_concurrency(self.args.concurrency)
+            run_concurrently(lambda vault: list(vault.jobs.all()),
+                             [(vault,) for vault in self.resource.vaults.all()],
+                             self.args.concurrency,
+                             callback=self._job_list_vault_listed)
+        else:
+            for vault_name, jobs in itertools.groupby(
+                    self.cache.get_jobs(), key=lambda job: job.vault):
+                self._print_jobs(vault_name, list(jobs))
+
+    def _job_list_vault_listed(self, item, jobs):
+        vault, = item
+        self._record_job_listing(vault.name, jobs)
+        self._print_jobs(vault.name, self.cache.get_jobs(vault.name))
+
+    def _print_jobs(self, vault_name, jobs):
+        archive_names = self.cache.get_archive_names(
+            vault_name,
+            [job.archive_id for job in jobs
+             if job.action == 'ArchiveRetrieval'])
+        for job in jobs:
+            print(job_oneline(vault_name, job, archive_names))
+        sys.stdout.flush()
+
+    @staticmethod
+    def _job_from_description(vault, description):
+        """Return a boto3 Job for a recorded job description without
+        describing the job again, as if it had just been listed"""
+        job = vault.Job(description['JobId'])
+        job.meta.data = description
+        return job
+
+    def _list_jobs(self, vault):
+        """List all of vault's jobs from Glacier, record them and return
+        them"""
+        jobs = list(vault.jobs.all())
+        self._record_job_listing(vault.name, jobs)
+        return jobs
+
+    def _record_job_listing(self, vault_name, jobs):
+        self.cache.replace_jobs(vault_name, [job.meta.data for job in jobs],
+                                listed=int(time.time()))
+
+    def _refresh_jobs(self, vault):
+        """Return vault's jobs, bringing the recorded jobs up to date.
+
+        All of the vault's jobs are only listed if that has not been done
+        for JOB_LISTING_MAX_AGE. Otherwise only its in-progress jobs are
+        listed, which finds jobs started elsewhere, and just those recorded
+        jobs that have since left that listing are described again."""
+        listed = self.cache.get_job_listing_time(vault.name)
+        if listed is None or listed < time.time() - JOB_LISTING_MAX_AGE:
+            return self._list_jobs(vault)
+
+        import botocore.exceptions
+        in_progress = list(vault.jobs_in_progress.all())
+        self.cache.record_jobs(vault.name,
+                               [job.meta.data for job in in_progress])
+        in_progress_ids = set(job.id for job in in_progress)
+        finished = []
+        expired = []
+        for recorded in self.cache.get_jobs(vault.name, in_progress=True):
+            if recorded.id in in_progress_ids:
+                continue
+            job = vault.Job(recorded.id)
+            try:
+                job.load()
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] != 'ResourceNotFoundException':
+                    raise
+                expired.append(recorded.id)
+            else:
+                finished.append(job.meta.data)
+        self.cache.record_jobs(vault.name, finished)
+        self.cache.delete_jobs(vault.name, expired)
+        return [self._job_from_description(vault, json.loads(job.description))
+                for job in self.cache.get_jobs(vault.name)]
+
+    def _job_index(self, vault):
+        """Return the JobIndex for vault, refreshing its jobs only the first
+        time it is needed during this invocation"""
+        if vault.name not in self._job_indexes:
+            self._job_indexes[vault.name] = JobIndex(self._refresh_jobs(vault))
+        return self._job_indexes[vault.name]
+
+    def _job_parameters(self, job_type, **parameters):
+        """Return the jobParameters for initiating a job of job_type, which
+        ask Glacier to notify the configured SNS topic, if any, when the job
+        completes"""
+        parameters['Type'] = job_type
+        topic = configuration['notifications']['sns_topic']
+        if topic:
+            parameters['SNSTopic'] = topic
+        return parameters
+
+    def _job_notifications(self):
+        """Return a JobNotifications for the configured SQS queue, or None
+        if there is none"""
+        queue_url = configuration['notifications']['sqs_queue_url']
+        if not queue_url:
+            return None
+        import boto3
+        from notifications import JobNotifications
+        sqs = boto3.client(
+            'sqs', region_name=self.args.region,
+            endpoint_url=configuration['notifications']['sqs_endpoint_url'] or None)
+        return JobNotifications(sqs, queue_url)
+
+    def _job_initiated(self, vault, job, action, archive_id=None, tier=None):
+        """Record a job that has just been initiated, both in the cache and
+        in vault's JobIndex, without describing it"""
+        description = {
+            'JobId': job.id,
+            'Action': action,
+            'ArchiveId': archive_id,
+            'StatusCode': 'InProgress',
+            'Completed': False,
+            'CreationDate': datetime.utcnow().strftime(
+                '%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+        }
+        if tier is not None:
+            description['Tier'] = tier
+        job.meta.data = description
+        self.cache.record_jobs(vault.name, [description])
+        self._job_index(vault).add_initiated(job, action, archive_id)
+
+    def _iter_completed_jobs(self, vault, job_groups):
+        """Wait for groups of vault's jobs as iter_completed_jobs does,
+        using notifications if configured, and record each completed job"""
+        for key, job in self._iter_completed_job_groups(job_groups):
+            self.cache.record_jobs(vault.name, [job.meta.data])
+            yield key, job
+
+    def _iter_completed_job_groups(self, job_groups):
+        """iter_completed_jobs, using notifications if configured"""
+        notifications = self._job_notifications()
+        if notifications is None:
+            return iter_completed_jobs(job_groups)
+        return iter_completed_jobs(job_groups, notifications=notifications,
+                                   max_sleep=MAX_NOTIFIED_POLL_INTERVAL)
+
+    def _wait_for_job(self, vault, jobs):
+        """Wait for one of jobs to complete, record it and return it"""
+        for key, job in self._iter_completed_jobs(vault, [(None, jobs)]):
+            return job
+
+    def _forget_job_index(self, vault_name):
+        """Make the next _job_index() call for vault_name refresh its jobs
+        again, for long running callers that need to see jobs changing"""
+        self._job_indexes.pop(vault_name, None)
+
+    def annex_remote(self):
+        # Imported here as only this subcommand needs it
+        from annexremote import AnnexRemote
+        AnnexRemote(self, sys.stdin, sys.stdout).run()
 
     def vault_list(self):
         print(*[vault.name for vault in self.resource.vaults.all()],
@@ -179,80 +443,320 @@ class App(object):
                 return True
         raise RuntimeError('Could not find vault {}'.format(self.args.name))
 
-    def _vault_sync_reconcile(self, vault, job, fix=False):
+    def _vault_sync_reconcile(self, vault, job, fix=False, cache=None):
+        """Reconcile the cache with the inventory that job retrieved,
+        keeping a compressed snapshot of it as it is read. The snapshot is
+        kept even if reconciling fails, so that it can be retried without
+        another inventory job, but not if it is interrupted, which would
+        otherwise first have to wait for the rest of the inventory."""
+        if cache is None:
+            cache = self.cache
         job_output = job.get_output()
-        response = job_output['body'].read()
-        response = json.loads(response)
-        inventory_date = iso8601_to_unix_timestamp(response['InventoryDate'])
+        content_type = job_output.get('contentType')
         job_creation_date = iso8601_to_unix_timestamp(job.creation_date)
-        seen_ids = []
-        for archive in response['ArchiveList']:
-            id = archive['ArchiveId']
-            name = archive['ArchiveDescription']
-            size = archive['Size']
-            creation_date = iso8601_to_unix_timestamp(archive['CreationDate'])
-            self.cache.mark_seen_upstream(
-                vault=vault.name,
-                id=id,
-                name=name,
-                size=size,
-                upstream_creation_date=creation_date,
-                upstream_inventory_date=inventory_date,
-                upstream_inventory_job_creation_date=job_creation_date,
-                fix=fix)
-            seen_ids.append(id)
-        self.cache.mark_only_seen(vault.name, inventory_date, seen_ids,
-                                  fix=fix)
-        self.cache.mark_commit()
-
-    def _vault_sync(self, vault_name, max_age_hours, fix, wait):
-        vault = self.resource.Vault('-', vault_name)
-        inventory_jobs = find_inventory_jobs(vault,
-                                             max_age_hours=max_age_hours)
+        snapshot = None
+        if int(configuration['inventory_snapshots']['max_count']) > 0:
+            path = self._inventory_snapshots.path(vault.name, job.id,
+                                                  content_type)
+            snapshot = self._inventory_snapshots.writer(job_output['body'],
+                                                        path)
+        inventory_date = None
+        try:
+            reader = open_inventory(snapshot or job_output['body'],
+                                    content_type)
+            inventory_date = self._inventory_date(reader.read_header(),
+                                                  job_creation_date)
+            unchanged = self._reconcile_inventory(
+                vault.name, reader, inventory_date, job.id,
+                job_creation_date, fix=fix, cache=cache)
+        except Exception:
+            if snapshot is not None:
+                if inventory_date is None:
+                    # The header could not be read, so assume the oldest
+                    # date, as for an undated inventory
+                    inventory_date = self._inventory_date({},
+                                                          job_creation_date)
+                self._keep_inventory_snapshot(
+                    vault.name, job.id, inventory_date, job_creation_date,
+                    content_type, path, snapshot, cache)
+            raise
+        else:
+            if snapshot is not None and not unchanged:
+                self._keep_inventory_snapshot(
+                    vault.name, job.id, inventory_date, job_creation_date,
+                    content_type, path, snapshot, cache)
+        finally:
+            if snapshot is not None:
+                snapshot.discard()
 
+    @staticmethod
+    def _inventory_date(header, job_creation_date):
+        if 'InventoryDate' in header:
+            return iso8601_to_unix_timestamp(header['InventoryDate'])
+        # CSV inventories are undated. Assume the oldest inventory that the
+        # job could have returned, which errs towards keeping archives in the
+        # cache and not warning about them.
+        from models import INVENTORY_LAG
+        return job_creation_date - INVENTORY_LAG
+
+    def _reconcile_inventory(self, vault_name, reader, inventory_date, job_id,
+                             job_creation_date, fix=False, cache=None):
+        """Reconcile the cache with an inventory whose header reader has
+        read. Each batch is written under the cache write lock, so that
+        vaults can be reconciled from several threads, each with a cache of
+        its own. Return whether the inventory was the one last reconciled,
+        in which case its archives are not reconciled one by one."""
+        if cache is None:
+            cache = self.cache
+        previous = cache.get_reconciled_inventory(vault_name)
+        unchanged = False
+        spool = None
+        try:
+            if fix or previous is None:
+                pass
+            elif 'InventoryDate' in reader.header:
+                unchanged = previous.inventory_date == inventory_date
+            elif previous.digest is not None:
+                # An undated inventory can only be recognised by its digest,
+                # so read the rest of it to a temporary file first, to be
+                # parsed from there if it has changed after all
+                spool = tempfile.TemporaryFile()
+                reader.read_ahead(spool)
+                unchanged = reader.hexdigest() == previous.digest
+            if unchanged:
+                logger.debug('Inventory of {} unchanged since job {}'.format(
+                    vault_name, previous.job_id))
+                with self._cache_write_lock:
+                    cache.mark_inventory_unchanged(
+                        vault_name, job_creation_date, job_id)
+                    cache.mark_commit()
+                return True
+            self._reconcile_inventory_archives(
+                vault_name, reader, inventory_date, job_id,
+                job_creation_date, fix, cache)
+            return False
+        finally:
+            if spool is not None:
+                spool.close()
+
+    def _reconcile_inventory_archives(self, vault_name, reader,
+                                      inventory_date, job_id,
+                                      job_creation_date, fix, cache):
+        for batch in chunked(reader.archives(), INVENTORY_BATCH_SIZE):
+            with self._cache_write_lock:
+                cache.mark_seen_upstream_batch(
+                    vault=vault_name,
+                    archives=[{'id': archive['ArchiveId'],
+                               'name': archive['ArchiveDescription'],
+                               'size': archive['Size']} for archive in batch],
+                    upstream_inventory_date=inventory_date,
+                    upstream_inventory_job_creation_date=job_creation_date,
+                    fix=fix)
+                cache.mark_commit()
+        with self._cache_write_lock:
+            cache.mark_only_seen(vault_name, inventory_date, job_creation_date,
+                                 fix=fix)
+            cache.record_reconciled_inventory(
+                vault_name, inventory_date, job_creation_date, job_id,
+                reader.hexdigest())
+            cache.mark_commit()
+
+    @property
+    def _inventory_snapshots(self):
+        return InventorySnapshots(
+            configuration['inventory_snapshots']['directory'])
+
+    def _keep_inventory_snapshot(self, vault_name, job_id, inventory_date,
+                                 job_creation_date, content_type, path,
+                                 snapshot, cache):
+        """Finish writing an inventory snapshot, index it and evict old
+        ones. Failing to keep a snapshot does not fail the sync."""
+        try:
+            snapshot.finish()
+            with self._cache_write_lock:
+                cache.add_inventory_snapshot(
+                    vault_name, job_id, inventory_date, job_creation_date,
+                    content_type, path, snapshot.size)
+                self._evict_inventory_snapshots(vault_name, cache)
+        except Exception as e:
+            logger.warn('could not keep inventory snapshot of %r: %s' %
+                        (vault_name, e))
+
+    def _evict_inventory_snapshots(self, vault_name, cache):
+        """Remove vault's snapshots beyond the newest max_count, and any
+        older than max_age_days"""
+        max_count = int(configuration['inventory_snapshots']['max_count'])
+        max_age = (float(configuration['inventory_snapshots']['max_age_days'])
+                   * 24 * 60 * 60)
+        snapshots = cache.get_inventory_snapshots(vault_name)
+        for i, snapshot in enumerate(snapshots):
+            if (i >= max_count or
+                    snapshot.created_here < time.time() - max_age):
+                logger.debug('Evicting inventory snapshot {}'.format(
+                    snapshot.path))
+                self._inventory_snapshots.remove(snapshot.path)
+                cache.delete_inventory_snapshot(snapshot.job_id)
+
+    def _vault_sync_from_snapshot(self, vault_name, fix):
+        """Reconcile vault with its newest inventory snapshot, without
+        asking Glacier for anything"""
+        snapshots = self.cache.get_inventory_snapshots(vault_name)
+        if not snapshots:
+            raise ConsoleError('no inventory snapshot of %r' % vault_name)
+        snapshot = snapshots[0]
+        try:
+            body = self._inventory_snapshots.open(snapshot.path)
+            reader = open_inventory(body, snapshot.content_type)
+            reader.read_header()
+        except IOError as e:
+            raise ConsoleError('could not read inventory snapshot of %r: %s' %
+                               (vault_name, e))
+        with contextlib.closing(body):
+            self._reconcile_inventory(
+                vault_name, reader, snapshot.inventory_date, snapshot.job_id,
+                snapshot.job_creation_date, fix=fix)
+
+    def _reconcile_in_thread(self, vault, job, fix):
+        cache = self.cache.clone()
+        try:
+            self._vault_sync_reconcile(vault, job, fix=fix, cache=cache)
+        finally:
+            cache.close()
+
+    def _attach_inventory_jobs(self, vault, max_age_hours,
+                               inventory_format='JSON'):
+        """Find or initiate an inventory job for vault, requesting the
+        inventory in inventory_format if a new job is needed.
+
+        Return (jobs, message): if one of jobs has completed, it is first
+        and message is None; otherwise message says what is being waited
+        for."""
+        inventory_jobs = find_inventory_jobs(self._job_index(vault),
+                                             max_age_hours=max_age_hours)
         complete_job = find_complete_job(inventory_jobs)
         if complete_job:
-            self._vault_sync_reconcile(vault, complete_job, fix=fix)
-        elif has_pending_job(inventory_jobs):
-            if wait:
-                complete_job = wait_until_job_completed(inventory_jobs)
-            else:
-                raise RetryConsoleError('job still pending for inventory on %r' %
-                                        vault.name)
+            return [complete_job], None
+        if has_pending_job(inventory_jobs):
+            return (inventory_jobs,
+                    'job still pending for inventory on %r' % vault.name)
+        job = vault.initiate_inventory_retrieval(
+            jobParameters=self._job_parameters('inventory-retrieval',
+                                               Format=inventory_format))
+        self._job_initiated(vault, job, 'InventoryRetrieval')
+        return [job], 'queued inventory job for %r' % vault.name
+
+    def _vault_sync(self, vault_name, max_age_hours, fix, wait,
+                    inventory_format='JSON'):
+        vault = self.resource.Vault('-', vault_name)
+        jobs, message = self._attach_inventory_jobs(vault, max_age_hours,
+                                                     inventory_format)
+        if message is None:
+            job = jobs[0]
+        elif wait:
+            job = self._wait_for_job(vault, jobs)
         else:
-            job = vault.initiate_inventory_retrieval()
-            if wait:
-                wait_until_job_completed([job])
-                self._vault_sync_reconcile(vault, job, fix=fix)
+            raise RetryConsoleError(message)
+        self._vault_sync_reconcile(vault, job, fix=fix)
+
+    def _vault_sync_many(self, vault_names, max_age_hours, fix, wait,
+                         concurrency=1, inventory_format='JSON'):
+        """Sync several vaults as a pipeline: inventory jobs are first found
+        or initiated for all of them, then with wait all of the jobs are
+        watched together and each vault is reconciled as soon as its job
+        completes, up to concurrency at once."""
+        completed = []
+        waiting = []
+        retry_list = []
+        for vault_name in collections.OrderedDict.fromkeys(vault_names):
+            vault = self.resource.Vault('-', vault_name)
+            jobs, message = self._attach_inventory_jobs(vault, max_age_hours,
+                                                         inventory_format)
+            if message is None:
+                completed.append((vault, jobs[0]))
+            elif wait:
+                waiting.append((vault, jobs))
             else:
-                raise RetryConsoleError('queued inventory job for %r' %
-                        vault.name)
+                retry_list.append(message)
+
+        success_list = []
+        error_list = []
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            reconciles = [(vault, executor.submit(self._reconcile_in_thread,
+                                                  vault, job, fix))
+                          for vault, job in completed]
+            if waiting:
+                for vault, job in self._iter_completed_job_groups(waiting):
+                    self.cache.record_jobs(vault.name, [job.meta.data])
+                    logger.info('inventory job for %r completed' % vault.name)
+                    reconciles.append((vault, executor.submit(
+                        self._reconcile_in_thread, vault, job, fix)))
+            for vault, reconcile in reconciles:
+                try:
+                    reconcile.result()
+                except Exception as e:
+                    error_list.append('could not sync vault %r: %s' %
+                                      (vault.name, e))
+                else:
+                    success_list.append('synced vault %r' % vault.name)
+
+        if error_list:
+            raise ConsoleError("\n".join(success_list + error_list +
+                                         retry_list))
+        if retry_list:
+            raise RetryConsoleError("\n".join(success_list + retry_list))
 
     def vault_sync(self):
-        return self._vault_sync(vault_name=self.args.name,
-                                max_age_hours=self.args.max_age_hours,
-                                fix=self.args.fix,
-                                wait=self.args.wait)
+        if self.args.from_snapshot:
+            if self.args.all:
+                vault_names = self.cache.get_inventory_snapshot_vaults()
+            else:
+                vault_names = self.args.names
+            if not vault_names:
+                raise ConsoleError('no vault named; use --all to sync every '
+                                   'vault with a snapshot')
+            for vault_name in collections.OrderedDict.fromkeys(vault_names):
+                self._vault_sync_from_snapshot(vault_name, fix=self.args.fix)
+            return
+        if self.args.all:
+            if self.args.names:
+                raise ConsoleError('cannot name vaults with --all')
+            vault_names = [vault.name
+                           for vault in self.resource.vaults.all()]
+        elif self.args.names:
+            vault_names = self.args.names
+        else:
+            raise ConsoleError('no vault named; use --all to sync every vault')
+        if len(vault_names) == 1 and not self.args.all:
+            return self._vault_sync(vault_name=vault_names[0],
+                                    max_age_hours=self.args.max_age_hours,
+                                    fix=self.args.fix,
+                                    wait=self.args.wait,
+                                    inventory_format=self.args.format)
+        validate_concurrency(self.args.concurrency)
+        return self._vault_sync_many(vault_names,
+                                     max_age_hours=self.args.max_age_hours,
+                                     fix=self.args.fix,
+                                     wait=self.args.wait,
+                                     concurrency=self.args.concurrency,
+                                     inventory_format=self.args.format)
 
     def archive_list(self):
         if self.args.force_ids:
-            archive_list = list(self.cache.get_archive_list_with_ids(
-                self.args.vault))
+            archive_list = self.cache.get_archive_list_with_ids(
+                self.args.vault)
         else:
-            archive_list = list(self.cache.get_archive_list(self.args.vault))
+            archive_list = self.cache.get_archive_list(self.args.vault)
 
-        if archive_list:
-            print(*archive_list, sep="\n")
+        for line in archive_list:
+            print(line)
 
     def archive_ls(self):
         """List archives in a vault with more consistent output"""
-        archive_list = self.cache.get_archive_list_objects(self.args.vault)
-        for archive in archive_list:
-            print('id:{} {} {} {}'.format(archive.id,
-                                          archive.size,
-                                          datetime.fromtimestamp(archive.modified),
-                                          archive.name))
-
+        for id, size, modified, name in self.cache.get_archive_listing(
+                self.args.vault):
+            print('id:{} {} {} {}'.format(id, size,
+                                          datetime.fromtimestamp(modified),
+                                          name))
 
     def archive_upload(self):
         # XXX: "Leading whitespace in archive descriptions is removed."
@@ -269,90 +773,135 @@ class App(object):
                 raise RuntimeError('Archive name not specified. Use --name')
             name = os.path.basename(full_name)
 
-        file = self.args.file
-        multipart_size = self.args.multipart_size
+        self._upload_archive(self.args.vault, name, self.args.file,
+                             multipart_size=self.args.multipart_size,
+                             concurrency=self.args.concurrency,
+                             resume=self.args.resume)
+
+    def _upload_archive(self, vault_name, name, file, multipart_size,
+                        concurrency=1, resume=False):
+        """Upload file to vault_name as an archive called name and return
+        the new archive's id"""
         validate_multipart_bytes(multipart_size)
-        logger.debug('Uploading archive with multipart size={}'.format(multipart_size))
+        validate_concurrency(concurrency)
+        logger.debug('Uploading archive with multipart size={} and concurrency={}'.format(multipart_size, concurrency))
         file.seek(0, 2)  # move to end of file
         file_size = file.tell()
         file.seek(0)
-        file_tree_hash = botocore.utils.calculate_tree_hash(file)
-        file.seek(0)
 
-        vault = self.resource.Vault('-', self.args.vault)
+        vault = self.resource.Vault('-', vault_name)
         if file_size < multipart_size:
             logger.debug('Uploading in single upload')
+            data = file.read()
             archive = vault.upload_archive(
                 archiveDescription=name,
-                body=file
+                body=data,
+                checksum=treehash.tree_hash(data)
             )
-            self.cache.add_archive(self.args.vault, name, file_size, archive)
+            self.cache.add_archive(vault_name, name, file_size, archive)
+            return archive.id
         else:
+            # Only uploads from regular files can be recognised again later
+            identity = None
+            if os.path.isfile(file.name):
+                identity = (os.path.abspath(file.name),
+                            int(os.fstat(file.fileno()).st_mtime))
+
             multipart = None
+            completed_parts = {}
+            if resume:
+                multipart, completed_parts = self._find_resumable_upload(
+                    vault_name, vault, name, identity, file_size,
+                    multipart_size)
             try:
-                logger.debug('Uploading in multi-part upload')
-                multipart = vault.initiate_multipart_upload(
-                    archiveDescription=name,
-                    partSize=str(multipart_size)
-                )
-
-                def _upload(start_byte, end_byte, chunk_num):
-                    logger.debug('Uploading bytes {}-{} (Chunk {} of {})'.format(start_byte, end_byte - 1, chunk_num, chunks))
-                    wrapped_reader = WrappedFile(file, start_byte, end_byte)
-                    multipart.upload_part(
-                        range='bytes {}-{}/*'.format(start_byte, end_byte - 1),
-                        body=wrapped_reader
+                if multipart is None:
+                    logger.debug('Uploading in multi-part upload')
+                    multipart = vault.initiate_multipart_upload(
+                        archiveDescription=name,
+                        partSize=str(multipart_size)
                     )
-
-                whole_parts = file_size // multipart_size
-                chunks = whole_parts
-                remainder = file_size % multipart_size
-                if remainder:
-                    chunks += 1
-                for chunk_num, first_byte in enumerate(xrange(0, whole_parts * multipart_size,
-                                                             multipart_size)):
-                    _upload(first_byte, first_byte + multipart_size, chunk_num=chunk_num+1)
-                if remainder:
-                    _upload(file_size-remainder, file_size, chunk_num=chunks)
+                    if identity is not None:
+                        self.cache.add_multipart_upload(
+                            vault_name, name, multipart.id, identity[0],
+                            file_size, identity[1], multipart_size)
+
+                def on_part_complete(start_byte, end_byte, tree_hash):
+                    if identity is not None:
+                        self.cache.add_multipart_part(
+                            multipart.id, start_byte, end_byte, tree_hash)
+
+                uploader = PartUploader(multipart, file, multipart_size,
+                                        concurrency=concurrency,
+                                        completed_parts=completed_parts,
+                                        on_part_complete=on_part_complete)
+                part_tree_hashes = uploader.upload(file_size)
 
                 response = multipart.complete(
                     archiveSize=str(file_size),
-                    checksum=file_tree_hash
+                    checksum=treehash.combine_tree_hashes(part_tree_hashes)
                 )
                 archive = vault.Archive(response['archiveId'])
-                self.cache.add_archive(self.args.vault, name, file_size, archive)
+                self.cache.add_archive(vault_name, name, file_size, archive)
+                if identity is not None:
+                    self.cache.delete_multipart_upload(multipart.id)
                 logger.debug('Multipart upload complete')
+                return archive.id
             except Exception, e:
                 logger.warn('Unhandled exception during multi-part upload: {} {}'.format(type(e), e))
                 if multipart:
+                    if identity is not None:
+                        raise RetryConsoleError(
+                            'upload of %r interrupted; rerun with --resume to continue it' % name)
                     multipart.abort()
                     logger.debug('Multipart upload aborted')
+                raise ConsoleError('multi-part upload of %r failed: %s' % (name, e))
+
+    def _find_resumable_upload(self, vault_name, vault, name, identity,
+                               file_size, part_size):
+        """Return the interrupted multipart upload of the same file and the
+        parts of it that Glacier has accepted, or (None, {})"""
+        if identity is None:
+            raise ConsoleError('only uploads from a regular file can be resumed')
+        path, file_mtime = identity
+        upload_id = self.cache.find_multipart_upload(
+            vault_name, name, path, file_size, file_mtime, part_size)
+        if upload_id is None:
+            logger.info('No interrupted upload of %r found; starting a new one' % name)
+            return None, {}
+
+        import botocore.exceptions
+        multipart = vault.MultipartUpload(upload_id)
+        try:
+            uploaded_parts = list_uploaded_parts(multipart)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'ResourceNotFoundException':
+                raise
+            logger.warn('Interrupted upload of %r has expired; starting a new one' % name)
+            self.cache.delete_multipart_upload(upload_id)
+            return None, {}
+
+        # Glacier is authoritative about which parts it has, but don't trust
+        # a part that disagrees with what we recorded sending
+        recorded_parts = self.cache.get_multipart_parts(upload_id)
+        completed_parts = dict(
+            (start_byte, tree_hash)
+            for start_byte, tree_hash in uploaded_parts.items()
+            if recorded_parts.get(start_byte, tree_hash) == tree_hash)
+        return multipart, completed_parts
 
     @staticmethod
-    def _write_archive_retrieval_job(args, f, job, multipart_size):
+    def _write_archive_retrieval_job(args, f, job, multipart_size,
+                                     completed_ranges=None,
+                                     on_range_complete=None):
         validate_multipart_bytes(multipart_size)
-        if job.archive_size_in_bytes > multipart_size:
-
-            def fetch(start, end, chunk_num):
-                byte_range = start, end-1
-                logger.debug('Fetching multipart byte range {}-{} (Chunk {} of {})'.format(byte_range[0], byte_range[1], chunk_num, chunks))
-                response = job.get_output(range='bytes={}-{}'.format(*byte_range))
-                data = response['body'].read()
-                f.write(data)
-
-            whole_parts = job.archive_size_in_bytes // multipart_size
-            chunks = whole_parts
-            remainder = job.archive_size_in_bytes % multipart_size
-            if remainder:
-                chunks += 1
-            for chunk_num, first_byte in enumerate(xrange(0, whole_parts * multipart_size, multipart_size)):
-                fetch(first_byte, first_byte + multipart_size, chunk_num=chunk_num+1)
-            if remainder:
-                fetch(job.archive_size_in_bytes - remainder, job.archive_size_in_bytes, chunk_num=chunks)
-        else:
-            logger.debug('Fetching entire byte range')
-            response = job.get_output()
-            f.write(response['body'].read())
+        validate_concurrency(args.concurrency)
+        downloader = RangeDownloader(job, f, multipart_size,
+                                     concurrency=args.concurrency,
+                                     seekable=args.output_filename != '-',
+                                     completed_ranges=completed_ranges,
+                                     on_range_complete=on_range_complete)
+        downloader.download(job.archive_size_in_bytes,
+                            expected_tree_hash=job.sha256_tree_hash)
 
         # Make sure that the file now exactly matches the downloaded archive,
         # even if the file existed before and was longer.
@@ -366,67 +915,195 @@ class App(object):
 
         f.flush()
 
-        # Verify tree hash to make sure we have the full content uncorrupted
-        if args.output_filename != '-':
-            if botocore.utils.calculate_tree_hash(open(f.name, 'rb')) != job.sha256_tree_hash:
-                raise ConsoleError('SHA256 Tree Hash does not match Glacier Archive. Download is likely corrupt.')
-        else:
-            logger.warn("File saved to stdout cannot have it's SHA256 Tree Hash verified")
-
 
-    @classmethod
-    def _archive_retrieve_completed(cls, args, job, name):
+    def _archive_retrieve_completed(self, args, job, name, cache=None):
+        """Download the output of job, a completed retrieval of archive name.
+        cache defaults to self.cache, but a thread other than the main one
+        must pass a Cache of its own."""
+        if cache is None:
+            cache = self.cache
         if args.output_filename == '-':
-            cls._write_archive_retrieval_job(
+            self._write_archive_retrieval_job(
                 args, sys.stdout, job, args.multipart_size)
+            return
+
+        if args.output_filename:
+            filename = args.output_filename
         else:
-            if args.output_filename:
-                filename = args.output_filename
-            else:
-                filename = os.path.basename(name)
-            with open(filename, 'wb') as f:
-                cls._write_archive_retrieval_job(args, f, job, args.multipart_size)
+            filename = os.path.basename(name)
+
+        # Resume into an existing file if an earlier attempt to download the
+        # same job output to it was interrupted
+        path = os.path.abspath(filename)
+        completed_ranges = cache.get_retrieval_ranges(
+            job.id, path, args.multipart_size)
+        if (completed_ranges and os.path.exists(path) and
+                os.path.getsize(path) == job.archive_size_in_bytes):
+            mode = 'r+b'
+        else:
+            cache.clear_retrieval_ranges(job.id, path)
+            completed_ranges = {}
+            mode = 'wb'
 
-    def archive_retrieve_one(self, name):
+        def on_range_complete(start_byte, end_byte, tree_hash):
+            cache.add_retrieval_range(
+                job.id, path, args.multipart_size, start_byte, end_byte,
+                tree_hash)
+
+        try:
+            with open(filename, mode) as f:
+                self._write_archive_retrieval_job(
+                    args, f, job, args.multipart_size,
+                    completed_ranges=completed_ranges,
+                    on_range_complete=on_range_complete)
+        except ChecksumMismatchError:
+            # Resuming would only reproduce the same corrupt file
+            cache.clear_retrieval_ranges(job.id, path)
+            raise
+        cache.clear_retrieval_ranges(job.id, path)
+
+    def _retrieval_deadline(self, name):
+        """Return the number of seconds within which archive name should be
+        retrieved, or None if it does not matter"""
+        deadlines = dict(self.args.deadline_for or [])
+        if name in deadlines:
+            return deadlines[name]
+        if self.args.deadline is not None:
+            return self.args.deadline
+        if self.args.tier is not None:
+            return tiers.TIER_LATENCY[self.args.tier]
+        return None
+
+    def _retrieval_tier(self, vault, name, deadline):
+        """Return the tier in which to retrieve archive name: the one asked
+        for, or the cheapest expected to meet deadline"""
+        if deadline is None:
+            return None
+        if (self.args.tier is not None and
+                name not in dict(self.args.deadline_for or [])):
+            return self.args.tier
+        size = self.cache.get_archive_size(vault.name, name)
+        tier = tiers.plan_tier(size, deadline)
+        if tiers.TIER_LATENCY[tier] > deadline:
+            logger.warn('no retrieval tier is expected to retrieve archive %r in time; using %s' % (name, tier))
+        return tier
+
+    def _initiate_archive_retrieval(self, vault, archive_id, tier):
+        """Initiate a retrieval of archive_id in tier, falling back from
+        Expedited to Standard if Glacier has no capacity to expedite it"""
+        import botocore.exceptions
+        archive = vault.Archive(archive_id)
+        parameters = {'ArchiveId': archive_id}
+        if tier is not None:
+            parameters['Tier'] = tier
+        try:
+            job = archive.initiate_archive_retrieval(
+                jobParameters=self._job_parameters('archive-retrieval',
+                                                   **parameters))
+        except botocore.exceptions.ClientError as e:
+            if (tier != tiers.EXPEDITED or
+                    e.response['Error']['Code'] != 'InsufficientCapacityException'):
+                raise
+            logger.warn('no capacity for an Expedited retrieval of archive id %s; using Standard' % archive_id)
+            tier = tiers.STANDARD
+            job = archive.initiate_archive_retrieval(
+                jobParameters=self._job_parameters('archive-retrieval',
+                                                   ArchiveId=archive_id,
+                                                   Tier=tier))
+        self._job_initiated(vault, job, 'ArchiveRetrieval', archive_id, tier)
+        return job, tier
+
+    def _attach_retrieval_jobs(self, vault, name):
+        """Return the jobs that will retrieve archive name, with a completed
+        one first if there is one, initiating a job if there are none that
+        are expected to complete in time, and a message describing any
+        wait"""
         try:
-            archive_id = self.cache.get_archive_id(self.args.vault, name)
+            archive_id = self.cache.get_archive_id(vault.name, name)
         except KeyError:
             raise ConsoleError('archive %r not found' % name)
 
-        vault = self.resource.Vault('-', self.args.vault)
-        retrieval_jobs = find_retrieval_jobs(vault, archive_id)
-
+        retrieval_jobs = find_retrieval_jobs(self._job_index(vault),
+                                             archive_id)
         complete_job = find_complete_job(retrieval_jobs)
         if complete_job:
-            self._archive_retrieve_completed(self.args, complete_job, name)
-        elif has_pending_job(retrieval_jobs):
-            if self.args.wait:
-                complete_job = wait_until_job_completed(retrieval_jobs)
-                self._archive_retrieve_completed(self.args, complete_job, name)
-            else:
-                raise RetryConsoleError('job still pending for archive %r' % name)
-        else:
-            # create an archive retrieval job
-            archive = vault.Archive(archive_id)
-            job = archive.initiate_archive_retrieval()
-            if self.args.wait:
-                wait_until_job_completed([job])
-                self._archive_retrieve_completed(self.args, job, name)
-            else:
-                raise RetryConsoleError('queued retrieval job for archive %r' % name)
+            return [complete_job], None
+        pending_jobs = [job for job in retrieval_jobs if not job.completed]
+        deadline = self._retrieval_deadline(name)
+        if deadline is not None:
+            pending_jobs = [
+                job for job in pending_jobs
+                if tiers.expected_completion(
+                    job.tier, iso8601_to_unix_timestamp(job.creation_date))
+                <= time.time() + deadline]
+        if pending_jobs:
+            return pending_jobs, 'job still pending for archive %r' % name
+
+        job, tier = self._initiate_archive_retrieval(
+            vault, archive_id, self._retrieval_tier(vault, name, deadline))
+        if tier is None:
+            return [job], 'queued retrieval job for archive %r' % name
+        return [job], 'queued %s retrieval job for archive %r' % (tier, name)
+
+    def _download_retrieval(self, name, job):
+        """Download archive name from job, which has completed, using a
+        Cache of its own so that it can run on a worker thread"""
+        if job.status_code != 'Succeeded':
+            raise ConsoleError('retrieval job for archive %r failed: %s' %
+                               (name, job.status_message))
+        cache = self.cache.clone()
+        try:
+            self._archive_retrieve_completed(self.args, job, name,
+                                             cache=cache)
+        finally:
+            cache.close()
 
     def archive_retrieve(self):
+        """Retrieve every named archive as a pipeline: jobs are first found
+        or initiated for all of them, then with --wait all of the jobs are
+        watched together and each archive is downloaded as soon as its job
+        completes, up to --archive-concurrency at once."""
         if len(self.args.names) > 1 and self.args.output_filename:
             raise ConsoleError('cannot specify output filename with multi-archive retrieval')
-        success_list = []
+        validate_concurrency(self.args.archive_concurrency)
+        vault = self.resource.Vault('-', self.args.vault)
+
+        completed = []
+        waiting = []
         retry_list = []
-        for name in self.args.names:
-            try:
-                self.archive_retrieve_one(name)
-            except RetryConsoleError as e:
-                retry_list.append(e.message)
+        for name in collections.OrderedDict.fromkeys(self.args.names):
+            jobs, message = self._attach_retrieval_jobs(vault, name)
+            if message is None:
+                completed.append((name, jobs[0]))
+            elif self.args.wait:
+                waiting.append((name, jobs))
             else:
-                success_list.append('retrieved archive %r' % name)
+                retry_list.append(message)
+
+        success_list = []
+        error_list = []
+        with ThreadPoolExecutor(
+                max_workers=self.args.archive_concurrency) as executor:
+            downloads = [(name, executor.submit(self._download_retrieval,
+                                                name, job))
+                         for name, job in completed]
+            if waiting:
+                for name, job in self._iter_completed_jobs(vault, waiting):
+                    logger.info('retrieval job for archive %r completed' % name)
+                    downloads.append((name, executor.submit(
+                        self._download_retrieval, name, job)))
+            for name, download in downloads:
+                try:
+                    download.result()
+                except Exception as e:
+                    error_list.append('could not retrieve archive %r: %s' %
+                                      (name, e))
+                else:
+                    success_list.append('retrieved archive %r' % name)
+
+        if error_list:
+            raise ConsoleError("\n".join(success_list + error_list +
+                                         retry_list))
         if retry_list:
             message_list = success_list + retry_list
             raise RetryConsoleError("\n".join(message_list))
@@ -441,7 +1118,20 @@ class App(object):
         vault.Archive(archive_id).delete()
         self.cache.delete_archive(self.args.vault, self.args.name)
 
+    def _too_old(self, last_seen):
+        return (not last_seen or
+                not self.args.max_age_hours or
+                (last_seen <
+                    time.time() - self.args.max_age_hours * 60 * 60))
+
     def archive_checkpresent(self):
+        if self.args.batch:
+            if self.args.name is not None:
+                raise ConsoleError('cannot specify an archive name with --batch')
+            return self.archive_checkpresent_batch()
+        if self.args.name is None:
+            raise ConsoleError('archive name not specified')
+
         try:
             last_seen = self.cache.get_archive_last_seen(
                 self.args.vault, self.args.name)
@@ -455,13 +1145,7 @@ class App(object):
                         file=sys.stderr)
                 return
 
-        def too_old(last_seen):
-            return (not last_seen or
-                    not self.args.max_age_hours or
-                    (last_seen <
-                        time.time() - self.args.max_age_hours * 60 * 60))
-
-        if too_old(last_seen):
+        if self._too_old(last_seen):
             # Not recent enough
             try:
                 self._vault_sync(vault_name=self.args.vault,
@@ -481,7 +1165,7 @@ class App(object):
                                            % self.args.name, file=sys.stderr)
                     return
 
-        if too_old(last_seen):
+        if self._too_old(last_seen):
             if not self.args.quiet:
                 print(('archive %r found, but has not been seen ' +
                                    'recently enough to consider it present') %
@@ -490,6 +1174,38 @@ class App(object):
 
         print(self.args.name)
 
+    def archive_checkpresent_batch(self):
+        """Check every archive named on standard input, one per line, with at
+        most one vault sync between them, and print 'present <name>' or
+        'absent <name>' for each in turn"""
+        refs = [line.decode('utf-8').rstrip('\r\n') for line in sys.stdin]
+        refs = [ref for ref in refs if ref]
+        last_seen = self.cache.get_archives_last_seen(self.args.vault, refs)
+
+        # As for a single archive, an archive that is not in the cache at all
+        # is only worth a sync when waiting for one
+        def needs_sync(ref):
+            if ref not in last_seen:
+                return self.args.wait
+            return self._too_old(last_seen[ref])
+
+        if any(needs_sync(ref) for ref in refs):
+            try:
+                self._vault_sync(vault_name=self.args.vault,
+                                 max_age_hours=self.args.max_age_hours,
+                                 fix=False,
+                                 wait=self.args.wait)
+            except RetryConsoleError:
+                pass
+            else:
+                last_seen = self.cache.get_archives_last_seen(
+                    self.args.vault, refs)
+
+        for ref in refs:
+            if not self._too_old(last_seen.get(ref)):
+                print('present', ref)
+            elif not self.args.quiet:
+                print('absent', ref)
 
     def parse_args(self, args=None):
         parser = argparse.ArgumentParser()
@@ -510,7 +1226,20 @@ class App(object):
         vault_delete_subparser.add_argument('name')
         vault_sync_subparser = vault_subparser.add_parser('sync')
         vault_sync_subparser.set_defaults(func=self.vault_sync)
-        vault_sync_subparser.add_argument('name', metavar='vault_name')
+        vault_sync_subparser.add_argument('names', nargs='*',
+                                          metavar='vault_name')
+        vault_sync_subparser.add_argument('--all', action='store_true',
+                help='sync every vault')
+        vault_sync_subparser.add_argument('--concurrency', type=int,
+                default=4, help='number of vaults to reconcile at once')
+        vault_sync_subparser.add_argument('--format', default='JSON',
+                choices=['JSON', 'CSV'], type=lambda format: format.upper(),
+                metavar='{json,csv}',
+                help='inventory format to request from Glacier')
+        vault_sync_subparser.add_argument('--from-snapshot',
+                action='store_true',
+                help='reconcile with the newest inventory kept on disk '
+                     'instead of asking Glacier')
         vault_sync_subparser.add_argument('--wait', action='store_true')
         vault_sync_subparser.add_argument('--fix', action='store_true')
         vault_sync_subparser.add_argument('--max-age', type=int, default=24,
@@ -531,6 +1260,10 @@ class App(object):
         archive_upload_subparser.add_argument('--name')
         archive_upload_subparser.add_argument('--multipart-size', type=int,
                 default=(32*1024*1024))
+        archive_upload_subparser.add_argument('--concurrency', type=int,
+                default=1, help='number of parts to upload at once')
+        archive_upload_subparser.add_argument('--resume', action='store_true',
+                help='continue an interrupted multi-part upload of the same file')
         archive_retrieve_subparser = archive_subparser.add_parser('retrieve')
         archive_retrieve_subparser.set_defaults(func=self.archive_retrieve)
         archive_retrieve_subparser.add_argument('vault')
@@ -538,9 +1271,29 @@ class App(object):
                                                 metavar='name')
         archive_retrieve_subparser.add_argument('--multipart-size', type=int,
                 default=(8*1024*1024))
+        archive_retrieve_subparser.add_argument('--concurrency', type=int,
+                default=1, help='number of byte ranges to download at once')
+        archive_retrieve_subparser.add_argument('--archive-concurrency',
+                type=int, default=1,
+                help='number of archives to download at once')
         archive_retrieve_subparser.add_argument('-o', dest='output_filename',
                                                 metavar='OUTPUT_FILENAME')
         archive_retrieve_subparser.add_argument('--wait', action='store_true')
+        archive_retrieve_tier_group = \
+            archive_retrieve_subparser.add_mutually_exclusive_group()
+        archive_retrieve_tier_group.add_argument('--tier',
+                choices=tiers.TIERS, type=lambda tier: tier.capitalize(),
+                metavar='{expedited,standard,bulk}',
+                help='retrieval tier for new jobs; defaults to standard')
+        archive_retrieve_tier_group.add_argument('--deadline',
+                type=parse_duration, metavar='DURATION',
+                help='pick the cheapest tier expected to retrieve each '
+                     'archive within DURATION (eg. 30m, 6h, 2d)')
+        archive_retrieve_subparser.add_argument('--deadline-for',
+                type=_name_and_duration, action='append',
+                metavar='NAME=DURATION',
+                help='as --deadline, but only for archive NAME; may be '
+                     'repeated')
         archive_delete_subparser = archive_subparser.add_parser('delete')
         archive_delete_subparser.set_defaults(func=self.archive_delete)
         archive_delete_subparser.add_argument('vault')
@@ -550,15 +1303,25 @@ class App(object):
         archive_checkpresent_subparser.set_defaults(
                 func=self.archive_checkpresent)
         archive_checkpresent_subparser.add_argument('vault')
-        archive_checkpresent_subparser.add_argument('name')
+        archive_checkpresent_subparser.add_argument('name', nargs='?')
+        archive_checkpresent_subparser.add_argument('--batch',
+                action='store_true',
+                help='read archive names from standard input, one per line')
         archive_checkpresent_subparser.add_argument('--wait',
                                                     action='store_true')
         archive_checkpresent_subparser.add_argument('--quiet',
                                                     action='store_true')
         archive_checkpresent_subparser.add_argument(
                 '--max-age', type=int, default=80, dest='max_age_hours')
+        subparsers.add_parser('annex-remote').set_defaults(
+                func=self.annex_remote)
         job_subparser = subparsers.add_parser('job').add_subparsers()
-        job_subparser.add_parser('list').set_defaults(func=self.job_list)
+        job_list_subparser = job_subparser.add_parser('list')
+        job_list_subparser.set_defaults(func=self.job_list)
+        job_list_subparser.add_argument('--refresh', action='store_true',
+                help='list every vault\'s jobs from Glacier first')
+        job_list_subparser.add_argument('--concurrency', type=int,
+                default=8, help='number of vaults to list at once')
         return parser.parse_args(args)
 
     def __init__(self, args=None, resource=None, cache=None):
@@ -581,16 +1344,33 @@ class App(object):
                 mute_logger = logging.getLogger(logger_name)
                 mute_logger.setLevel(logging.ERROR)
 
-        if resource is None:
-            resource = boto3.resource('glacier', region_name=args.region)
-
-        if cache is None:
-            cache = Cache(get_cache_key(), configuration['database']['driver'])
-
-        self.resource = resource
-        self.cache = cache
+        # Both are created on first use, so that a command only pays for
+        # what it touches
+        self._resource = resource
+        self._cache = cache
+        self._job_indexes = {}
+        # Serialises writes to the cache from threads with caches of their
+        # own, as SQLite allows only one writer at a time
+        self._cache_write_lock = threading.Lock()
         self.args = args
 
+    @property
+    def resource(self):
+        if self._resource is None:
+            import boto3
+            self._resource = boto3.resource('glacier',
+                                            region_name=self.args.region)
+        return self._resource
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            from models import Cache
+            self._cache = Cache(
+                get_cache_key(), configuration['database']['driver'],
+                busy_timeout=float(configuration['database']['busy_timeout']))
+        return self._cache
+
     def main(self):
         try:
             self.args.func()
@@ -607,7 +1387,12 @@ class App(object):
         except RuntimeError as e:
             logger.error(str(e))
             sys.exit(1)
-        except sqlalchemy.exc.OperationalError as e:
+        except Exception as e:
+            # If SQLAlchemy was never imported, this cannot be its error
+            sqlalchemy_exc = sys.modules.get('sqlalchemy.exc')
+            if (sqlalchemy_exc is None or
+                    not isinstance(e, sqlalchemy_exc.OperationalError)):
+                raise
             logger.error(str(e))
             logger.error("Your database may be out of date. Run '{} config upgrade_database' to update.".format(sys.argv[0]))
 
@@ -616,5 +1401,10 @@ def main():
     App().main()
 
 
+def annex_remote_main():
+    """Entry point for git-annex, which runs git-annex-remote-<externaltype>"""
+    App(['annex-remote']).main()
+
+
 if __name__ == '__main__':
     main()
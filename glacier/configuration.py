@@ -35,6 +35,17 @@ class Configuration(object):
 
     DEFAULT_CONFIG = """[database]
 driver=sqlite:///%(user_cache_dir)s/glacier-cli/db.sqlite
+busy_timeout=60
+
+[notifications]
+sns_topic=
+sqs_queue_url=
+sqs_endpoint_url=
+
+[inventory_snapshots]
+directory=%(user_cache_dir)s/glacier-cli/inventories
+max_count=2
+max_age_days=30
 """
     config = None
 
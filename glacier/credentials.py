@@ -0,0 +1,64 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import os.path
+from ConfigParser import RawConfigParser, Error as ConfigParserError
+
+
+def _read_ini(path):
+    parser = RawConfigParser()
+    try:
+        parser.read([os.path.expanduser(path)])
+    except ConfigParserError:
+        return None
+    return parser
+
+
+def _get_option(parser, section, option):
+    if parser is None or not parser.has_section(section):
+        return None
+    if not parser.has_option(section, option):
+        return None
+    return parser.get(section, option) or None
+
+
+def find_access_key(environ=None):
+    """Return the AWS access key id that boto3's default session would use,
+    without importing boto3, or None if it cannot be determined cheaply.
+
+    This follows the start of botocore's credential provider chain:
+    environment variables, then the profile's entry in the shared credentials
+    file, then in the config file. Where the chain would go on to anything
+    that needs boto3 to resolve (an assumed role, instance metadata and so
+    on), None is returned and the caller should ask boto3 instead."""
+    if environ is None:
+        environ = os.environ
+
+    access_key = environ.get('AWS_ACCESS_KEY_ID')
+    if access_key:
+        return access_key
+
+    profile = (environ.get('AWS_DEFAULT_PROFILE') or
+               environ.get('AWS_PROFILE') or 'default')
+    config = _read_ini(environ.get('AWS_CONFIG_FILE', '~/.aws/config'))
+    if profile == 'default':
+        config_sections = ['default', 'profile default']
+    else:
+        config_sections = ['profile ' + profile]
+
+    if any(_get_option(config, section, 'role_arn')
+           for section in config_sections):
+        return None
+
+    credentials = _read_ini(environ.get('AWS_SHARED_CREDENTIALS_FILE',
+                                        '~/.aws/credentials'))
+    access_key = _get_option(credentials, profile, 'aws_access_key_id')
+    if access_key:
+        return access_key
+
+    for section in config_sections:
+        access_key = _get_option(config, section, 'aws_access_key_id')
+        if access_key:
+            return access_key
+    return None
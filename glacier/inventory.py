@@ -0,0 +1,266 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import codecs
+import csv
+import hashlib
+import itertools
+import json
+import re
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class _BodyReader(object):
+    """The reading of a file-like inventory body shared by the readers of
+    each format, which keeps a SHA-256 digest of the body as it goes"""
+
+    def __init__(self, body, chunk_size):
+        self.body = body
+        self.chunk_size = chunk_size
+        self._digest = hashlib.sha256()
+        self._read_ahead = False
+
+    def _read(self):
+        data = self.body.read(self.chunk_size)
+        if not self._read_ahead:
+            self._digest.update(data)
+        return data
+
+    def read_ahead(self, spool):
+        """Copy the rest of the body to the file spool and carry on reading
+        from there, so that hexdigest() covers the whole body before any
+        more of it is parsed"""
+        while True:
+            data = self._read()
+            if not data:
+                break
+            spool.write(data)
+        spool.seek(0)
+        self.body = spool
+        self._read_ahead = True
+
+    def hexdigest(self):
+        """Return the SHA-256 digest of the body as read so far"""
+        return self._digest.hexdigest()
+
+
+class InventoryReader(_BodyReader):
+    """Incrementally parse a Glacier vault inventory in JSON format.
+
+    The inventory is read from a file-like body a chunk at a time, so that
+    memory use does not depend on the number of archives in the vault. The
+    top level fields that come before the ArchiveList (VaultARN and
+    InventoryDate in practice) are returned by read_header(); archives()
+    then yields each ArchiveList entry as a dict. Once the archives have all
+    been read, hexdigest() returns the SHA-256 digest of the whole body."""
+
+    def __init__(self, body, chunk_size=64 * 1024):
+        super(InventoryReader, self).__init__(body, chunk_size)
+        self.header = {}
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self._header_read = False
+        self._in_archive_list = False
+
+    def _fill(self):
+        if self._eof:
+            return False
+        data = self._read()
+        self._eof = not data
+        self._buf = (self._buf[self._pos:] +
+                     self._text_decoder.decode(data, final=self._eof))
+        self._pos = 0
+        return True
+
+    def _peek(self):
+        """Return the next non-whitespace character without consuming it, or
+        '' at the end of the body"""
+        while True:
+            self._pos = _WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ''
+
+    def _next(self, expected):
+        char = self._peek()
+        if char not in expected:
+            raise ValueError('Malformed inventory: expected one of {!r} but found {!r}'.format(expected, char))
+        self._pos += 1
+        return char
+
+    def _decode_value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                # The value may just be incomplete in the buffer
+                if not self._fill():
+                    raise
+                continue
+            if end == len(self._buf) and self._fill():
+                # A number at the end of the buffer may be truncated
+                continue
+            self._pos = end
+            return value
+
+    def _read_fields(self):
+        """Read top level fields into self.header until either the ArchiveList
+        starts or the inventory ends"""
+        while True:
+            key = self._decode_value()
+            self._next(':')
+            if key == 'ArchiveList':
+                self._next('[')
+                self._in_archive_list = True
+                return
+            self.header[key] = self._decode_value()
+            if self._next(',}') == '}':
+                return
+
+    def read_header(self):
+        """Return the top level fields that precede the ArchiveList"""
+        if not self._header_read:
+            self._header_read = True
+            self._next('{')
+            if self._peek() == '}':
+                self._pos += 1
+            else:
+                self._read_fields()
+        return self.header
+
+    def archives(self):
+        """Yield each entry of the ArchiveList in turn"""
+        self.read_header()
+        if not self._in_archive_list:
+            return
+        if self._peek() == ']':
+            self._pos += 1
+        else:
+            while True:
+                yield self._decode_value()
+                if self._next(',]') == ']':
+                    break
+        self._in_archive_list = False
+        if self._next(',}') == ',':
+            self._read_fields()
+
+
+# Columns of a Glacier inventory in CSV format, in the order Glacier writes
+# them
+CSV_COLUMNS = ['ArchiveId', 'ArchiveDescription', 'CreationDate', 'Size',
+               'SHA256TreeHash']
+
+
+# A quoted field of a CSV inventory line, in which a backslash escapes a
+# double quote or another backslash
+_CSV_QUOTED_FIELD = re.compile(br'(?:^|(?<=,))"((?:[^"\\]|\\.|"")*)"(?=,|\r?$)')
+_CSV_ESCAPE = re.compile(br'\\([\\"])')
+
+
+def _unescape_quoted_field(match):
+    return b'"' + _CSV_ESCAPE.sub(
+        lambda m: b'""' if m.group(1) == b'"' else m.group(1),
+        match.group(1)) + b'"'
+
+
+def _unescape_csv_line(line):
+    """Return line with the backslash escapes in its quoted fields replaced
+    by what the csv module expects: doubled quotes and bare backslashes"""
+    if b'\\' not in line:
+        return line
+    return _CSV_QUOTED_FIELD.sub(_unescape_quoted_field, line)
+
+
+class InventoryCSVReader(_BodyReader):
+    """Incrementally parse a Glacier vault inventory in CSV format.
+
+    This has the interface of InventoryReader. A CSV inventory has no top
+    level fields, so read_header() only consumes the row of column names
+    and returns an empty dict; in particular there is no InventoryDate.
+    Rows are parsed by the csv module as they are read, and yielded as
+    dicts with the same keys as the JSON ArchiveList entries.
+    Quoted archive descriptions may contain commas, and double quotes
+    escaped either by doubling them or with a backslash; a backslash that
+    ends one is escaped too. Any other backslash is part of the
+    description, as in a Windows path."""
+
+    def __init__(self, body, chunk_size=64 * 1024):
+        super(InventoryCSVReader, self).__init__(body, chunk_size)
+        self.header = {}
+        # Glacier only allows printable ASCII in archive descriptions, so no
+        # field spans lines and the body can be split on newlines up front
+        self._rows = csv.reader(
+            itertools.chain.from_iterable(self._chunk_lines()),
+            doublequote=True, strict=True)
+        self._columns = None
+
+    def _chunk_lines(self):
+        """Yield the complete lines of each chunk of the body, with backslash
+        escapes undone for the csv module, which would otherwise take every
+        backslash as an escape"""
+        pending = b''
+        while True:
+            data = self._read()
+            if not data:
+                break
+            lines, sep, pending = (pending + data).rpartition(b'\n')
+            if sep:
+                if b'\\' in lines:
+                    yield [_unescape_csv_line(line)
+                           for line in lines.split(b'\n')]
+                else:
+                    yield lines.split(b'\n')
+        if pending:
+            yield [_unescape_csv_line(pending)]
+
+    def _malformed(self, e):
+        return ValueError('Malformed inventory: line {}: {}'.format(
+            self._rows.line_num, e))
+
+    def read_header(self):
+        if self._columns is None:
+            try:
+                names = next(self._rows, None)
+            except csv.Error as e:
+                raise self._malformed(e)
+            if names is None:
+                self._columns = []
+            else:
+                missing = set(CSV_COLUMNS) - set(names)
+                if missing:
+                    raise ValueError('Malformed inventory: no {} column'.format(
+                        ', '.join(sorted(missing))))
+                self._columns = names
+        return self.header
+
+    def archives(self):
+        """Yield each row of the inventory in turn"""
+        self.read_header()
+        columns = self._columns
+        try:
+            for row in self._rows:
+                if not row:
+                    continue
+                archive = dict(zip(columns, row))
+                archive['ArchiveId'] = archive['ArchiveId'].decode('utf-8')
+                archive['ArchiveDescription'] = \
+                    archive['ArchiveDescription'].decode('utf-8')
+                archive['Size'] = int(archive['Size'])
+                yield archive
+        except csv.Error as e:
+            raise self._malformed(e)
+
+
+def open_inventory(body, content_type=None):
+    """Return a reader for an inventory body, chosen by the content type of
+    the job output that it came from"""
+    if content_type and content_type.split(';')[0].strip() == 'text/csv':
+        return InventoryCSVReader(body)
+    return InventoryReader(body)
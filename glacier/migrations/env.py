@@ -24,6 +24,14 @@ target_metadata = glacier.models.Base.metadata
 from glacier.configuration import configuration
 
 
+def include_object(object, name, type_, reflected, compare_to):
+    """Leave indexes that the model only has on some backends out of
+    autogenerate elsewhere"""
+    if type_ == 'index' and 'dialects' in object.info:
+        return context.get_bind().dialect.name in object.info['dialects']
+    return True
+
+
 def run_migrations_offline():
     """Run migrations in 'offline' mode.
 
@@ -58,7 +66,8 @@ def run_migrations_online():
     with connectable.connect() as connection:
         context.configure(
             connection=connection,
-            target_metadata=target_metadata
+            target_metadata=target_metadata,
+            include_object=include_object
         )
 
         with context.begin_transaction():
@@ -0,0 +1,32 @@
+"""Add retrieval_range table for resumable downloads
+
+Revision ID: 3c8e5a1f0b27
+Revises: d7df2bddf955
+Create Date: 2026-10-16 09:12:40.318224
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c8e5a1f0b27'
+down_revision = 'd7df2bddf955'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('retrieval_range',
+    sa.Column('job_id', sa.String(length=255), nullable=False),
+    sa.Column('path', sa.String(length=4096), nullable=False),
+    sa.Column('start_byte', sa.Integer(), nullable=False),
+    sa.Column('end_byte', sa.Integer(), nullable=False),
+    sa.Column('part_size', sa.Integer(), nullable=False),
+    sa.Column('tree_hash', sa.String(length=64), nullable=False),
+    sa.PrimaryKeyConstraint('job_id', 'path', 'start_byte')
+    )
+
+
+def downgrade():
+    op.drop_table('retrieval_range')
@@ -0,0 +1,32 @@
+"""Add reconciled_inventory table to record the last inventory reconciled
+
+Revision ID: 4a7c19e5d3b0
+Revises: e6a93b7d2f18
+Create Date: 2026-10-16 16:48:09.203517
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4a7c19e5d3b0'
+down_revision = 'e6a93b7d2f18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('reconciled_inventory',
+    sa.Column('key', sa.String(length=255), nullable=False),
+    sa.Column('vault', sa.String(length=255), nullable=False),
+    sa.Column('inventory_date', sa.Integer(), nullable=False),
+    sa.Column('job_id', sa.String(length=255), nullable=False),
+    sa.Column('digest', sa.String(length=64), nullable=True),
+    sa.Column('last_seen_upstream', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('key', 'vault')
+    )
+
+
+def downgrade():
+    op.drop_table('reconciled_inventory')
@@ -0,0 +1,43 @@
+"""Add multipart_upload and multipart_part tables for resumable uploads
+
+Revision ID: 8f41d2c6a9e3
+Revises: 3c8e5a1f0b27
+Create Date: 2026-10-16 10:47:05.902136
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8f41d2c6a9e3'
+down_revision = '3c8e5a1f0b27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('multipart_upload',
+    sa.Column('id', sa.String(length=255), nullable=False),
+    sa.Column('key', sa.String(length=255), nullable=False),
+    sa.Column('vault', sa.String(length=255), nullable=False),
+    sa.Column('name', sa.String(length=255), nullable=True),
+    sa.Column('path', sa.String(length=4096), nullable=False),
+    sa.Column('file_size', sa.Integer(), nullable=False),
+    sa.Column('file_mtime', sa.Integer(), nullable=False),
+    sa.Column('part_size', sa.Integer(), nullable=False),
+    sa.Column('created_here', sa.Integer(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('multipart_part',
+    sa.Column('upload_id', sa.String(length=255), nullable=False),
+    sa.Column('start_byte', sa.Integer(), nullable=False),
+    sa.Column('end_byte', sa.Integer(), nullable=False),
+    sa.Column('tree_hash', sa.String(length=64), nullable=False),
+    sa.PrimaryKeyConstraint('upload_id', 'start_byte')
+    )
+
+
+def downgrade():
+    op.drop_table('multipart_part')
+    op.drop_table('multipart_upload')
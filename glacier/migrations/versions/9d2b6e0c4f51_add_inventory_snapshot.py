@@ -0,0 +1,39 @@
+"""Add inventory_snapshot table to index inventories kept on disk
+
+Revision ID: 9d2b6e0c4f51
+Revises: 4a7c19e5d3b0
+Create Date: 2026-10-16 18:21:44.610385
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d2b6e0c4f51'
+down_revision = '4a7c19e5d3b0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('inventory_snapshot',
+    sa.Column('job_id', sa.String(length=255), nullable=False),
+    sa.Column('key', sa.String(length=255), nullable=False),
+    sa.Column('vault', sa.String(length=255), nullable=False),
+    sa.Column('inventory_date', sa.Integer(), nullable=False),
+    sa.Column('job_creation_date', sa.Integer(), nullable=False),
+    sa.Column('content_type', sa.String(length=255), nullable=True),
+    sa.Column('path', sa.String(length=4096), nullable=False),
+    sa.Column('size', sa.Integer(), nullable=False),
+    sa.Column('created_here', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('job_id')
+    )
+    op.create_index('ix_inventory_snapshot_key_vault', 'inventory_snapshot',
+                    ['key', 'vault'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_inventory_snapshot_key_vault',
+                  table_name='inventory_snapshot')
+    op.drop_table('inventory_snapshot')
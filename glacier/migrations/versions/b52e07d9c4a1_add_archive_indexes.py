@@ -0,0 +1,40 @@
+"""Add secondary indexes to the archive table
+
+Revision ID: b52e07d9c4a1
+Revises: 8f41d2c6a9e3
+Create Date: 2026-10-16 13:20:51.774310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b52e07d9c4a1'
+down_revision = '8f41d2c6a9e3'
+branch_labels = None
+depends_on = None
+
+# Backends that support partial indexes
+PARTIAL_INDEX_DIALECTS = ('sqlite', 'postgresql')
+
+
+def upgrade():
+    op.create_index('ix_archive_key_vault_name', 'archive',
+                    ['key', 'vault', 'name'])
+    op.create_index('ix_archive_key_vault_id', 'archive',
+                    ['key', 'vault', 'id'])
+    # Partial index of live archives. Elsewhere it would only duplicate
+    # ix_archive_key_vault_name, so it is left out.
+    if op.get_bind().dialect.name in PARTIAL_INDEX_DIALECTS:
+        op.create_index('ix_archive_live_key_vault_name', 'archive',
+                        ['key', 'vault', 'name'],
+                        sqlite_where=sa.text('deleted_here IS NULL'),
+                        postgresql_where=sa.text('deleted_here IS NULL'))
+
+
+def downgrade():
+    if op.get_bind().dialect.name in PARTIAL_INDEX_DIALECTS:
+        op.drop_index('ix_archive_live_key_vault_name', table_name='archive')
+    op.drop_index('ix_archive_key_vault_id', table_name='archive')
+    op.drop_index('ix_archive_key_vault_name', table_name='archive')
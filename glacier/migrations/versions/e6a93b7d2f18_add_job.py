@@ -0,0 +1,45 @@
+"""Add job and job_listing tables to record Glacier jobs locally
+
+Revision ID: e6a93b7d2f18
+Revises: b52e07d9c4a1
+Create Date: 2026-10-16 14:02:31.417952
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e6a93b7d2f18'
+down_revision = 'b52e07d9c4a1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('job',
+    sa.Column('id', sa.String(length=255), nullable=False),
+    sa.Column('key', sa.String(length=255), nullable=False),
+    sa.Column('vault', sa.String(length=255), nullable=False),
+    sa.Column('action', sa.String(length=32), nullable=False),
+    sa.Column('archive_id', sa.String(length=255), nullable=True),
+    sa.Column('status_code', sa.String(length=32), nullable=False),
+    sa.Column('creation_date', sa.String(length=32), nullable=False),
+    sa.Column('completion_date', sa.String(length=32), nullable=True),
+    sa.Column('output_expires', sa.Integer(), nullable=True),
+    sa.Column('description', sa.Text(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_job_key_vault', 'job', ['key', 'vault'], unique=False)
+    op.create_table('job_listing',
+    sa.Column('key', sa.String(length=255), nullable=False),
+    sa.Column('vault', sa.String(length=255), nullable=False),
+    sa.Column('listed', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('key', 'vault')
+    )
+
+
+def downgrade():
+    op.drop_table('job_listing')
+    op.drop_index('ix_job_key_vault', table_name='job')
+    op.drop_table('job')
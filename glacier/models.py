@@ -1,20 +1,24 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import calendar
+import copy
+import contextlib
+import json
 import os
 import os.path
 import time
+import functools
 import itertools
 import logging
-import pkg_resources
+import operator
 
 import sqlalchemy
+import sqlalchemy.event
 import sqlalchemy.ext.declarative
 import sqlalchemy.orm
-import alembic
-import alembic.config
 
-from utils import mkdir_p
+from utils import mkdir_p, chunked
 
 
 # There is a lag between an archive being created and the archive
@@ -25,8 +29,58 @@ from utils import mkdir_p
 # uploaded successfully.
 INVENTORY_LAG = 24 * 60 * 60 * 3
 
+# Maximum number of values bound in a single IN (...) clause, comfortably
+# below SQLite's default limit of 999 bound parameters per statement
+IN_CLAUSE_LIMIT = 500
+
+# Backends that support partial indexes
+PARTIAL_INDEX_DIALECTS = ('sqlite', 'postgresql')
+
+# Number of rows inserted per executemany when staging ids in a temporary table
+STAGING_BATCH_SIZE = 10000
+
+# Number of rows fetched at a time when streaming an archive listing
+ARCHIVE_LIST_FETCH_SIZE = 1000
+
+# Seconds for which Glacier keeps a job, and so its output, after the job
+# completes
+JOB_OUTPUT_LIFETIME = 24 * 60 * 60
+
+# Seconds to wait for another process to release a lock on an SQLite cache
+# before giving up. SQLite's busy handler retries with increasing sleeps until
+# this expires.
+DEFAULT_BUSY_TIMEOUT = 60
+
 logger = logging.getLogger(__name__)
 
+
+def _configure_sqlite_connection(dbapi_connection, connection_record):
+    """Set up an SQLite connection for concurrent use by several glacier
+    processes, such as those started by 'git annex copy -J'. WAL lets readers
+    carry on alongside a writer, and synchronous=NORMAL is crash safe in WAL
+    mode without an fsync on every commit."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
+def _short_transaction(fn):
+    """End the session's transaction as soon as fn returns, so that no
+    connection, and so no database lock, is held while the caller goes on to
+    talk to Glacier"""
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        try:
+            result = fn(self, *args, **kwargs)
+        except:
+            self.session.rollback()
+            raise
+        self.session.commit()
+        return result
+    return wrapper
+
+
 Base = sqlalchemy.ext.declarative.declarative_base()
 
 class Cache(object):
@@ -41,6 +95,20 @@ class Cache(object):
         created_here = sqlalchemy.Column(sqlalchemy.Integer)
         deleted_here = sqlalchemy.Column(sqlalchemy.Integer)
 
+        # Every lookup is scoped to an account key and vault. Lookups by
+        # name and listings only consider live archives, so where the
+        # backend supports partial indexes they get one of their own; its
+        # info lists those backends, and migrations leave it out elsewhere.
+        __table_args__ = (
+            sqlalchemy.Index('ix_archive_key_vault_name', 'key', 'vault', 'name'),
+            sqlalchemy.Index('ix_archive_key_vault_id', 'key', 'vault', 'id'),
+            sqlalchemy.Index('ix_archive_live_key_vault_name',
+                             'key', 'vault', 'name',
+                             sqlite_where=sqlalchemy.text('deleted_here IS NULL'),
+                             postgresql_where=sqlalchemy.text('deleted_here IS NULL'),
+                             info={'dialects': PARTIAL_INDEX_DIALECTS}),
+        )
+
         def __init__(self, *args, **kwargs):
             self.created_here = time.time()
             super(Cache.Archive, self).__init__(*args, **kwargs)
@@ -54,9 +122,113 @@ class Cache(object):
                 return self.created_here
             return last_seen_upstream
 
+    class RetrievalRange(Base):
+        """A byte range of a retrieval job's output already written to a
+        local file, so that an interrupted download can be resumed"""
+        __tablename__ = 'retrieval_range'
+        job_id = sqlalchemy.Column(sqlalchemy.String(255), primary_key=True)
+        path = sqlalchemy.Column(sqlalchemy.String(4096), primary_key=True)
+        start_byte = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+        end_byte = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+        part_size = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+        tree_hash = sqlalchemy.Column(sqlalchemy.String(64), nullable=False)
+
+    class MultipartUpload(Base):
+        """A multipart upload in progress, with enough of the identity of the
+        file being uploaded to recognise it again when resuming"""
+        __tablename__ = 'multipart_upload'
+        id = sqlalchemy.Column(sqlalchemy.String(255), primary_key=True)
+        key = sqlalchemy.Column(sqlalchemy.String(255), nullable=False)
+        vault = sqlalchemy.Column(sqlalchemy.String(255), nullable=False)
+        name = sqlalchemy.Column(sqlalchemy.String(255))
+        path = sqlalchemy.Column(sqlalchemy.String(4096), nullable=False)
+        file_size = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+        file_mtime = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+        part_size = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+        created_here = sqlalchemy.Column(sqlalchemy.Integer)
+
+        def __init__(self, *args, **kwargs):
+            self.created_here = time.time()
+            super(Cache.MultipartUpload, self).__init__(*args, **kwargs)
+
+    class MultipartPart(Base):
+        """A part of a multipart upload that Glacier has accepted"""
+        __tablename__ = 'multipart_part'
+        upload_id = sqlalchemy.Column(sqlalchemy.String(255), primary_key=True)
+        start_byte = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+        end_byte = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+        tree_hash = sqlalchemy.Column(sqlalchemy.String(64), nullable=False)
+
+    class Job(Base):
+        """A Glacier job, as last described by Glacier, so that jobs need not
+        be listed again on every run. The attributes used to pick and show
+        jobs match those of a boto3 Job; description holds the whole
+        description as JSON."""
+        __tablename__ = 'job'
+        id = sqlalchemy.Column(sqlalchemy.String(255), primary_key=True)
+        key = sqlalchemy.Column(sqlalchemy.String(255), nullable=False)
+        vault = sqlalchemy.Column(sqlalchemy.String(255), nullable=False)
+        action = sqlalchemy.Column(sqlalchemy.String(32), nullable=False)
+        archive_id = sqlalchemy.Column(sqlalchemy.String(255))
+        status_code = sqlalchemy.Column(sqlalchemy.String(32), nullable=False)
+        creation_date = sqlalchemy.Column(sqlalchemy.String(32), nullable=False)
+        completion_date = sqlalchemy.Column(sqlalchemy.String(32))
+        output_expires = sqlalchemy.Column(sqlalchemy.Integer)
+        description = sqlalchemy.Column(sqlalchemy.Text, nullable=False)
+
+        __table_args__ = (
+            sqlalchemy.Index('ix_job_key_vault', 'key', 'vault'),
+        )
+
+        @property
+        def completed(self):
+            return self.status_code != 'InProgress'
+
+    class JobListing(Base):
+        """When all of a vault's jobs were last listed from Glacier"""
+        __tablename__ = 'job_listing'
+        key = sqlalchemy.Column(sqlalchemy.String(255), primary_key=True)
+        vault = sqlalchemy.Column(sqlalchemy.String(255), primary_key=True)
+        listed = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+
+    class ReconciledInventory(Base):
+        """The inventory of a vault that the cache was last reconciled with.
+        Glacier only generates a new inventory when a vault has changed, so
+        one with the same InventoryDate, or for an undated inventory the same
+        digest of its body, needs no reconciling archive by archive.
+        last_seen_upstream is what its archives were marked with."""
+        __tablename__ = 'reconciled_inventory'
+        key = sqlalchemy.Column(sqlalchemy.String(255), primary_key=True)
+        vault = sqlalchemy.Column(sqlalchemy.String(255), primary_key=True)
+        inventory_date = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+        job_id = sqlalchemy.Column(sqlalchemy.String(255), nullable=False)
+        digest = sqlalchemy.Column(sqlalchemy.String(64))
+        last_seen_upstream = sqlalchemy.Column(sqlalchemy.Integer,
+                                               nullable=False)
+
+    class InventorySnapshot(Base):
+        """A compressed copy of a retrieved inventory kept on disk, at path
+        relative to the snapshot directory. inventory_date and
+        job_creation_date are as used to reconcile it."""
+        __tablename__ = 'inventory_snapshot'
+        job_id = sqlalchemy.Column(sqlalchemy.String(255), primary_key=True)
+        key = sqlalchemy.Column(sqlalchemy.String(255), nullable=False)
+        vault = sqlalchemy.Column(sqlalchemy.String(255), nullable=False)
+        inventory_date = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+        job_creation_date = sqlalchemy.Column(sqlalchemy.Integer,
+                                              nullable=False)
+        content_type = sqlalchemy.Column(sqlalchemy.String(255))
+        path = sqlalchemy.Column(sqlalchemy.String(4096), nullable=False)
+        size = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+        created_here = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+
+        __table_args__ = (
+            sqlalchemy.Index('ix_inventory_snapshot_key_vault', 'key', 'vault'),
+        )
+
     Session = sqlalchemy.orm.sessionmaker()
 
-    def __init__(self, key, db_driver):
+    def __init__(self, key, db_driver, busy_timeout=DEFAULT_BUSY_TIMEOUT):
         self.key = key
         if 'sqlite://' in db_driver:
             db_path = db_driver[len('sqlite:///'):]
@@ -64,7 +236,11 @@ class Cache(object):
             initial_upgrade = False
             if not os.path.exists(db_path):
                 initial_upgrade = True
-            self.engine = sqlalchemy.create_engine('sqlite:///%s' % db_path)
+            self.engine = sqlalchemy.create_engine(
+                'sqlite:///%s' % db_path,
+                connect_args={'timeout': busy_timeout})
+            sqlalchemy.event.listen(self.engine, 'connect',
+                                    _configure_sqlite_connection)
             if initial_upgrade:
                 self.upgrade_schema()
         else:
@@ -72,7 +248,21 @@ class Cache(object):
         self.Session.configure(bind=self.engine)
         self.session = self.Session()
 
+    def clone(self):
+        """Return a Cache for the same database and key with a session of its
+        own, for use from another thread"""
+        cache = copy.copy(self)
+        cache.session = self.Session(bind=self.engine)
+        return cache
+
+    def close(self):
+        self.session.close()
+
     def upgrade_schema(self):
+        # alembic and pkg_resources are slow to import and only needed here
+        import pkg_resources
+        import alembic.command
+        import alembic.config
         alembic_ini = pkg_resources.resource_filename(__name__, 'alembic.ini')
         cfg = alembic.config.Config(alembic_ini)
         alembic.command.upgrade(cfg, 'head')
@@ -93,6 +283,7 @@ class Cache(object):
         return self.session.query(self.Archive).filter_by(
                 key=self.key, vault=vault, deleted_here=None, **filter)
 
+    @_short_transaction
     def get_archive_id(self, vault, ref):
         try:
             result = self._get_archive_query_by_ref(vault, ref).one()
@@ -100,6 +291,7 @@ class Cache(object):
             raise KeyError(ref)
         return result.id
 
+    @_short_transaction
     def get_archive_name(self, vault, ref):
         try:
             result = self._get_archive_query_by_ref(vault, ref).one()
@@ -107,6 +299,28 @@ class Cache(object):
             raise KeyError(ref)
         return result.name
 
+    @_short_transaction
+    def get_archive_names(self, vault, ids):
+        """Return a dict mapping those of ids that name an archive in vault to
+        its name, with one query per IN_CLAUSE_LIMIT ids"""
+        names = {}
+        for chunk in chunked(sorted(set(ids)), IN_CLAUSE_LIMIT):
+            names.update(
+                self.session.query(self.Archive.id, self.Archive.name)
+                            .filter_by(key=self.key, vault=vault,
+                                       deleted_here=None)
+                            .filter(self.Archive.id.in_(chunk)))
+        return names
+
+    @_short_transaction
+    def get_archive_size(self, vault, ref):
+        try:
+            result = self._get_archive_query_by_ref(vault, ref).one()
+        except sqlalchemy.orm.exc.NoResultFound:
+            raise KeyError(ref)
+        return result.size
+
+    @_short_transaction
     def get_archive_last_seen(self, vault, ref):
         try:
             result = self._get_archive_query_by_ref(vault, ref).one()
@@ -123,15 +337,18 @@ class Cache(object):
         self.session.commit()
 
     @staticmethod
-    def _archive_ref(archive, force_id=False):
-        if archive.name and not force_id:
-            if (archive.name.startswith('name:') or
-                    archive.name.startswith('id:')):
-                return "name:%s" % archive.name
+    def _ref(id, name, force_id=False):
+        if name and not force_id:
+            if name.startswith('name:') or name.startswith('id:'):
+                return "name:%s" % name
             else:
-                return archive.name
+                return name
         else:
-            return 'id:' + archive.id
+            return 'id:' + id
+
+    @classmethod
+    def _archive_ref(cls, archive, force_id=False):
+        return cls._ref(archive.id, archive.name, force_id=force_id)
 
     def get_archive_list_objects(self, vault):
         for archive in (
@@ -142,42 +359,81 @@ class Cache(object):
                              order_by(self.Archive.name)):
             yield archive
 
+    def _stream_archive_list(self, vault, columns):
+        """Yield rows of the given columns of vault's live archives, in name
+        order.
+
+        The rows come straight from a Core select, without building ORM
+        objects, and are fetched ARCHIVE_LIST_FETCH_SIZE at a time, through
+        a server side cursor where the database has them. So a listing of
+        any size starts at once and takes little memory. The transaction
+        ends once the listing does."""
+        table = self.Archive.__table__
+        try:
+            result = self.session.connection().execute(
+                sqlalchemy.select(columns)
+                          .where(table.c.key == self.key)
+                          .where(table.c.vault == vault)
+                          .where(table.c.deleted_here == None)
+                          .order_by(table.c.name)
+                          .execution_options(stream_results=True))
+            while True:
+                rows = result.fetchmany(ARCHIVE_LIST_FETCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            self.session.commit()
+
     def get_archive_list(self, vault):
-        def force_id(archive):
-            return "\t".join([
-                self._archive_ref(archive, force_id=True),
-                "%s" % archive.name
-                ])
+        def force_id(id, name):
+            return "\t".join([self._ref(id, name, force_id=True),
+                              "%s" % name])
 
+        table = self.Archive.__table__
         for archive_name, archive_iterator in (
                 itertools.groupby(
-                    self.get_archive_list_objects(vault),
-                    lambda archive: archive.name)):
-            # Yield self._archive_ref(..., force_id=True) if there is more than
-            # one archive with the same name; otherwise use force_id=False.
-            first_archive = next(archive_iterator)
+                    self._stream_archive_list(vault,
+                                              [table.c.id, table.c.name]),
+                    operator.itemgetter(1))):
+            # Yield self._ref(..., force_id=True) if there is more than one
+            # archive with the same name; otherwise use force_id=False.
+            first_id, _ = next(archive_iterator)
             try:
-                second_archive = next(archive_iterator)
+                second_id, _ = next(archive_iterator)
             except StopIteration:
-                yield self._archive_ref(first_archive, force_id=False)
+                yield self._ref(first_id, archive_name, force_id=False)
             else:
-                yield force_id(first_archive)
-                yield force_id(second_archive)
-                for subsequent_archive in archive_iterator:
-                    yield force_id(subsequent_archive)
+                yield force_id(first_id, archive_name)
+                yield force_id(second_id, archive_name)
+                for subsequent_id, _ in archive_iterator:
+                    yield force_id(subsequent_id, archive_name)
 
     def get_archive_list_with_ids(self, vault):
-        for archive in self.get_archive_list_objects(vault):
-            yield "\t".join([
-                self._archive_ref(archive, force_id=True),
-                "%s" % archive.name,
-                ])
+        table = self.Archive.__table__
+        for id, name in self._stream_archive_list(vault,
+                                                  [table.c.id, table.c.name]):
+            yield "\t".join([self._ref(id, name, force_id=True),
+                             "%s" % name])
 
-    def mark_seen_upstream(
-            self, vault, id, name, size, upstream_creation_date,
-            upstream_inventory_date, upstream_inventory_job_creation_date,
-            fix=False):
+    def get_archive_listing(self, vault):
+        """Yield (id, size, modified, name) for each of vault's live
+        archives, in name order, as archive ls shows them"""
+        table = self.Archive.__table__
+        for id, size, created_here, last_seen_upstream, name in (
+                self._stream_archive_list(
+                    vault, [table.c.id, table.c.size, table.c.created_here,
+                            table.c.last_seen_upstream, table.c.name])):
+            if created_here is not None:
+                modified = created_here
+            else:
+                modified = last_seen_upstream
+            yield id, size, modified, name
 
+    @staticmethod
+    def _inventory_last_seen(upstream_inventory_date,
+                             upstream_inventory_job_creation_date):
         # Inventories don't get recreated unless the vault has changed.
         # See: https://forums.aws.amazon.com/thread.jspa?threadID=106541
         #
@@ -200,11 +456,53 @@ class Cache(object):
         #
         # With thanks to Wolfgang Nagele.
 
-        last_seen_upstream = max(
+        return max(
             upstream_inventory_date,
             upstream_inventory_job_creation_date - INVENTORY_LAG
             )
 
+    def _reconcile_seen_archive(self, archive, name, size,
+                                upstream_inventory_date, fix=False):
+        """Warn about any differences between a cached archive and its
+        inventory entry, and return the (name, size) the cache should keep"""
+        new_name, new_size = archive.name, archive.size
+        if not archive.name:
+            new_name = name
+        elif archive.name != name:
+            if fix:
+                logger.warn('archive %r appears to have changed name from %r ' %
+                     (archive.id, archive.name) + 'to %r (fixed)' % (name))
+                new_name = name
+            else:
+                logger.warn('archive %r appears to have changed name from %r ' %
+                     (archive.id, archive.name) + 'to %r' % (name))
+        if not archive.size:
+            new_size = size
+        elif archive.size != size:
+            if fix:
+                logger.warn('archive %r appears to have changed size from %r ' %
+                     (archive.id, archive.size) + 'to %r (fixed)' % (size))
+                new_size = size
+            else:
+                logger.warn('archive %r appears to have changed size from %r ' %
+                     (archive.id, archive.size) + 'to %r' % (size))
+        if archive.deleted_here:
+            archive_ref = self._archive_ref(archive)
+            if archive.deleted_here < upstream_inventory_date:
+                logger.warn('archive %r marked deleted but still present' %
+                     archive_ref)
+            else:
+                logger.warn('archive %r deletion not yet in inventory' %
+                     archive_ref)
+        return new_name, new_size
+
+    def mark_seen_upstream(
+            self, vault, id, name, size, upstream_creation_date,
+            upstream_inventory_date, upstream_inventory_job_creation_date,
+            fix=False):
+        last_seen_upstream = self._inventory_last_seen(
+            upstream_inventory_date, upstream_inventory_job_creation_date)
+
         try:
             archive = self.session.query(self.Archive).filter_by(
                 key=self.key, vault=vault, id=id).one()
@@ -216,50 +514,181 @@ class Cache(object):
                     )
                 )
         else:
-            if not archive.name:
-                archive.name = name
-            elif archive.name != name:
-                if fix:
-                    logger.warn('archive %r appears to have changed name from %r ' %
-                         (archive.id, archive.name) + 'to %r (fixed)' % (name))
-                    archive.name = name
-                else:
-                    logger.warn('archive %r appears to have changed name from %r ' %
-                         (archive.id, archive.name) + 'to %r' % (name))
-            if not archive.size:
-                archive.size = size
-            elif archive.size != size:
-                if fix:
-                    logger.warn('archive %r appears to have changed size from %r ' %
-                         (archive.id, archive.size) + 'to %r (fixed)' % (size))
-                    archive.size = size
-                else:
-                    logger.warn('archive %r appears to have changed size from %r ' %
-                         (archive.id, archive.size) + 'to %r' % (size))
-            if archive.deleted_here:
-                archive_ref = self._archive_ref(archive)
-                if archive.deleted_here < upstream_inventory_date:
-                    logger.warn('archive %r marked deleted but still present' %
-                         archive_ref)
-                else:
-                    logger.warn('archive %r deletion not yet in inventory' %
-                         archive_ref)
+            archive.name, archive.size = self._reconcile_seen_archive(
+                archive, name, size, upstream_inventory_date, fix=fix)
             archive.last_seen_upstream = last_seen_upstream
 
-    def mark_only_seen(self, vault, inventory_date, ids, fix=False):
-        upstream_ids = set(ids)
-        our_ids = set([r[0] for r in
-                self.session.query(self.Archive.id)
-                            .filter_by(key=self.key, vault=vault).all()])
-        missing_ids = our_ids - upstream_ids
-        for id in missing_ids:
-            archive = (self.session.query(self.Archive)
-                                   .filter_by(key=self.key,
-                                              vault=vault, id=id)
-                                   .one())
+    def mark_seen_upstream_batch(
+            self, vault, archives, upstream_inventory_date,
+            upstream_inventory_job_creation_date, fix=False):
+        """Reconcile a batch of inventory entries with the cache.
+
+        This is equivalent to calling mark_seen_upstream for each entry, but
+        looks up the existing rows with a single join against the batch's
+        ids, staged in a temporary table, and applies inserts and updates as
+        executemany statements, bypassing the ORM. archives is a sequence of
+        dicts with id, name and size keys. The caller is responsible for
+        committing."""
+        last_seen_upstream = self._inventory_last_seen(
+            upstream_inventory_date, upstream_inventory_job_creation_date)
+        table = self.Archive.__table__
+
+        with self._staging_table(
+                'inventory_batch',
+                [sqlalchemy.Column('id', sqlalchemy.String(255),
+                                   primary_key=True)],
+                ({'id': id}
+                 for id in set(archive['id'] for archive in archives))
+                ) as batch:
+            existing = dict(
+                (row.id, row) for row in self.session.connection().execute(
+                    sqlalchemy.select([table.c.id, table.c.name,
+                                       table.c.size, table.c.deleted_here])
+                              .select_from(table.join(
+                                  batch, table.c.id == batch.c.id))
+                              .where(table.c.key == self.key)
+                              .where(table.c.vault == vault)))
+
+        inserts = []
+        updates = []
+        unchanged_ids = []
+        now = time.time()
+        for archive in archives:
+            row = existing.get(archive['id'])
+            if row is None:
+                inserts.append({
+                    'id': archive['id'], 'key': self.key, 'vault': vault,
+                    'name': archive['name'], 'size': archive['size'],
+                    'last_seen_upstream': last_seen_upstream,
+                    'created_here': now,
+                })
+            elif (row.name == archive['name'] and row.size == archive['size']
+                    and not row.deleted_here):
+                # Nothing to reconcile, so only last_seen_upstream moves
+                unchanged_ids.append(row.id)
+            else:
+                name, size = self._reconcile_seen_archive(
+                    row, archive['name'], archive['size'],
+                    upstream_inventory_date, fix=fix)
+                updates.append({
+                    'b_id': row.id, 'b_name': name, 'b_size': size,
+                })
+
+        if inserts:
+            self.session.execute(table.insert(), inserts)
+        if updates:
+            self.session.execute(
+                table.update()
+                     .where(table.c.key == self.key)
+                     .where(table.c.vault == vault)
+                     .where(table.c.id == sqlalchemy.bindparam('b_id'))
+                     .values(name=sqlalchemy.bindparam('b_name'),
+                             size=sqlalchemy.bindparam('b_size'),
+                             last_seen_upstream=last_seen_upstream),
+                updates)
+        if unchanged_ids:
+            self.session.execute(
+                table.update()
+                     .where(table.c.key == self.key)
+                     .where(table.c.vault == vault)
+                     .where(table.c.id == sqlalchemy.bindparam('b_id'))
+                     .values(last_seen_upstream=last_seen_upstream),
+                [{'b_id': id} for id in unchanged_ids])
+
+    @contextlib.contextmanager
+    def _staging_table(self, name, columns, rows):
+        """Create a temporary table on the session's connection, fill it with
+        rows and yield it, dropping it afterwards. Staging a large set of
+        values this way lets them be joined against in a single query."""
+        table = sqlalchemy.Table(name, sqlalchemy.MetaData(), *columns,
+                                 prefixes=['TEMPORARY'])
+        self.session.flush()
+        connection = self.session.connection()
+        table.create(connection)
+        try:
+            for chunk in chunked(rows, STAGING_BATCH_SIZE):
+                connection.execute(table.insert(), chunk)
+            yield table
+        finally:
+            table.drop(connection)
+
+    def _missing_archives(self, vault, last_seen_upstream):
+        """Return the cached archives of vault that are not marked with
+        last_seen_upstream.
+
+        Reconciling an inventory marks every archive it lists with the same
+        last_seen_upstream, so once all of its entries have been reconciled
+        the rest are the archives missing from it, found with a single query
+        and without holding the inventory's ids."""
+        table = self.Archive.__table__
+        self.session.flush()
+        return self.session.connection().execute(
+            sqlalchemy.select([table])
+                      .where(table.c.key == self.key)
+                      .where(table.c.vault == vault)
+                      .where((table.c.last_seen_upstream == None) |
+                             (table.c.last_seen_upstream !=
+                              last_seen_upstream))
+            ).fetchall()
+
+    @_short_transaction
+    def get_archives_last_seen(self, vault, refs):
+        """Return {ref: last seen time} for those of refs that name a live
+        archive in vault, answering all of them with one query.
+
+        refs take the same forms as for get_archive_last_seen. Where a name
+        is shared by several archives, the most recently seen one counts."""
+        def staged_row(ref):
+            if ref.startswith('id:'):
+                return {'ref': ref, 'id': ref[3:], 'name': None}
+            elif ref.startswith('name:'):
+                return {'ref': ref, 'id': None, 'name': ref[5:]}
+            return {'ref': ref, 'id': None, 'name': ref}
+
+        table = self.Archive.__table__
+        last_seen = sqlalchemy.func.coalesce(table.c.last_seen_upstream,
+                                             table.c.created_here)
+        with self._staging_table(
+                'checked_ref',
+                [sqlalchemy.Column('ref', sqlalchemy.String(255),
+                                   primary_key=True),
+                 sqlalchemy.Column('id', sqlalchemy.String(255)),
+                 sqlalchemy.Column('name', sqlalchemy.String(255))],
+                (staged_row(ref) for ref in set(refs))) as checked:
+            def matches(column):
+                return (sqlalchemy.select([checked.c.ref,
+                                           last_seen.label('last_seen')])
+                                  .select_from(checked.join(
+                                      table, table.c[column] == checked.c[column]))
+                                  .where(table.c.key == self.key)
+                                  .where(table.c.vault == vault)
+                                  .where(table.c.deleted_here == None))
+            found = sqlalchemy.union_all(matches('id'), matches('name')).alias()
+            return dict(self.session.connection().execute(
+                sqlalchemy.select([found.c.ref,
+                                   sqlalchemy.func.max(found.c.last_seen)])
+                          .group_by(found.c.ref)).fetchall())
+
+    def mark_only_seen(self, vault, upstream_inventory_date,
+                       upstream_inventory_job_creation_date, fix=False):
+        """Deal with the cached archives of vault that are missing from an
+        inventory, once all of its entries have been passed to
+        mark_seen_upstream_batch or mark_seen_upstream"""
+        last_seen_upstream = self._inventory_last_seen(
+            upstream_inventory_date, upstream_inventory_job_creation_date)
+        self._mark_missing(
+            vault, upstream_inventory_date,
+            self._missing_archives(vault, last_seen_upstream), fix=fix)
+
+    def _mark_missing(self, vault, inventory_date, missing_archives,
+                      fix=False):
+        """Warn about, and where appropriate remove, cached archives that are
+        missing from an inventory"""
+        deleted_ids = []
+        for archive in missing_archives:
             archive_ref = self._archive_ref(archive)
             if archive.deleted_here and archive.deleted_here < inventory_date:
-                self.session.delete(archive)
+                deleted_ids.append(archive.id)
                 logger.info('deleted archive %r has left inventory; ' % archive_ref +
                      'removed from cache')
             elif not archive.deleted_here and (
@@ -267,7 +696,7 @@ class Cache(object):
                     (archive.created_here and
                      archive.created_here < inventory_date - INVENTORY_LAG)):
                 if fix:
-                    self.session.delete(archive)
+                    deleted_ids.append(archive.id)
                     logger.warn('archive disappeared: %r (removed from cache)' %
                          archive_ref)
                 else:
@@ -275,5 +704,248 @@ class Cache(object):
             else:
                 logger.warn('new archive not yet in inventory: %r' % archive_ref)
 
+        if deleted_ids:
+            table = self.Archive.__table__
+            self.session.execute(
+                table.delete()
+                     .where(table.c.key == self.key)
+                     .where(table.c.vault == vault)
+                     .where(table.c.id == sqlalchemy.bindparam('b_id')),
+                [{'b_id': id} for id in deleted_ids])
+            # Drop any stale copies of the deleted rows from the session
+            self.session.expire_all()
+
+    @_short_transaction
+    def get_reconciled_inventory(self, vault):
+        """Return the ReconciledInventory of vault, or None"""
+        inventory = self.session.query(self.ReconciledInventory).get(
+            (self.key, vault))
+        if inventory is not None:
+            self.session.expunge(inventory)
+        return inventory
+
+    def record_reconciled_inventory(
+            self, vault, inventory_date, upstream_inventory_job_creation_date,
+            job_id, digest):
+        """Record that vault was reconciled with an inventory. The caller is
+        responsible for committing."""
+        self.session.merge(self.ReconciledInventory(
+            key=self.key, vault=vault, inventory_date=inventory_date,
+            job_id=job_id, digest=digest,
+            last_seen_upstream=self._inventory_last_seen(
+                inventory_date, upstream_inventory_job_creation_date)))
+
+    def mark_inventory_unchanged(
+            self, vault, upstream_inventory_job_creation_date, job_id,
+            fix=False):
+        """Reconcile vault with a new retrieval of the inventory it was last
+        reconciled with, without reading it.
+
+        The archives that inventory listed are exactly those marked with its
+        last_seen_upstream, so they are moved on with a single update, after
+        which the rest are missing from it just as for mark_only_seen. The
+        caller is responsible for committing."""
+        previous = self.session.query(self.ReconciledInventory).get(
+            (self.key, vault))
+        last_seen_upstream = self._inventory_last_seen(
+            previous.inventory_date, upstream_inventory_job_creation_date)
+        table = self.Archive.__table__
+        self.session.flush()
+        if last_seen_upstream != previous.last_seen_upstream:
+            self.session.execute(
+                table.update()
+                     .where(table.c.key == self.key)
+                     .where(table.c.vault == vault)
+                     .where(table.c.last_seen_upstream ==
+                            previous.last_seen_upstream)
+                     .values(last_seen_upstream=last_seen_upstream))
+        self._mark_missing(
+            vault, previous.inventory_date,
+            self._missing_archives(vault, last_seen_upstream), fix=fix)
+        previous.job_id = job_id
+        previous.last_seen_upstream = last_seen_upstream
+
     def mark_commit(self):
         self.session.commit()
+
+    def add_inventory_snapshot(self, vault, job_id, inventory_date,
+                               job_creation_date, content_type, path, size):
+        self.session.merge(self.InventorySnapshot(
+            job_id=job_id, key=self.key, vault=vault,
+            inventory_date=inventory_date,
+            job_creation_date=job_creation_date, content_type=content_type,
+            path=path, size=size, created_here=time.time()))
+        self.session.commit()
+
+    @_short_transaction
+    def get_inventory_snapshots(self, vault):
+        """Return the recorded inventory snapshots of vault, newest first"""
+        snapshots = (self.session.query(self.InventorySnapshot)
+                                 .filter_by(key=self.key, vault=vault)
+                                 .order_by(
+                                     self.InventorySnapshot.inventory_date.desc(),
+                                     self.InventorySnapshot.created_here.desc())
+                                 .all())
+        for snapshot in snapshots:
+            self.session.expunge(snapshot)
+        return snapshots
+
+    @_short_transaction
+    def get_inventory_snapshot_vaults(self):
+        """Return the names of the vaults that have inventory snapshots"""
+        return [vault for vault, in
+                self.session.query(self.InventorySnapshot.vault)
+                            .filter_by(key=self.key)
+                            .distinct()
+                            .order_by(self.InventorySnapshot.vault)]
+
+    def delete_inventory_snapshot(self, job_id):
+        (self.session.query(self.InventorySnapshot)
+                     .filter_by(key=self.key, job_id=job_id)
+                     .delete())
+        self.session.commit()
+
+    def add_multipart_upload(self, vault, name, upload_id, path, file_size,
+                             file_mtime, part_size):
+        self.session.add(self.MultipartUpload(
+            id=upload_id, key=self.key, vault=vault, name=name, path=path,
+            file_size=file_size, file_mtime=file_mtime, part_size=part_size))
+        self.session.commit()
+
+    @_short_transaction
+    def find_multipart_upload(self, vault, name, path, file_size, file_mtime,
+                              part_size):
+        """Return the id of the most recent multipart upload of the same
+        file, or None"""
+        upload = (self.session.query(self.MultipartUpload)
+                              .filter_by(key=self.key, vault=vault, name=name,
+                                         path=path, file_size=file_size,
+                                         file_mtime=file_mtime,
+                                         part_size=part_size)
+                              .order_by(self.MultipartUpload.created_here.desc())
+                              .first())
+        if upload is None:
+            return None
+        return upload.id
+
+    def add_multipart_part(self, upload_id, start_byte, end_byte, tree_hash):
+        self.session.merge(self.MultipartPart(
+            upload_id=upload_id, start_byte=start_byte, end_byte=end_byte,
+            tree_hash=tree_hash))
+        self.session.commit()
+
+    @_short_transaction
+    def get_multipart_parts(self, upload_id):
+        """Return {start_byte: tree_hash} for the parts of upload_id
+        recorded as accepted"""
+        return dict(
+            self.session.query(self.MultipartPart.start_byte,
+                               self.MultipartPart.tree_hash)
+                        .filter_by(upload_id=upload_id))
+
+    def delete_multipart_upload(self, upload_id):
+        (self.session.query(self.MultipartPart)
+                     .filter_by(upload_id=upload_id)
+                     .delete())
+        (self.session.query(self.MultipartUpload)
+                     .filter_by(id=upload_id)
+                     .delete())
+        self.session.commit()
+
+    @_short_transaction
+    def get_retrieval_ranges(self, job_id, path, part_size):
+        """Return {start_byte: tree_hash} for each range of job_id's output
+        already written to path using the same part size"""
+        return dict(
+            self.session.query(self.RetrievalRange.start_byte,
+                               self.RetrievalRange.tree_hash)
+                        .filter_by(job_id=job_id, path=path,
+                                   part_size=part_size))
+
+    def add_retrieval_range(self, job_id, path, part_size, start_byte,
+                            end_byte, tree_hash):
+        self.session.add(self.RetrievalRange(
+            job_id=job_id, path=path, part_size=part_size,
+            start_byte=start_byte, end_byte=end_byte, tree_hash=tree_hash))
+        self.session.commit()
+
+    def clear_retrieval_ranges(self, job_id, path):
+        (self.session.query(self.RetrievalRange)
+                     .filter_by(job_id=job_id, path=path)
+                     .delete())
+        self.session.commit()
+
+    def _job_row(self, vault, description):
+        # Imported here so that commands that only read the cache need not
+        # import iso8601
+        import iso8601
+        completion_date = description.get('CompletionDate')
+        output_expires = None
+        if completion_date:
+            output_expires = (calendar.timegm(
+                iso8601.parse_date(completion_date).utctimetuple()) +
+                JOB_OUTPUT_LIFETIME)
+        return self.Job(
+            id=description['JobId'], key=self.key, vault=vault,
+            action=description['Action'],
+            archive_id=description.get('ArchiveId'),
+            status_code=description['StatusCode'],
+            creation_date=description['CreationDate'],
+            completion_date=completion_date,
+            output_expires=output_expires,
+            description=json.dumps(description))
+
+    def record_jobs(self, vault, descriptions):
+        """Add or update jobs from their Glacier job descriptions"""
+        for description in descriptions:
+            self.session.merge(self._job_row(vault, description))
+        self.session.commit()
+
+    def replace_jobs(self, vault, descriptions, listed):
+        """Record descriptions as every job vault has, as listed at time
+        listed, forgetting any others"""
+        ids = set()
+        for description in descriptions:
+            self.session.merge(self._job_row(vault, description))
+            ids.add(description['JobId'])
+        for job in (self.session.query(self.Job)
+                                .filter_by(key=self.key, vault=vault)):
+            if job.id not in ids:
+                self.session.delete(job)
+        self.session.merge(self.JobListing(key=self.key, vault=vault,
+                                           listed=listed))
+        self.session.commit()
+
+    def delete_jobs(self, vault, ids):
+        for chunk in chunked(ids, IN_CLAUSE_LIMIT):
+            (self.session.query(self.Job)
+                         .filter_by(key=self.key, vault=vault)
+                         .filter(self.Job.id.in_(chunk))
+                         .delete(synchronize_session=False))
+        self.session.commit()
+
+    @_short_transaction
+    def get_job_listing_time(self, vault):
+        """Return when all of vault's jobs were last listed, or None"""
+        listing = self.session.query(self.JobListing).get((self.key, vault))
+        if listing is None:
+            return None
+        return listing.listed
+
+    @_short_transaction
+    def get_jobs(self, vault=None, in_progress=False):
+        """Return the recorded jobs of vault, or of every vault, whose output
+        has not expired yet, oldest first"""
+        query = (self.session.query(self.Job)
+                             .filter_by(key=self.key)
+                             .filter((self.Job.output_expires == None) |
+                                     (self.Job.output_expires > time.time())))
+        if vault is not None:
+            query = query.filter_by(vault=vault)
+        if in_progress:
+            query = query.filter_by(status_code='InProgress')
+        jobs = query.order_by(self.Job.vault, self.Job.creation_date).all()
+        # Keep them readable once the transaction ends
+        for job in jobs:
+            self.session.expunge(job)
+        return jobs
@@ -0,0 +1,70 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Longest wait that SQS allows for a single ReceiveMessage call
+MAX_LONG_POLL = 20
+
+
+def parse_job_notification(body):
+    """Return the Glacier job description carried by an SQS message body, or
+    None if it is not one.
+
+    Glacier publishes the job description to SNS. Unless the subscription
+    uses raw message delivery, SNS wraps it in an envelope whose Message
+    field holds the description as a JSON string."""
+    try:
+        message = json.loads(body)
+        if 'JobId' not in message and 'Message' in message:
+            message = json.loads(message['Message'])
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(message, dict) or 'JobId' not in message:
+        return None
+    return message
+
+
+class JobNotifications(object):
+    """Glacier job completion notifications, delivered through an SNS topic
+    to an SQS queue.
+
+    sqs is a boto3 SQS client; pointing it at a local stand-in with an
+    endpoint URL works just as well. Notifications for jobs that nobody here
+    is waiting for are left on the queue for other processes sharing it, and
+    become visible again after the queue's visibility timeout."""
+
+    def __init__(self, sqs, queue_url):
+        self.sqs = sqs
+        self.queue_url = queue_url
+
+    def wait(self, job_ids, timeout):
+        """Long poll the queue for up to timeout seconds for notifications
+        that any of job_ids have completed, and return the set of those that
+        have; the set is empty if none arrived in time"""
+        job_ids = set(job_ids)
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return set()
+            response = self.sqs.receive_message(
+                QueueUrl=self.queue_url,
+                MaxNumberOfMessages=10,
+                WaitTimeSeconds=int(min(MAX_LONG_POLL, max(remaining, 1))))
+            completed = set()
+            for message in response.get('Messages', []):
+                description = parse_job_notification(message['Body'])
+                if description is None or description['JobId'] not in job_ids:
+                    continue
+                logger.debug('Notified of completion of job {}'.format(description['JobId']))
+                completed.add(description['JobId'])
+                self.sqs.delete_message(QueueUrl=self.queue_url,
+                                        ReceiptHandle=message['ReceiptHandle'])
+            if completed:
+                return completed
@@ -0,0 +1,100 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import errno
+import gzip
+import logging
+import os
+import os.path
+
+from utils import mkdir_p
+
+
+logger = logging.getLogger(__name__)
+
+# zlib's default level; higher levels cost much more time for little gain on
+# inventories
+COMPRESS_LEVEL = 6
+
+# File name extensions by the content type of an inventory
+EXTENSIONS = {
+    'text/csv': '.csv.gz',
+}
+DEFAULT_EXTENSION = '.json.gz'
+
+
+class SnapshotWriter(object):
+    """A file-like wrapper around an inventory body that writes everything
+    read through it to a compressed snapshot.
+
+    The snapshot is written to a temporary file beside its final path, and
+    only moved into place by finish(), so that a partial snapshot is never
+    mistaken for a whole one."""
+
+    def __init__(self, body, path):
+        self.body = body
+        self.path = path
+        self._partial_path = path + '.partial'
+        mkdir_p(os.path.dirname(path))
+        self._file = gzip.GzipFile(self._partial_path, 'wb',
+                                   compresslevel=COMPRESS_LEVEL)
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.body.read(size)
+        self._file.write(data)
+        self.size += len(data)
+        return data
+
+    def finish(self, chunk_size=1024 * 1024):
+        """Copy whatever remains of the body into the snapshot and move it
+        into place"""
+        while self.read(chunk_size):
+            pass
+        self._file.close()
+        os.rename(self._partial_path, self.path)
+
+    def discard(self):
+        """Remove the snapshot, unless finish() has already kept it"""
+        if self._file.closed:
+            return
+        self._file.close()
+        try:
+            os.unlink(self._partial_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+class InventorySnapshots(object):
+    """Compressed copies of retrieved vault inventories, kept on disk so that
+    a vault can be reconciled again without waiting hours for another
+    inventory job.
+
+    Snapshots live under directory, one subdirectory per vault and one file
+    per inventory job. Which snapshots exist, and what they hold, is recorded
+    in the cache; paths given and taken here are relative to directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, vault, job_id, content_type=None):
+        return os.path.join(
+            vault,
+            job_id + EXTENSIONS.get(content_type, DEFAULT_EXTENSION))
+
+    def writer(self, body, path):
+        """Return a SnapshotWriter that copies body to the snapshot at path
+        as it is read"""
+        return SnapshotWriter(body, os.path.join(self.directory, path))
+
+    def open(self, path):
+        """Open the snapshot at path, returning a file-like inventory body"""
+        return gzip.GzipFile(os.path.join(self.directory, path), 'rb')
+
+    def remove(self, path):
+        try:
+            os.unlink(os.path.join(self.directory, path))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
@@ -0,0 +1,47 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+
+EXPEDITED = 'Expedited'
+STANDARD = 'Standard'
+BULK = 'Bulk'
+
+# Cheapest first
+TIERS = [BULK, STANDARD, EXPEDITED]
+
+# Longest time in seconds that Amazon quotes for a retrieval in each tier to
+# complete
+TIER_LATENCY = {
+    EXPEDITED: 5 * 60,
+    STANDARD: 5 * 60 * 60,
+    BULK: 12 * 60 * 60,
+}
+
+# Expedited retrievals are not available for the largest archives
+EXPEDITED_MAX_SIZE = 250 * 1024 * 1024
+
+
+def tier_available(tier, size):
+    """Return whether an archive of size bytes can be retrieved in tier. An
+    archive of unknown size (None) is assumed to be too large to expedite."""
+    if tier == EXPEDITED:
+        return size is not None and size <= EXPEDITED_MAX_SIZE
+    return True
+
+
+def plan_tier(size, deadline):
+    """Return the cheapest tier expected to retrieve an archive of size bytes
+    within deadline seconds, or the fastest available tier if none is"""
+    available = [tier for tier in TIERS if tier_available(tier, size)]
+    for tier in available:
+        if TIER_LATENCY[tier] <= deadline:
+            return tier
+    return available[-1]
+
+
+def expected_completion(tier, creation_time):
+    """Return the latest time by which a job in tier initiated at
+    creation_time is expected to complete. Jobs which predate tiers, or
+    whose tier is unknown, are taken to be Standard."""
+    return creation_time + TIER_LATENCY.get(tier or STANDARD,
+                                            TIER_LATENCY[STANDARD])
@@ -0,0 +1,246 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import collections
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from wrappedfile import WrappedFile
+import treehash
+
+
+logger = logging.getLogger(__name__)
+
+
+class ChecksumMismatchError(RuntimeError):
+    """Downloaded data does not match the tree hash reported by Glacier"""
+
+
+def part_ranges(total_size, part_size):
+    """Yield (start, end) byte ranges of part_size bytes covering total_size
+    bytes. The final range may be shorter than part_size."""
+    for start in xrange(0, total_size, part_size):
+        yield start, min(start + part_size, total_size)
+
+
+def run_concurrently(fn, items, concurrency, callback=None):
+    """Call fn(*item) for each item on a pool of concurrency threads and
+    return the results in the order of items.
+
+    If given, callback(item, result) is called from the calling thread as each
+    call completes. If any call raises, calls that have not started yet are
+    cancelled and the exception is re-raised once the running calls have
+    finished."""
+    results = [None] * len(items)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = dict((executor.submit(fn, *item), i)
+                       for i, item in enumerate(items))
+        try:
+            for future in as_completed(futures):
+                i = futures[future]
+                results[i] = future.result()
+                if callback is not None:
+                    callback(items[i], results[i])
+        except:
+            for future in futures:
+                future.cancel()
+            raise
+    return results
+
+
+class PartUploader(object):
+    """Upload the parts of a Glacier multipart upload from a pool of threads.
+
+    Each part is read through its own WrappedFile window. As the underlying
+    file object is shared by all workers, windows are read one at a time under
+    a lock; the network transfers themselves run concurrently. The tree hash
+    of each part is computed from the same buffer that is sent, so the file
+    is only read once.
+
+    An upload can be resumed: completed_parts maps the start of each part
+    already accepted by Glacier to its tree hash, and those parts are not
+    sent again. on_part_complete(start, end, tree_hash) is called from the
+    calling thread as each new part is accepted."""
+
+    def __init__(self, multipart, file, part_size, concurrency=1,
+                 completed_parts=None, on_part_complete=None):
+        self.multipart = multipart
+        self.file = file
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.completed_parts = completed_parts or {}
+        self.on_part_complete = on_part_complete
+        self._file_lock = threading.Lock()
+
+    def _read_part(self, start, end):
+        with self._file_lock:
+            return WrappedFile(self.file, start, end).read()
+
+    def _upload_part(self, start, end, chunk_num, chunks):
+        data = self._read_part(start, end)
+        tree_hash = treehash.tree_hash(data)
+        logger.debug('Uploading bytes {}-{} (Chunk {} of {})'.format(start, end - 1, chunk_num, chunks))
+        self.multipart.upload_part(
+            range='bytes {}-{}/*'.format(start, end - 1),
+            body=data,
+            checksum=tree_hash
+        )
+        return tree_hash
+
+    def upload(self, file_size):
+        """Upload all parts of a file of file_size bytes and return the tree
+        hash of each part, in file order"""
+        ranges = list(part_ranges(file_size, self.part_size))
+        chunks = len(ranges)
+        tree_hashes_by_start = dict(self.completed_parts)
+        missing = [(start, end, chunk_num + 1, chunks)
+                   for chunk_num, (start, end) in enumerate(ranges)
+                   if start not in tree_hashes_by_start]
+        if tree_hashes_by_start:
+            logger.info('Resuming upload with {} of {} parts already complete'.format(chunks - len(missing), chunks))
+
+        def part_complete(item, tree_hash):
+            tree_hashes_by_start[item[0]] = tree_hash
+            if self.on_part_complete is not None:
+                self.on_part_complete(item[0], item[1], tree_hash)
+
+        run_concurrently(self._upload_part, missing, self.concurrency,
+                         callback=part_complete)
+        return [tree_hashes_by_start[start] for start, end in ranges]
+
+
+def list_uploaded_parts(multipart):
+    """Return {start: tree_hash} for the parts of a multipart upload that
+    Glacier has already accepted"""
+    parts = {}
+    kwargs = {}
+    while True:
+        response = multipart.parts(**kwargs)
+        for part in response['Parts']:
+            start, end = part['RangeInBytes'].split('-')
+            parts[int(start)] = part['SHA256TreeHash']
+        if not response.get('Marker'):
+            return parts
+        kwargs['marker'] = response['Marker']
+
+
+class RangeDownloader(object):
+    """Download the output of a Glacier archive retrieval job as byte ranges
+    fetched from a pool of threads.
+
+    If the output file is seekable, it is preallocated to the archive size and
+    each range is written at its own offset as soon as it arrives. Otherwise
+    (eg. standard output) ranges are fetched ahead of time but written in
+    order, so that at most concurrency ranges are held in memory.
+
+    Every range is tree hashed as it arrives and checked against the tree hash
+    Glacier sends with it before it is written. The range hashes are then
+    combined to verify the whole archive without reading it back.
+
+    A seekable download can be resumed: completed_ranges maps the start of
+    each range already present in the file to its tree hash, and those ranges
+    are not fetched again. on_range_complete(start, end, tree_hash) is called
+    from the calling thread once each new range is safely on disk."""
+
+    def __init__(self, job, file, part_size, concurrency=1, seekable=True,
+                 completed_ranges=None, on_range_complete=None):
+        self.job = job
+        self.file = file
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.seekable = seekable
+        self.completed_ranges = completed_ranges or {}
+        self.on_range_complete = on_range_complete
+        self._file_lock = threading.Lock()
+
+    @staticmethod
+    def _verify(response, data, description):
+        tree_hash = treehash.tree_hash(data)
+        expected = response.get('checksum')
+        if expected is not None and expected != tree_hash:
+            raise ChecksumMismatchError(
+                'SHA256 Tree Hash of {} does not match Glacier. Download is likely corrupt.'.format(description))
+        return tree_hash
+
+    def _fetch(self, start, end, chunk_num, chunks):
+        logger.debug('Fetching multipart byte range {}-{} (Chunk {} of {})'.format(start, end - 1, chunk_num, chunks))
+        response = self.job.get_output(range='bytes={}-{}'.format(start, end - 1))
+        data = response['body'].read()
+        tree_hash = self._verify(response, data, 'byte range {}-{}'.format(start, end - 1))
+        return data, tree_hash
+
+    def _fetch_and_write(self, start, end, chunk_num, chunks):
+        data, tree_hash = self._fetch(start, end, chunk_num, chunks)
+        with self._file_lock:
+            self.file.seek(start)
+            self.file.write(data)
+            if self.on_range_complete is not None:
+                # Never let a checkpoint get ahead of the data it describes
+                self.file.flush()
+                os.fsync(self.file.fileno())
+        return tree_hash
+
+    def _download_in_order(self, items):
+        tree_hashes = []
+
+        def write(future):
+            data, tree_hash = future.result()
+            self.file.write(data)
+            tree_hashes.append(tree_hash)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            pending = collections.deque()
+            try:
+                for item in items:
+                    pending.append(executor.submit(self._fetch, *item))
+                    if len(pending) > self.concurrency:
+                        write(pending.popleft())
+                while pending:
+                    write(pending.popleft())
+            except:
+                for future in pending:
+                    future.cancel()
+                raise
+        return tree_hashes
+
+    def download(self, size, expected_tree_hash=None):
+        """Write the size bytes of job output to the file and return its tree
+        hash. If expected_tree_hash is given, raise ChecksumMismatchError
+        unless the downloaded archive matches it."""
+        if size <= self.part_size:
+            logger.debug('Fetching entire byte range')
+            response = self.job.get_output()
+            data = response['body'].read()
+            tree_hash = self._verify(response, data, 'archive')
+            self.file.write(data)
+        else:
+            ranges = list(part_ranges(size, self.part_size))
+            chunks = len(ranges)
+            items = [(start, end, chunk_num + 1, chunks)
+                     for chunk_num, (start, end) in enumerate(ranges)]
+            if self.seekable:
+                self.file.truncate(size)
+                tree_hashes_by_start = dict(self.completed_ranges)
+                missing = [item for item in items
+                           if item[0] not in tree_hashes_by_start]
+                if tree_hashes_by_start:
+                    logger.info('Resuming download with {} of {} byte ranges already complete'.format(chunks - len(missing), chunks))
+
+                def range_complete(item, tree_hash):
+                    tree_hashes_by_start[item[0]] = tree_hash
+                    if self.on_range_complete is not None:
+                        self.on_range_complete(item[0], item[1], tree_hash)
+
+                run_concurrently(self._fetch_and_write, missing,
+                                 self.concurrency, callback=range_complete)
+                tree_hashes = [tree_hashes_by_start[start]
+                               for start, end in ranges]
+            else:
+                tree_hashes = self._download_in_order(items)
+            tree_hash = treehash.combine_tree_hashes(tree_hashes)
+
+        if expected_tree_hash is not None and tree_hash != expected_tree_hash:
+            raise ChecksumMismatchError('SHA256 Tree Hash does not match Glacier Archive. Download is likely corrupt.')
+        return tree_hash
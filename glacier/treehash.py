@@ -0,0 +1,46 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import binascii
+import hashlib
+
+
+# Glacier tree hashes are built from SHA256 hashes of 1MB leaves. See:
+# http://docs.aws.amazon.com/amazonglacier/latest/dev/checksum-calculations.html
+LEAF_SIZE = 1024 * 1024
+
+
+def _combine_digests(digests):
+    """Reduce a list of binary subtree hashes to the binary root hash"""
+    if not digests:
+        return hashlib.sha256(b'').digest()
+    while len(digests) > 1:
+        combined = []
+        for i in xrange(0, len(digests) - 1, 2):
+            combined.append(hashlib.sha256(digests[i] + digests[i + 1]).digest())
+        if len(digests) % 2:
+            combined.append(digests[-1])
+        digests = combined
+    return digests[0]
+
+
+def leaf_digests(data):
+    """Return the binary SHA256 hash of each 1MB leaf of data"""
+    return [hashlib.sha256(data[i:i + LEAF_SIZE]).digest()
+            for i in xrange(0, len(data), LEAF_SIZE)]
+
+
+def tree_hash(data):
+    """Return the hex tree hash of a string of bytes"""
+    return binascii.hexlify(_combine_digests(leaf_digests(data))).decode('ascii')
+
+
+def combine_tree_hashes(tree_hashes):
+    """Return the hex tree hash of consecutive ranges given their hex tree hashes.
+
+    This is only valid when every range but the last is the same power of two
+    multiple of 1MB long, which validate_multipart_bytes guarantees for
+    multipart part sizes, so that each range is a whole subtree of the final
+    tree."""
+    return binascii.hexlify(_combine_digests(
+        [binascii.unhexlify(h) for h in tree_hashes])).decode('ascii')
@@ -3,6 +3,7 @@ from __future__ import unicode_literals
 
 import os
 import errno
+import itertools
 
 
 def mkdir_p(path):
@@ -20,3 +21,33 @@ def validate_multipart_bytes(num_bytes):
     error = ValueError('Part size must be a power of two and be between 1048576 and 4294967296 bytes.')
     if num_bytes not in [2**n for n in range(20,33)]:
         raise error
+
+
+def validate_concurrency(num_workers):
+    """Concurrent transfers need at least one worker"""
+    if num_workers < 1:
+        raise ValueError('Concurrency must be at least 1.')
+
+
+def chunked(iterable, size):
+    """Yield lists of up to size consecutive items from iterable"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+_DURATION_UNITS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+
+def parse_duration(text):
+    """Return the number of seconds in a duration such as 90s, 30m, 4h or
+    2d. A bare number is a number of hours."""
+    text = text.strip().lower()
+    unit = 'h'
+    if text and text[-1] in _DURATION_UNITS:
+        text, unit = text[:-1], text[-1]
+    seconds = float(text) * _DURATION_UNITS[unit]
+    if seconds <= 0:
+        raise ValueError('Duration must be positive.')
+    return seconds
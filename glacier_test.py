@@ -23,14 +23,29 @@
 
 from __future__ import print_function
 
+import datetime
+import hashlib
+import io
+import json
+import os
+import shutil
+import StringIO
+import subprocess
 import sys
+import tempfile
+import time
 import unittest
 
 import mock
 from mock import Mock, patch, sentinel
 import nose.tools
+import botocore.exceptions
+import botocore.utils
+import sqlalchemy
 
 import glacier
+from glacier import annexremote, cli, credentials, inventory, models, \
+    notifications, snapshots, tiers, transfer, treehash, utils
 
 
 EX_TEMPFAIL = 75
@@ -171,3 +186,1679 @@ class TestCase(unittest.TestCase):
         mock_vault = self.connection.get_vault.return_value
         mock_vault.delete_archive.assert_called_once_with(
             self.cache.get_archive_id.return_value)
+
+
+class TransferTestCase(unittest.TestCase):
+    def test_part_ranges(self):
+        nose.tools.assert_equals(
+            list(transfer.part_ranges(5, 2)), [(0, 2), (2, 4), (4, 5)])
+        nose.tools.assert_equals(list(transfer.part_ranges(4, 2)),
+                                 [(0, 2), (2, 4)])
+
+    def test_part_uploader(self):
+        part_size = 1024 * 1024
+        data = b'a' * part_size + b'b' * part_size + b'c'
+        multipart = Mock()
+        uploader = transfer.PartUploader(
+            multipart, io.BytesIO(data), part_size, concurrency=3)
+        tree_hashes = uploader.upload(len(data))
+        nose.tools.assert_equals(tree_hashes, [
+            botocore.utils.calculate_tree_hash(io.BytesIO(part))
+            for part in [b'a' * part_size, b'b' * part_size, b'c']])
+        uploaded = sorted(
+            (call[2]['range'], call[2]['body'], call[2]['checksum'])
+            for call in multipart.upload_part.mock_calls)
+        nose.tools.assert_equals(uploaded, [
+            ('bytes 0-1048575/*', b'a' * part_size, tree_hashes[0]),
+            ('bytes 1048576-2097151/*', b'b' * part_size, tree_hashes[1]),
+            ('bytes 2097152-2097152/*', b'c', tree_hashes[2]),
+        ])
+
+    def test_part_uploader_resume(self):
+        part_size = 1024 * 1024
+        data = b'a' * part_size + b'b' * part_size
+        multipart = Mock()
+        completed = []
+        uploader = transfer.PartUploader(
+            multipart, io.BytesIO(data), part_size,
+            completed_parts={0: sentinel.tree_hash},
+            on_part_complete=lambda *args: completed.append(args))
+        tree_hashes = uploader.upload(len(data))
+        nose.tools.assert_equals(
+            tree_hashes,
+            [sentinel.tree_hash, treehash.tree_hash(b'b' * part_size)])
+        nose.tools.assert_equals(multipart.upload_part.call_count, 1)
+        nose.tools.assert_equals(
+            completed, [(part_size, 2 * part_size, tree_hashes[1])])
+
+    def test_list_uploaded_parts(self):
+        multipart = Mock()
+        multipart.parts.side_effect = [
+            {'Parts': [{'RangeInBytes': '0-1048575',
+                        'SHA256TreeHash': 'hash0'}],
+             'Marker': 'next'},
+            {'Parts': [{'RangeInBytes': '1048576-2097151',
+                        'SHA256TreeHash': 'hash1'}],
+             'Marker': None},
+        ]
+        nose.tools.assert_equals(
+            transfer.list_uploaded_parts(multipart),
+            {0: 'hash0', 1048576: 'hash1'})
+        nose.tools.assert_equals(multipart.parts.mock_calls,
+                                 [mock.call(), mock.call(marker='next')])
+
+    def test_part_uploader_failure(self):
+        multipart = Mock()
+        multipart.upload_part.side_effect = IOError('network down')
+        uploader = transfer.PartUploader(
+            multipart, io.BytesIO(b'x' * 4 * 1024 * 1024), 1024 * 1024,
+            concurrency=2)
+        nose.tools.assert_raises(IOError, uploader.upload, 4 * 1024 * 1024)
+
+
+class TreeHashTestCase(unittest.TestCase):
+    SIZES = [0, 1, treehash.LEAF_SIZE, treehash.LEAF_SIZE + 1,
+             3 * treehash.LEAF_SIZE, 5 * treehash.LEAF_SIZE - 7]
+
+    def test_tree_hash(self):
+        for size in self.SIZES:
+            data = b'x' * size
+            nose.tools.assert_equals(
+                treehash.tree_hash(data),
+                botocore.utils.calculate_tree_hash(io.BytesIO(data)))
+
+    def test_combine_tree_hashes(self):
+        data = b''.join(chr(i % 256) * 1000
+                        for i in xrange(7 * 1024))
+        for part_size in [treehash.LEAF_SIZE, 2 * treehash.LEAF_SIZE,
+                          4 * treehash.LEAF_SIZE]:
+            part_hashes = [treehash.tree_hash(data[start:end]) for start, end
+                           in transfer.part_ranges(len(data), part_size)]
+            nose.tools.assert_equals(
+                treehash.combine_tree_hashes(part_hashes),
+                treehash.tree_hash(data))
+
+
+class FakeRetrievalJob(object):
+    """A job whose output is served from a string, one range at a time"""
+    def __init__(self, data, corrupt_range=None):
+        self.data = data
+        self.corrupt_range = corrupt_range
+        self.ranges = []
+
+    def get_output(self, range=None):
+        if range is None:
+            body = self.data
+        else:
+            start, end = [int(n) for n in range[len('bytes='):].split('-')]
+            self.ranges.append((start, end))
+            body = self.data[start:end + 1]
+        checksum = treehash.tree_hash(body)
+        if range is not None and range == self.corrupt_range:
+            body = b'x' + body[1:]
+        return {'body': io.BytesIO(body), 'checksum': checksum}
+
+
+class RangeDownloaderTestCase(unittest.TestCase):
+    DATA = b''.join(chr(i % 256) * 1000 for i in xrange(5 * 1024 + 3))
+
+    def test_download_seekable(self):
+        job = FakeRetrievalJob(self.DATA)
+        f = io.BytesIO()
+        tree_hash = transfer.RangeDownloader(
+            job, f, 1024 * 1024, concurrency=3).download(
+                len(self.DATA), treehash.tree_hash(self.DATA))
+        nose.tools.assert_equals(tree_hash, treehash.tree_hash(self.DATA))
+        nose.tools.assert_equals(f.getvalue(), self.DATA)
+        nose.tools.assert_equals(len(job.ranges), 5)
+
+    def test_download_in_order(self):
+        job = FakeRetrievalJob(self.DATA)
+        f = Mock()
+        transfer.RangeDownloader(job, f, 1024 * 1024, concurrency=3,
+                                 seekable=False).download(len(self.DATA))
+        nose.tools.assert_false(f.seek.called)
+        nose.tools.assert_equals(
+            b''.join(call[1][0] for call in f.write.mock_calls), self.DATA)
+
+    def test_download_resume(self):
+        job = FakeRetrievalJob(self.DATA)
+        f = tempfile.TemporaryFile()
+        f.write(self.DATA[:1024 * 1024])
+        completed = []
+        tree_hash = transfer.RangeDownloader(
+            job, f, 1024 * 1024,
+            completed_ranges={
+                0: treehash.tree_hash(self.DATA[:1024 * 1024])},
+            on_range_complete=lambda *args: completed.append(args),
+        ).download(len(self.DATA), treehash.tree_hash(self.DATA))
+        nose.tools.assert_equals(tree_hash, treehash.tree_hash(self.DATA))
+        nose.tools.assert_equals(len(job.ranges), 4)
+        nose.tools.assert_equals(
+            sorted(args[0] for args in completed),
+            [n * 1024 * 1024 for n in range(1, 5)])
+        f.seek(0)
+        nose.tools.assert_equals(f.read(), self.DATA)
+
+    def test_download_single_range(self):
+        job = FakeRetrievalJob(b'small')
+        f = io.BytesIO()
+        transfer.RangeDownloader(job, f, 1024 * 1024).download(5)
+        nose.tools.assert_equals(f.getvalue(), b'small')
+        nose.tools.assert_equals(job.ranges, [])
+
+    def test_download_corrupt_range(self):
+        job = FakeRetrievalJob(self.DATA,
+                               corrupt_range='bytes=1048576-2097151')
+        f = Mock()
+        downloader = transfer.RangeDownloader(job, f, 1024 * 1024,
+                                              seekable=False)
+        nose.tools.assert_raises(transfer.ChecksumMismatchError,
+                                 downloader.download, len(self.DATA))
+        nose.tools.assert_equals(f.write.call_count, 1)
+
+    def test_download_whole_archive_mismatch(self):
+        job = FakeRetrievalJob(self.DATA)
+        downloader = transfer.RangeDownloader(job, io.BytesIO(), 1024 * 1024)
+        nose.tools.assert_raises(transfer.ChecksumMismatchError,
+                                 downloader.download, len(self.DATA),
+                                 treehash.tree_hash(b'something else'))
+
+
+def make_inventory(archives, inventory_date='2017-06-01T00:00:00Z'):
+    return json.dumps({
+        'VaultARN': 'arn:aws:glacier:us-east-1:0:vaults/vault',
+        'InventoryDate': inventory_date,
+        'ArchiveList': [{
+            'ArchiveId': id,
+            'ArchiveDescription': name,
+            'CreationDate': '2017-05-01T00:00:00Z',
+            'Size': size,
+            'SHA256TreeHash': '0' * 64,
+        } for id, name, size in archives],
+    }).encode('utf-8')
+
+
+def make_csv_inventory(archives):
+    lines = [b'ArchiveId,ArchiveDescription,CreationDate,Size,SHA256TreeHash']
+    for id, name, size in archives:
+        name = name.encode('utf-8')
+        if b',' in name or b'"' in name:
+            name = (b'"' + name.replace(b'\\', b'\\\\').replace(b'"', b'\\"')
+                    + b'"')
+        lines.append(b','.join([id.encode('utf-8'), name,
+                                b'2017-05-01T00:00:00Z', str(size),
+                                b'0' * 64]))
+    return b'\r\n'.join(lines) + b'\r\n'
+
+
+class InventoryReaderTestCase(unittest.TestCase):
+    ARCHIVES = [
+        ('id_1', u'plain', 1),
+        ('id_2', u'with "quotes", commas and \\ backslashes', 22),
+        ('id_3', u'unicode \u00e9\u4e2d', 333333333333),
+    ]
+
+    def test_archives(self):
+        body = make_inventory(self.ARCHIVES)
+        for chunk_size in [1, 7, 64 * 1024]:
+            reader = inventory.InventoryReader(io.BytesIO(body),
+                                               chunk_size=chunk_size)
+            header = reader.read_header()
+            nose.tools.assert_equals(header['InventoryDate'],
+                                     '2017-06-01T00:00:00Z')
+            nose.tools.assert_equals(
+                [(a['ArchiveId'], a['ArchiveDescription'], a['Size'])
+                 for a in reader.archives()],
+                self.ARCHIVES)
+
+    def test_hexdigest(self):
+        body = make_inventory(self.ARCHIVES)
+        reader = inventory.InventoryReader(io.BytesIO(body), chunk_size=7)
+        list(reader.archives())
+        nose.tools.assert_equals(reader.hexdigest(),
+                                 hashlib.sha256(body).hexdigest())
+
+    def test_read_ahead(self):
+        for make_body, reader_class in [
+                (make_inventory, inventory.InventoryReader),
+                (make_csv_inventory, inventory.InventoryCSVReader)]:
+            body = make_body(self.ARCHIVES)
+            reader = reader_class(io.BytesIO(body), chunk_size=7)
+            reader.read_header()
+            spool = io.BytesIO()
+            reader.read_ahead(spool)
+            nose.tools.assert_equals(spool.getvalue(), body[len(body) -
+                                                            len(spool.getvalue()):])
+            nose.tools.assert_equals(reader.hexdigest(),
+                                     hashlib.sha256(body).hexdigest())
+            nose.tools.assert_equals(
+                [(a['ArchiveId'], a['ArchiveDescription'], a['Size'])
+                 for a in reader.archives()],
+                self.ARCHIVES)
+            nose.tools.assert_equals(reader.hexdigest(),
+                                     hashlib.sha256(body).hexdigest())
+
+    def test_csv_archives(self):
+        body = make_csv_inventory(self.ARCHIVES)
+        for chunk_size in [1, 7, 64 * 1024]:
+            reader = inventory.InventoryCSVReader(io.BytesIO(body),
+                                                  chunk_size=chunk_size)
+            nose.tools.assert_equals(reader.read_header(), {})
+            nose.tools.assert_equals(
+                [(a['ArchiveId'], a['ArchiveDescription'], a['Size'])
+                 for a in reader.archives()],
+                self.ARCHIVES)
+        nose.tools.assert_equals(reader.hexdigest(),
+                                 hashlib.sha256(body).hexdigest())
+
+    def test_csv_doubled_quotes(self):
+        body = (b'ArchiveId,ArchiveDescription,CreationDate,Size,'
+                b'SHA256TreeHash\nid_1,"say ""hi"", then go",'
+                b'2017-05-01T00:00:00Z,5,hash')
+        archive, = inventory.InventoryCSVReader(io.BytesIO(body)).archives()
+        nose.tools.assert_equals(archive['ArchiveDescription'],
+                                 'say "hi", then go')
+
+    def test_csv_backslashes(self):
+        body = (b'ArchiveId,ArchiveDescription,CreationDate,Size,'
+                b'SHA256TreeHash\nid_1,C:\\backup\\new.tar,'
+                b'2017-05-01T00:00:00Z,5,hash\n'
+                b'id_2,"D:\\say \\"hi\\", then go",'
+                b'2017-05-01T00:00:00Z,5,hash\n'
+                b'id_3,"a,b\\\\",2017-05-01T00:00:00Z,5,hash\r\n'
+                b'id_4,"a,b\\",2017-05-01T00:00:00Z,5,hash')
+        for chunk_size in [1, 64 * 1024]:
+            reader = inventory.InventoryCSVReader(io.BytesIO(body),
+                                                  chunk_size=chunk_size)
+            nose.tools.assert_equals(
+                [a['ArchiveDescription'] for a in reader.archives()],
+                ['C:\\backup\\new.tar', 'D:\\say "hi", then go',
+                 'a,b\\', 'a,b\\'])
+
+    def test_csv_malformed(self):
+        body = (b'ArchiveId,ArchiveDescription,CreationDate,Size,'
+                b'SHA256TreeHash\nid_1,one,2017-05-01T00:00:00Z,5,hash\n'
+                b'id_2,"quoted"junk,2017-05-01T00:00:00Z,5,hash')
+        reader = inventory.InventoryCSVReader(io.BytesIO(body))
+        with nose.tools.assert_raises(ValueError) as cm:
+            list(reader.archives())
+        nose.tools.assert_in('Malformed inventory: line 3', str(cm.exception))
+
+    def test_csv_missing_column(self):
+        reader = inventory.InventoryCSVReader(io.BytesIO(b'ArchiveId,Size\n'))
+        nose.tools.assert_raises(ValueError, reader.read_header)
+
+    def test_open_inventory(self):
+        nose.tools.assert_is_instance(
+            inventory.open_inventory(io.BytesIO(), 'text/csv'),
+            inventory.InventoryCSVReader)
+        nose.tools.assert_is_instance(
+            inventory.open_inventory(io.BytesIO(), 'application/json'),
+            inventory.InventoryReader)
+
+    def test_fields_after_archive_list(self):
+        body = (b'{"ArchiveList": [], "InventoryDate": '
+                b'"2017-06-01T00:00:00Z"}')
+        reader = inventory.InventoryReader(io.BytesIO(body), chunk_size=3)
+        nose.tools.assert_equals(list(reader.archives()), [])
+        nose.tools.assert_equals(reader.header['InventoryDate'],
+                                 '2017-06-01T00:00:00Z')
+
+    def test_malformed(self):
+        reader = inventory.InventoryReader(
+            io.BytesIO(b'{"ArchiveList": [{"ArchiveId": "a"} {}]}'))
+        nose.tools.assert_raises(ValueError, list, reader.archives())
+
+
+def make_job(job_id, action='ArchiveRetrieval', archive_id=None,
+             completed=False, creation_date='2017-06-01T00:00:00.000Z',
+             completion_date=None):
+    """Return a mock boto3 Job, including the description it was built
+    from"""
+    status_code = 'Succeeded' if completed else 'InProgress'
+    job = Mock(id=job_id, action=action, archive_id=archive_id,
+               completed=completed, status_code=status_code,
+               creation_date=creation_date, completion_date=completion_date)
+    job.meta.data = {'JobId': job_id, 'Action': action,
+                     'ArchiveId': archive_id, 'Completed': completed,
+                     'StatusCode': status_code,
+                     'CreationDate': creation_date,
+                     'CompletionDate': completion_date}
+    return job
+
+
+class CacheMixin(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        # Keep anything an App writes next to the cache out of the home
+        # directory
+        environ = patch.dict(os.environ, {'XDG_CACHE_HOME': self.tmpdir,
+                                          'XDG_CONFIG_HOME': self.tmpdir})
+        environ.start()
+        self.addCleanup(environ.stop)
+
+    def make_cache(self, key='key'):
+        db_path = os.path.join(self.tmpdir, 'glacier-cli', 'db.sqlite')
+        with patch.object(models.Cache, 'upgrade_schema'):
+            cache = models.Cache(key, 'sqlite:///' + db_path)
+        models.Base.metadata.create_all(cache.engine)
+        return cache
+
+
+class CacheTestCase(CacheMixin, unittest.TestCase):
+    def test_upgrade_schema(self):
+        environ = {'XDG_CACHE_HOME': self.tmpdir,
+                   'XDG_CONFIG_HOME': self.tmpdir}
+        db_path = os.path.join(self.tmpdir, 'glacier-cli', 'db.sqlite')
+        with patch.dict(os.environ, environ):
+            cache = models.Cache('key', 'sqlite:///' + db_path)
+        inspector = sqlalchemy.inspect(cache.engine)
+        nose.tools.assert_equals(
+            sorted(set(models.Base.metadata.tables) -
+                   set(inspector.get_table_names())), [])
+        for name, table in models.Base.metadata.tables.items():
+            nose.tools.assert_equals(
+                sorted(index['name'] for index in
+                       inspector.get_indexes(name)),
+                sorted(index.name for index in table.indexes))
+
+    def test_no_duplicate_index_without_partial_indexes(self):
+        import alembic.command
+        import alembic.config
+        import pkg_resources
+        output = StringIO.StringIO()
+        cfg = alembic.config.Config(
+            pkg_resources.resource_filename(models.__name__, 'alembic.ini'),
+            output_buffer=output)
+        cfg.set_main_option('sqlalchemy.url', 'mysql://')
+        alembic.command.upgrade(cfg, 'b52e07d9c4a1', sql=True)
+        nose.tools.assert_equals(
+            [line.split()[2] for line in output.getvalue().splitlines()
+             if line.startswith('CREATE INDEX ix_archive_')],
+            ['ix_archive_key_vault_name', 'ix_archive_key_vault_id'])
+
+    def test_live_archive_lookup_uses_index(self):
+        cache = self.make_cache()
+        plan = cache.engine.execute(
+            'EXPLAIN QUERY PLAN ' + str(
+                cache._get_archive_query_by_ref('vault', 'name')
+                     .statement.compile(cache.engine)),
+            'key', 'vault', 'name').fetchall()
+        nose.tools.assert_in('USING INDEX ix_archive_', str(plan))
+
+    def test_sqlite_concurrency_settings(self):
+        cache = self.make_cache()
+        connection = cache.engine.connect()
+        nose.tools.assert_equals(
+            connection.execute('PRAGMA journal_mode').scalar(), 'wal')
+        # NORMAL
+        nose.tools.assert_equals(
+            connection.execute('PRAGMA synchronous').scalar(), 1)
+        nose.tools.assert_equals(
+            connection.execute('PRAGMA busy_timeout').scalar(),
+            models.DEFAULT_BUSY_TIMEOUT * 1000)
+        connection.close()
+
+    def test_lookup_releases_connection(self):
+        cache = self.make_cache()
+        cache.add_archive('vault', 'name', 1, Mock(id='id'))
+        checked_out = []
+        sqlalchemy.event.listen(cache.engine, 'checkout',
+                                lambda *args: checked_out.append(1))
+        sqlalchemy.event.listen(cache.engine, 'checkin',
+                                lambda *args: checked_out.pop())
+        nose.tools.assert_equals(cache.get_archive_id('vault', 'name'), 'id')
+        nose.tools.assert_equals(checked_out, [])
+        nose.tools.assert_raises(KeyError, cache.get_archive_id, 'vault',
+                                 'missing')
+        nose.tools.assert_equals(checked_out, [])
+
+    def test_retrieval_ranges(self):
+        cache = self.make_cache()
+        cache.add_retrieval_range('job', '/tmp/a', 2, 0, 2, 'hash0')
+        cache.add_retrieval_range('job', '/tmp/a', 2, 2, 4, 'hash1')
+        cache.add_retrieval_range('job', '/tmp/b', 2, 0, 2, 'hash2')
+        nose.tools.assert_equals(
+            cache.get_retrieval_ranges('job', '/tmp/a', 2),
+            {0: 'hash0', 2: 'hash1'})
+        nose.tools.assert_equals(
+            cache.get_retrieval_ranges('job', '/tmp/a', 4), {})
+        cache.clear_retrieval_ranges('job', '/tmp/a')
+        nose.tools.assert_equals(
+            cache.get_retrieval_ranges('job', '/tmp/a', 2), {})
+        nose.tools.assert_equals(
+            cache.get_retrieval_ranges('job', '/tmp/b', 2), {0: 'hash2'})
+
+    def test_mark_seen_upstream_batch(self):
+        cache = self.make_cache()
+        cache.add_archive('vault', 'renamed', 10, Mock(id='id_1'))
+        cache.add_archive('vault', 'unchanged', 20, Mock(id='id_2'))
+        cache.add_archive('vault', 'deleted', 30, Mock(id='id_3'))
+        cache.delete_archive('vault', 'deleted')
+        log = Mock()
+        with patch.object(models.logger, 'warn', log):
+            cache.mark_seen_upstream_batch(
+                'vault',
+                [{'id': 'id_1', 'name': 'new name', 'size': 11},
+                 {'id': 'id_2', 'name': 'unchanged', 'size': 20},
+                 {'id': 'id_3', 'name': 'deleted', 'size': 30},
+                 {'id': 'id_4', 'name': 'added', 'size': 40}],
+                upstream_inventory_date=1000 + models.INVENTORY_LAG,
+                upstream_inventory_job_creation_date=0,
+                fix=True)
+        cache.mark_commit()
+        nose.tools.assert_equals(len(log.mock_calls), 3)
+        nose.tools.assert_equals(sorted(cache.get_archive_list('vault')),
+                                 ['added', 'new name', 'unchanged'])
+        nose.tools.assert_equals(
+            [(a.id, a.size, a.last_seen_upstream)
+             for a in cache.get_archive_list_objects('vault')],
+            [('id_4', 40, 1000 + models.INVENTORY_LAG),
+             ('id_1', 11, 1000 + models.INVENTORY_LAG),
+             ('id_2', 20, 1000 + models.INVENTORY_LAG)])
+
+    def test_mark_only_seen(self):
+        cache = self.make_cache()
+        inventory_date = 10 * models.INVENTORY_LAG
+        for id, name in [('id_1', 'seen'), ('id_2', 'disappeared'),
+                         ('id_3', 'deleted'), ('id_4', 'new')]:
+            cache.add_archive('vault', name, 1, Mock(id=id))
+        cache.add_archive('other_vault', 'other', 1, Mock(id='id_5'))
+        cache.mark_seen_upstream_batch(
+            'vault', [{'id': 'id_2', 'name': 'disappeared', 'size': 1}],
+            inventory_date - 1, 0)
+        cache.mark_seen_upstream_batch(
+            'vault', [{'id': 'id_1', 'name': 'seen', 'size': 1}],
+            inventory_date, 0)
+        cache.session.query(cache.Archive).filter_by(id='id_3').update(
+            {'deleted_here': inventory_date - 1})
+        cache.session.query(cache.Archive).filter_by(id='id_4').update(
+            {'created_here': inventory_date})
+        cache.mark_commit()
+        log = Mock()
+        with patch.object(models.logger, 'warn', log):
+            cache.mark_only_seen('vault', inventory_date, 0, fix=True)
+        cache.mark_commit()
+        nose.tools.assert_equals(sorted(cache.get_archive_list('vault')),
+                                 ['new', 'seen'])
+        nose.tools.assert_equals(list(cache.get_archive_list('other_vault')),
+                                 ['other'])
+        nose.tools.assert_equals(sorted(call[1][0] for call in log.mock_calls), [
+            "archive disappeared: u'disappeared' (removed from cache)",
+            "new archive not yet in inventory: u'new'",
+        ])
+
+    def test_mark_only_seen_after_batches(self):
+        cache = self.make_cache()
+        inventory_date = 10 * models.INVENTORY_LAG
+        cache.mark_seen_upstream_batch(
+            'vault', [{'id': 'id_%d' % i, 'name': str(i), 'size': 1}
+                      for i in range(4)], inventory_date - 1, 0)
+        cache.mark_commit()
+        for ids in [['id_0'], ['id_2', 'id_4']]:
+            cache.mark_seen_upstream_batch(
+                'vault', [{'id': id, 'name': id[3:], 'size': 1} for id in ids],
+                inventory_date, 0)
+            cache.mark_commit()
+        log = Mock()
+        with patch.object(models.logger, 'warn', log):
+            cache.mark_only_seen('vault', inventory_date, 0)
+        nose.tools.assert_equals(sorted(call[1][0] for call in log.mock_calls), [
+            "archive disappeared: u'1'", "archive disappeared: u'3'"])
+
+    def test_mark_inventory_unchanged(self):
+        cache = self.make_cache()
+        inventory_date = 10 * models.INVENTORY_LAG
+        cache.add_archive('vault', 'new', 1, Mock(id='id_new'))
+        cache.mark_seen_upstream_batch(
+            'vault', [{'id': 'id_1', 'name': 'one', 'size': 1},
+                      {'id': 'id_2', 'name': 'two', 'size': 2}],
+            inventory_date, 0)
+        cache.record_reconciled_inventory('vault', inventory_date, 0, 'job_1',
+                                          'digest')
+        cache.mark_commit()
+        nose.tools.assert_is_none(cache.get_reconciled_inventory('other'))
+
+        later = inventory_date + 5 * models.INVENTORY_LAG
+        log = Mock()
+        with patch.object(models.logger, 'warn', log):
+            cache.mark_inventory_unchanged('vault', later, 'job_2')
+        cache.mark_commit()
+        nose.tools.assert_equals(
+            sorted((a.id, a.last_seen_upstream)
+                   for a in cache.get_archive_list_objects('vault')),
+            [('id_1', later - models.INVENTORY_LAG),
+             ('id_2', later - models.INVENTORY_LAG), ('id_new', None)])
+        nose.tools.assert_equals([call[1][0] for call in log.mock_calls],
+                                 ["new archive not yet in inventory: u'new'"])
+        reconciled = cache.get_reconciled_inventory('vault')
+        nose.tools.assert_equals(
+            (reconciled.inventory_date, reconciled.job_id, reconciled.digest,
+             reconciled.last_seen_upstream),
+            (inventory_date, 'job_2', 'digest', later - models.INVENTORY_LAG))
+
+    def test_get_archive_list(self):
+        cache = self.make_cache()
+        for id, name in [('id_1', 'dup'), ('id_2', 'dup'), ('id_3', 'single'),
+                         ('id_4', 'id:looks like a ref'), ('id_5', 'gone')]:
+            cache.add_archive('vault', name, 1, Mock(id=id))
+        cache.delete_archive('vault', 'gone')
+        with patch.object(models, 'ARCHIVE_LIST_FETCH_SIZE', 2), \
+                patch.object(cache, 'get_archive_list_objects') as objects:
+            nose.tools.assert_equals(list(cache.get_archive_list('vault')), [
+                'id:id_1\tdup', 'id:id_2\tdup', 'name:id:looks like a ref',
+                'single'])
+            nose.tools.assert_equals(
+                list(cache.get_archive_list_with_ids('vault')), [
+                    'id:id_1\tdup', 'id:id_2\tdup',
+                    'id:id_4\tid:looks like a ref', 'id:id_3\tsingle'])
+        nose.tools.assert_false(objects.called)
+
+    def test_get_archive_listing(self):
+        cache = self.make_cache()
+        with patch('time.time', return_value=1000):
+            cache.add_archive('vault', 'here', 10, Mock(id='id_1'))
+        cache.mark_seen_upstream_batch(
+            'vault', [{'id': 'id_2', 'name': 'there', 'size': 20}], 2000, 0)
+        cache.session.execute(cache.Archive.__table__.update().values(
+            created_here=None).where(cache.Archive.__table__.c.id == 'id_2'))
+        cache.mark_commit()
+        nose.tools.assert_equals(list(cache.get_archive_listing('vault')), [
+            ('id_1', 10, 1000, 'here'), ('id_2', 20, 2000, 'there')])
+
+    def test_get_archives_last_seen(self):
+        cache = self.make_cache()
+        for id, name in [('id_1', 'one'), ('id_2', 'dup'), ('id_3', 'dup'),
+                         ('id_4', 'gone')]:
+            cache.add_archive('vault', name, 1, Mock(id=id))
+        cache.mark_seen_upstream('vault', 'id_1', 'one', 1, 0, 100, 100)
+        cache.mark_seen_upstream('vault', 'id_2', 'dup', 1, 0, 200, 200)
+        cache.mark_seen_upstream('vault', 'id_3', 'dup', 1, 0, 300, 300)
+        cache.mark_commit()
+        cache.delete_archive('vault', 'gone')
+        nose.tools.assert_equals(
+            cache.get_archives_last_seen(
+                'vault', ['one', 'id:id_2', 'name:dup', 'gone', 'missing',
+                          'one']),
+            {'one': 100, 'id:id_2': 200, 'name:dup': 300})
+        nose.tools.assert_equals(cache.get_archives_last_seen('other', ['one']),
+                                 {})
+
+    def test_get_archive_names(self):
+        cache = self.make_cache()
+        for id, name in [('id_1', 'one'), ('id_2', 'two'), ('id_3', 'gone')]:
+            cache.add_archive('vault', name, 1, Mock(id=id))
+        cache.delete_archive('vault', 'gone')
+        with patch('glacier.models.IN_CLAUSE_LIMIT', 2):
+            nose.tools.assert_equals(
+                cache.get_archive_names('vault', ['id_1', 'id_2', 'id_3',
+                                                  'missing', 'id_1']),
+                {'id_1': 'one', 'id_2': 'two'})
+        nose.tools.assert_equals(cache.get_archive_names('other', ['id_1']),
+                                 {})
+
+    def test_jobs(self):
+        cache = self.make_cache()
+        nose.tools.assert_is_none(cache.get_job_listing_time('vault'))
+        cache.replace_jobs('vault', [
+            make_job('old', completed=True,
+                     completion_date='2017-06-01T00:00:00Z').meta.data,
+            make_job('done', completed=True,
+                     completion_date='2017-06-02T00:00:00Z').meta.data,
+            make_job('pending', archive_id='id_1').meta.data,
+        ], listed=1000)
+        cache.record_jobs('other', [make_job('elsewhere').meta.data])
+        nose.tools.assert_equals(cache.get_job_listing_time('vault'), 1000)
+        # Output is kept for a day after completion
+        with patch('time.time', return_value=1496361600):
+            nose.tools.assert_equals(
+                [job.id for job in cache.get_jobs('vault')],
+                ['done', 'pending'])
+            nose.tools.assert_equals(
+                [job.id for job in cache.get_jobs()],
+                ['elsewhere', 'done', 'pending'])
+        job, = cache.get_jobs('vault', in_progress=True)
+        nose.tools.assert_equals(
+            (job.id, job.action, job.archive_id, job.completed),
+            ('pending', 'ArchiveRetrieval', 'id_1', False))
+
+        cache.replace_jobs('vault', [make_job('new').meta.data], listed=2000)
+        nose.tools.assert_equals([job.id for job in cache.get_jobs('vault')],
+                                 ['new'])
+        cache.delete_jobs('vault', ['new'])
+        nose.tools.assert_equals(cache.get_jobs('vault'), [])
+        nose.tools.assert_equals(len(cache.get_jobs('other')), 1)
+
+    def test_multipart_upload(self):
+        cache = self.make_cache()
+        cache.add_multipart_upload('vault', 'name', 'upload', '/tmp/a', 10,
+                                   1234, 2)
+        nose.tools.assert_equals(
+            cache.find_multipart_upload('vault', 'name', '/tmp/a', 10, 1234,
+                                        2), 'upload')
+        nose.tools.assert_is_none(
+            cache.find_multipart_upload('vault', 'name', '/tmp/a', 10, 1235,
+                                        2))
+        cache.add_multipart_part('upload', 0, 2, 'hash0')
+        cache.add_multipart_part('upload', 2, 4, 'hash1')
+        nose.tools.assert_equals(cache.get_multipart_parts('upload'),
+                                 {0: 'hash0', 2: 'hash1'})
+        cache.delete_multipart_upload('upload')
+        nose.tools.assert_equals(cache.get_multipart_parts('upload'), {})
+        nose.tools.assert_is_none(
+            cache.find_multipart_upload('vault', 'name', '/tmp/a', 10, 1234,
+                                        2))
+
+
+class AppTestCase(CacheMixin, unittest.TestCase):
+    def init_app(self, args):
+        self.resource = Mock()
+        self.cache = self.make_cache()
+        self.app = cli.App(args=args, resource=self.resource,
+                           cache=self.cache)
+        return self.app
+
+    def test_archive_upload_resume(self):
+        part_size = 1024 * 1024
+        path = os.path.join(self.tmpdir, 'archive')
+        with open(path, 'wb') as f:
+            f.write(b'a' * part_size + b'b' * part_size)
+        app = self.init_app(['archive', 'upload', '--multipart-size',
+                             str(part_size), 'vault', path])
+        vault = self.resource.Vault.return_value
+        multipart = vault.initiate_multipart_upload.return_value
+        multipart.id = 'upload'
+        multipart.upload_part.side_effect = [None, IOError('network down')]
+        nose.tools.assert_raises(cli.RetryConsoleError, app.archive_upload)
+        nose.tools.assert_false(multipart.abort.called)
+        nose.tools.assert_equals(
+            self.cache.get_multipart_parts('upload'),
+            {0: treehash.tree_hash(b'a' * part_size)})
+
+        app.args = app.parse_args(['archive', 'upload', '--resume',
+                                   '--multipart-size', str(part_size),
+                                   'vault', path])
+        resumed = vault.MultipartUpload.return_value
+        resumed.id = 'upload'
+        resumed.parts.return_value = {'Parts': [
+            {'RangeInBytes': '0-1048575',
+             'SHA256TreeHash': treehash.tree_hash(b'a' * part_size)}]}
+        resumed.complete.return_value = {'archiveId': 'archive_id'}
+        vault.Archive.return_value.id = 'archive_id'
+        app.archive_upload()
+        vault.MultipartUpload.assert_called_once_with('upload')
+        resumed.upload_part.assert_called_once_with(
+            range='bytes 1048576-2097151/*', body=b'b' * part_size,
+            checksum=treehash.tree_hash(b'b' * part_size))
+        resumed.complete.assert_called_once_with(
+            archiveSize='2097152',
+            checksum=treehash.tree_hash(b'a' * part_size + b'b' * part_size))
+        nose.tools.assert_equals(
+            self.cache.get_archive_id('vault', 'archive'), 'archive_id')
+        nose.tools.assert_equals(self.cache.get_multipart_parts('upload'), {})
+
+    def test_vault_sync(self):
+        app = self.init_app(['vault', 'sync', 'vault'])
+        self.cache.add_archive('vault', 'old', 1, Mock(id='id_old'))
+        self.cache.mark_seen_upstream('vault', 'id_old', 'old', 1, 0, 0, 0)
+        self.cache.mark_commit()
+        job = make_job('job', action='InventoryRetrieval', completed=True,
+                       completion_date='2017-06-01T01:00:00Z',
+                       creation_date='2017-06-01T00:30:00Z')
+        job.get_output.return_value = {'body': io.BytesIO(make_inventory(
+            [('id_1', 'one', 1), ('id_2', 'two', 2)]))}
+        self.resource.Vault.return_value.name = 'vault'
+        self.resource.Vault.return_value.jobs.all.return_value = [job]
+        with patch('time.time', return_value=1496280000):
+            app.vault_sync()
+        nose.tools.assert_equals(sorted(self.cache.get_archive_list('vault')),
+                                 ['old', 'one', 'two'])
+        nose.tools.assert_equals(
+            self.cache.get_archive_last_seen('vault', 'one'),
+            cli.iso8601_to_unix_timestamp('2017-06-01T00:00:00Z'))
+
+
+    def test_vault_sync_in_batches(self):
+        app = self.init_app(['vault', 'sync', 'vault'])
+        for id, name in [('id_1', 'kept'), ('id_gone', 'gone')]:
+            self.cache.add_archive('vault', name, 1, Mock(id=id))
+            self.cache.mark_seen_upstream('vault', id, name, 1, 0, 500, 0)
+        self.cache.mark_commit()
+        reader = Mock()
+        reader.archives.return_value = iter([
+            {'ArchiveId': id, 'ArchiveDescription': name, 'Size': 1}
+            for id, name in [('id_1', 'kept'), ('id_2', 'two'),
+                             ('id_3', 'three')]])
+        reader.hexdigest.return_value = 'digest'
+        log = Mock()
+        with patch.object(cli, 'INVENTORY_BATCH_SIZE', 1), \
+                patch.object(self.cache, 'mark_only_seen',
+                             wraps=self.cache.mark_only_seen) as only_seen, \
+                patch.object(models.logger, 'warn', log):
+            app._reconcile_inventory('vault', reader, 1000, 'job', 2000)
+        # The missing archives are found from the cache alone, so the
+        # inventory's ids are never gathered up
+        only_seen.assert_called_once_with('vault', 1000, 2000, fix=False)
+        nose.tools.assert_equals([call[1][0] for call in log.mock_calls],
+                                 ["archive disappeared: u'gone'"])
+        nose.tools.assert_equals(
+            sorted(self.cache.get_archive_list('vault')),
+            ['gone', 'kept', 'three', 'two'])
+
+    def test_vault_sync_csv(self):
+        app = self.init_app(['vault', 'sync', '--format', 'csv', '--wait',
+                             'vault'])
+        self.cache.add_archive('vault', 'old', 1, Mock(id='id_old'))
+        vault = self.resource.Vault.return_value
+        vault.name = 'vault'
+        vault.jobs.all.return_value = []
+        job = make_job('job', action='InventoryRetrieval', completed=True,
+                       completion_date='2017-06-01T01:00:00Z',
+                       creation_date='2017-06-01T00:30:00Z')
+        job.get_output.return_value = {
+            'contentType': 'text/csv',
+            'body': io.BytesIO(make_csv_inventory(
+                [('id_1', 'one, "quoted"', 1)]))}
+        vault.initiate_inventory_retrieval.return_value = job
+        with patch('time.time', return_value=1496280000):
+            app.vault_sync()
+        nose.tools.assert_equals(
+            vault.initiate_inventory_retrieval.call_args[1]['jobParameters'],
+            {'Type': 'inventory-retrieval', 'Format': 'CSV'})
+        nose.tools.assert_equals(sorted(self.cache.get_archive_list('vault')),
+                                 ['old', 'one, "quoted"'])
+        # Undated, so the archives are taken to have been seen no later than
+        # the job could have been served a stale inventory
+        nose.tools.assert_equals(
+            self.cache.get_archive_last_seen('vault', 'one, "quoted"'),
+            cli.iso8601_to_unix_timestamp('2017-06-01T00:30:00Z') -
+            models.INVENTORY_LAG)
+
+    def test_vault_sync_unchanged_inventory(self):
+        app = self.init_app(['vault', 'sync', 'vault'])
+        body = make_inventory([('id_1', 'one', 1)])
+        jobs = [make_job(job_id, action='InventoryRetrieval', completed=True,
+                         completion_date=creation_date,
+                         creation_date=creation_date)
+                for job_id, creation_date in [
+                    ('job_1', '2017-06-01T01:00:00Z'),
+                    ('job_2', '2017-06-10T01:00:00Z')]]
+        for job in jobs:
+            job.get_output.return_value = {'body': io.BytesIO(body)}
+        vault = self.resource.Vault.return_value
+        vault.name = 'vault'
+        vault.jobs.all.return_value = jobs[:1]
+        with patch('time.time', return_value=1496280000):
+            app.vault_sync()
+        reconciled = self.cache.get_reconciled_inventory('vault')
+        nose.tools.assert_equals((reconciled.job_id, reconciled.digest),
+                                 ('job_1', hashlib.sha256(body).hexdigest()))
+
+        app._forget_job_index('vault')
+        vault.jobs.all.return_value = jobs[1:]
+        with patch('time.time', return_value=1497056400), \
+                patch.object(self.cache, 'mark_seen_upstream_batch') as batch:
+            app.vault_sync()
+        nose.tools.assert_false(batch.called)
+        nose.tools.assert_equals(
+            self.cache.get_archive_last_seen('vault', 'one'),
+            cli.iso8601_to_unix_timestamp('2017-06-10T01:00:00Z') -
+            models.INVENTORY_LAG)
+        nose.tools.assert_equals(
+            self.cache.get_reconciled_inventory('vault').job_id, 'job_2')
+
+    def test_vault_sync_unchanged_csv_inventory(self):
+        app = self.init_app(['vault', 'sync', 'vault'])
+        vault = self.resource.Vault.return_value
+        vault.name = 'vault'
+        bodies = [make_csv_inventory(archives) for archives in [
+            [('id_1', 'one', 1)], [('id_1', 'one', 1)],
+            [('id_1', 'one', 1), ('id_2', 'two', 2)]]]
+        jobs = []
+        for i, body in enumerate(bodies):
+            job = make_job('job_%d' % i, action='InventoryRetrieval',
+                           completed=True,
+                           creation_date='2017-06-0%dT01:00:00Z' % (i + 1),
+                           completion_date='2017-06-0%dT01:00:00Z' % (i + 1))
+            job.get_output.return_value = {'contentType': 'text/csv',
+                                           'body': io.BytesIO(body)}
+            jobs.append(job)
+        app._vault_sync_reconcile(vault, jobs[0])
+
+        with patch.object(self.cache, 'mark_seen_upstream_batch') as batch:
+            app._vault_sync_reconcile(vault, jobs[1])
+        nose.tools.assert_false(batch.called)
+        nose.tools.assert_equals(
+            self.cache.get_archive_last_seen('vault', 'one'),
+            cli.iso8601_to_unix_timestamp('2017-06-02T01:00:00Z') -
+            models.INVENTORY_LAG)
+        nose.tools.assert_equals(
+            self.cache.get_reconciled_inventory('vault').job_id, 'job_1')
+
+        app._vault_sync_reconcile(vault, jobs[2])
+        nose.tools.assert_equals(sorted(self.cache.get_archive_list('vault')),
+                                 ['one', 'two'])
+        reconciled = self.cache.get_reconciled_inventory('vault')
+        nose.tools.assert_equals(
+            (reconciled.job_id, reconciled.digest),
+            ('job_2', hashlib.sha256(bodies[2]).hexdigest()))
+
+    def sync_with_snapshot(self, app, job_id, archives,
+                           creation_date='2017-06-01T00:30:00Z',
+                           inventory_date='2017-06-01T00:00:00Z'):
+        vault = self.resource.Vault.return_value
+        vault.name = 'vault'
+        job = make_job(job_id, action='InventoryRetrieval', completed=True,
+                       completion_date=creation_date,
+                       creation_date=creation_date)
+        job.get_output.return_value = {'body': io.BytesIO(
+            make_inventory(archives, inventory_date=inventory_date))}
+        app._vault_sync_reconcile(vault, job)
+
+    def test_vault_sync_keeps_snapshots(self):
+        app = self.init_app(['vault', 'sync', 'vault'])
+        with patch.dict(cli.configuration['inventory_snapshots'],
+                        {'max_count': '2'}):
+            for i in range(3):
+                self.sync_with_snapshot(
+                    app, 'job_%d' % i, [('id_%d' % i, 'name_%d' % i, 1)],
+                    inventory_date='2017-06-0%dT00:00:00Z' % (i + 1))
+        kept = self.cache.get_inventory_snapshots('vault')
+        nose.tools.assert_equals([snapshot.job_id for snapshot in kept],
+                                 ['job_2', 'job_1'])
+        directory = os.path.join(self.tmpdir, 'glacier-cli', 'inventories')
+        nose.tools.assert_equals(sorted(os.listdir(os.path.join(directory,
+                                                                'vault'))),
+                                 ['job_1.json.gz', 'job_2.json.gz'])
+        with app._inventory_snapshots.open(kept[0].path) as body:
+            nose.tools.assert_equals(
+                body.read(), make_inventory([('id_2', 'name_2', 1)],
+                                            inventory_date='2017-06-03T00:00:00Z'))
+        nose.tools.assert_equals(self.cache.get_inventory_snapshot_vaults(),
+                                 ['vault'])
+
+    def test_vault_sync_snapshot_evicted_by_age(self):
+        app = self.init_app(['vault', 'sync', 'vault'])
+        self.sync_with_snapshot(app, 'old', [('id_1', 'one', 1)])
+        with patch('time.time', return_value=time.time() + 31 * 24 * 60 * 60):
+            self.sync_with_snapshot(app, 'new', [('id_1', 'one', 1)],
+                                    inventory_date='2017-06-02T00:00:00Z')
+        nose.tools.assert_equals(
+            [snapshot.job_id
+             for snapshot in self.cache.get_inventory_snapshots('vault')],
+            ['new'])
+
+    def test_vault_sync_snapshot_kept_on_failure(self):
+        app = self.init_app(['vault', 'sync', 'vault'])
+        with patch.object(self.cache, 'mark_only_seen',
+                          side_effect=RuntimeError('crashed')), \
+                nose.tools.assert_raises(RuntimeError):
+            self.sync_with_snapshot(app, 'job', [('id_1', 'one', 1)])
+        nose.tools.assert_equals(
+            [snapshot.job_id
+             for snapshot in self.cache.get_inventory_snapshots('vault')],
+            ['job'])
+
+    def test_vault_sync_snapshot_kept_on_bad_header(self):
+        app = self.init_app(['vault', 'sync', 'vault'])
+        vault = self.resource.Vault.return_value
+        vault.name = 'vault'
+        job = make_job('job', action='InventoryRetrieval', completed=True,
+                       creation_date='2017-06-01T00:30:00Z')
+        job.get_output.return_value = {'body': io.BytesIO(b'[not json')}
+        nose.tools.assert_raises(ValueError, app._vault_sync_reconcile,
+                                 vault, job)
+        snapshot, = self.cache.get_inventory_snapshots('vault')
+        nose.tools.assert_equals(
+            snapshot.inventory_date,
+            cli.iso8601_to_unix_timestamp('2017-06-01T00:30:00Z') -
+            models.INVENTORY_LAG)
+
+    def test_vault_sync_snapshot_discarded_on_interrupt(self):
+        app = self.init_app(['vault', 'sync', 'vault'])
+        vault = self.resource.Vault.return_value
+        vault.name = 'vault'
+        job = make_job('job', action='InventoryRetrieval', completed=True,
+                       creation_date='2017-06-01T00:30:00Z')
+        body = io.BytesIO(make_inventory([('id_%d' % i, 'name', 1)
+                                          for i in range(10000)]))
+        job.get_output.return_value = {'body': body}
+        with patch.object(cli, 'INVENTORY_BATCH_SIZE', 10), \
+                patch.object(self.cache, 'mark_seen_upstream_batch',
+                             side_effect=KeyboardInterrupt), \
+                nose.tools.assert_raises(KeyboardInterrupt):
+            app._vault_sync_reconcile(vault, job)
+        # The rest of the inventory was not read in order to keep it
+        nose.tools.assert_less(body.tell(), len(body.getvalue()))
+        nose.tools.assert_equals(self.cache.get_inventory_snapshots('vault'),
+                                 [])
+        nose.tools.assert_equals(
+            os.listdir(os.path.join(self.tmpdir, 'glacier-cli', 'inventories',
+                                    'vault')), [])
+
+    def test_vault_sync_from_snapshot(self):
+        app = self.init_app(['vault', 'sync', 'vault'])
+        self.cache.add_archive('vault', 'renamed', 1, Mock(id='id_1'))
+        self.sync_with_snapshot(app, 'job', [('id_1', 'one', 1),
+                                             ('id_2', 'two', 2)])
+        nose.tools.assert_equals(sorted(self.cache.get_archive_list('vault')),
+                                 ['renamed', 'two'])
+
+        app = self.init_app(['vault', 'sync', '--from-snapshot', '--fix',
+                             'vault'])
+        app.vault_sync()
+        nose.tools.assert_false(self.resource.Vault.called)
+        nose.tools.assert_equals(sorted(self.cache.get_archive_list('vault')),
+                                 ['one', 'two'])
+
+        app = self.init_app(['vault', 'sync', '--from-snapshot', 'other'])
+        nose.tools.assert_raises(cli.ConsoleError, app.vault_sync)
+
+    def test_vault_sync_all(self):
+        app = self.init_app(['vault', 'sync', '--all', '--wait',
+                             '--concurrency', '2'])
+        inventory_job = lambda job_id, completed: make_job(
+            job_id, action='InventoryRetrieval', completed=completed,
+            creation_date='2017-06-01T00:30:00Z',
+            completion_date='2017-06-01T01:00:00Z' if completed else None)
+        ready_job = inventory_job('job_1', completed=True)
+        pending_job = inventory_job('job_2', completed=False)
+        new_job = inventory_job('job_3', completed=False)
+        for job in [pending_job, new_job]:
+            job.reload.side_effect = lambda job=job: job.configure_mock(
+                completed=True, completion_date='2017-06-01T01:00:00Z')
+        vaults = {}
+        for name, jobs, archive_id in [('ready', [ready_job], 'id_1'),
+                                       ('pending', [pending_job], 'id_2'),
+                                       ('new', [], 'id_3')]:
+            vault = Mock()
+            vault.name = name
+            vault.jobs.all.return_value = jobs
+            vaults[name] = vault
+            for job in jobs + ([new_job] if not jobs else []):
+                job.get_output.return_value = {'body': io.BytesIO(
+                    make_inventory([(archive_id, name, 1)]))}
+        vaults['new'].initiate_inventory_retrieval.return_value = new_job
+        self.resource.vaults.all.return_value = [
+            vaults['ready'], vaults['pending'], vaults['new']]
+        self.resource.Vault.side_effect = lambda account, name: vaults[name]
+
+        with patch('time.time', return_value=1496280000), \
+                patch('time.sleep'):
+            app.vault_sync()
+        for name in ['ready', 'pending']:
+            nose.tools.assert_false(
+                vaults[name].initiate_inventory_retrieval.called)
+        for name in ['ready', 'pending', 'new']:
+            nose.tools.assert_equals(list(self.cache.get_archive_list(name)),
+                                     [name])
+
+    def test_vault_sync_many_without_wait(self):
+        app = self.init_app(['vault', 'sync', 'one', 'two'])
+        def make_vault(account, name):
+            vault = Mock()
+            vault.name = name
+            vault.jobs.all.return_value = []
+            vault.initiate_inventory_retrieval.return_value = make_job(
+                'job_' + name, action='InventoryRetrieval')
+            return vault
+        self.resource.Vault.side_effect = make_vault
+        with nose.tools.assert_raises(cli.RetryConsoleError) as cm:
+            app.vault_sync()
+        nose.tools.assert_equals(str(cm.exception).splitlines(), [
+            "queued inventory job for 'one'",
+            "queued inventory job for 'two'"])
+
+    def test_vault_sync_needs_names(self):
+        app = self.init_app(['vault', 'sync'])
+        nose.tools.assert_raises(cli.ConsoleError, app.vault_sync)
+
+
+    def test_archive_list_and_ls(self):
+        app = self.init_app(['archive', 'list', 'vault'])
+        with patch('time.time', return_value=0):
+            for id, name in [('id_1', 'dup'), ('id_2', 'dup'),
+                             ('id_3', 'single')]:
+                self.cache.add_archive('vault', name, 1, Mock(id=id))
+        stdout = StringIO.StringIO()
+        with patch('sys.stdout', stdout):
+            app.archive_list()
+        nose.tools.assert_equals(stdout.getvalue(),
+                                 'id:id_1\tdup\nid:id_2\tdup\nsingle\n')
+
+        app = self.init_app(['archive', 'ls', 'vault'])
+        stdout = StringIO.StringIO()
+        with patch('sys.stdout', stdout):
+            app.archive_ls()
+        nose.tools.assert_equals(
+            stdout.getvalue().splitlines()[-1],
+            'id:id_3 1 {} single'.format(datetime.datetime.fromtimestamp(0)))
+
+        app = self.init_app(['archive', 'list', 'empty'])
+        stdout = StringIO.StringIO()
+        with patch('sys.stdout', stdout):
+            app.archive_list()
+        nose.tools.assert_equals(stdout.getvalue(), '')
+
+    def test_archive_checkpresent_batch(self):
+        app = self.init_app(['archive', 'checkpresent', '--batch', 'vault'])
+        self.cache.add_archive('vault', 'fresh', 1, Mock(id='id_fresh'))
+        self.cache.add_archive('vault', 'stale', 1, Mock(id='id_stale'))
+        self.cache.mark_seen_upstream('vault', 'id_stale', 'stale', 1, 0, 1, 1)
+        self.cache.mark_commit()
+        stdin = io.BytesIO(b'fresh\nstale\nmissing\nid:id_fresh\n')
+        stdout = StringIO.StringIO()
+        with patch.object(app, '_vault_sync') as vault_sync, \
+                patch('sys.stdin', stdin), patch('sys.stdout', stdout):
+            app.archive_checkpresent()
+        vault_sync.assert_called_once_with(vault_name='vault',
+                                           max_age_hours=80, fix=False,
+                                           wait=False)
+        nose.tools.assert_equals(stdout.getvalue().splitlines(), [
+            'present fresh', 'absent stale', 'absent missing',
+            'present id:id_fresh'])
+
+    def test_archive_checkpresent_batch_encoding(self):
+        app = self.init_app(['archive', 'checkpresent', '--batch', 'vault'])
+        self.cache.add_archive('vault', u'caf\u00e9', 1, Mock(id='id_1'))
+        self.cache.add_archive('vault', 'crlf', 1, Mock(id='id_2'))
+        stdin = io.BytesIO(b'caf\xc3\xa9\ncrlf\r\n')
+        stdout = StringIO.StringIO()
+        with patch('sys.stdin', stdin), patch('sys.stdout', stdout):
+            app.archive_checkpresent()
+        nose.tools.assert_equals(stdout.getvalue().splitlines(), [
+            u'present caf\u00e9', 'present crlf'])
+
+    def test_archive_retrieve_lists_jobs_once(self):
+        app = self.init_app(['archive', 'retrieve', 'vault', 'one', 'two',
+                             'one'])
+        for id, name in [('id_1', 'one'), ('id_2', 'two')]:
+            self.cache.add_archive('vault', name, 1, Mock(id=id))
+        vault = self.resource.Vault.return_value
+        vault.name = 'vault'
+        vault.jobs.all.return_value = [
+            make_job('job_1', action='InventoryRetrieval'),
+            make_job('job_2', archive_id='id_other')]
+        new_job = Mock(id='job_3', completed=False)
+        vault.Archive.return_value.initiate_archive_retrieval.return_value = \
+            new_job
+        with nose.tools.assert_raises(cli.RetryConsoleError) as cm:
+            app.archive_retrieve()
+        nose.tools.assert_equals(vault.jobs.all.call_count, 1)
+        # Repeated names are only retrieved once
+        nose.tools.assert_equals(
+            vault.Archive.return_value.initiate_archive_retrieval.call_count,
+            2)
+        nose.tools.assert_equals(
+            str(cm.exception),
+            "queued retrieval job for archive 'one'\n"
+            "queued retrieval job for archive 'two'")
+        job_index = app._job_index(vault)
+        nose.tools.assert_equals(job_index.for_archive('id_1'), [new_job])
+        nose.tools.assert_equals(
+            len(job_index.for_action('ArchiveRetrieval')), 3)
+
+
+    def test_archive_retrieve_pipeline(self):
+        app = self.init_app(['archive', 'retrieve', '--wait',
+                             '--archive-concurrency', '2', 'vault',
+                             'ready', 'pending', 'new'])
+        for id, name in [('id_1', 'ready'), ('id_2', 'pending'),
+                         ('id_3', 'new')]:
+            self.cache.add_archive('vault', name, 1, Mock(id=id))
+        vault = self.resource.Vault.return_value
+        vault.name = 'vault'
+        ready_job = make_job('job_1', archive_id='id_1', completed=True,
+                             completion_date='2017-06-01T00:00:00Z')
+        pending_job = make_job('job_2', archive_id='id_2')
+        vault.jobs.all.return_value = [ready_job, pending_job]
+        new_job = make_job('job_3', archive_id='id_3')
+        vault.Archive.return_value.initiate_archive_retrieval.return_value = \
+            new_job
+
+        # Each job completes on its second poll, but the new job is only
+        # initiated once, before any waiting begins
+        events = []
+
+        def completes_on_second_poll(job):
+            def reload():
+                events.append(('poll', job.id))
+                if ('poll', job.id) in events[:-1]:
+                    job.completed = True
+                    job.status_code = 'Succeeded'
+                    job.completion_date = '2017-06-02T00:00:00Z'
+            job.reload.side_effect = reload
+        completes_on_second_poll(pending_job)
+        completes_on_second_poll(new_job)
+        vault.Archive.return_value.initiate_archive_retrieval.side_effect = \
+            lambda **kwargs: events.append(('initiate',)) or new_job
+
+        def retrieve(args, job, name, cache):
+            nose.tools.assert_is_not(cache, self.cache)
+            events.append(('download', name))
+        with patch.object(app, '_archive_retrieve_completed',
+                          side_effect=retrieve), patch('time.sleep'):
+            app.archive_retrieve()
+        nose.tools.assert_equals(events[0], ('initiate',))
+        nose.tools.assert_equals(
+            sorted(event[1] for event in events if event[0] == 'download'),
+            ['new', 'pending', 'ready'])
+        for job_id, name in [('job_2', 'pending'), ('job_3', 'new')]:
+            nose.tools.assert_equals(events.count(('poll', job_id)), 2)
+            nose.tools.assert_greater(events.index(('download', name)),
+                                      events.index(('poll', job_id)))
+
+    def test_archive_retrieve_tiers(self):
+        app = self.init_app(['archive', 'retrieve', '--deadline', '2d',
+                             '--deadline-for', 'critical=10m',
+                             '--deadline-for', 'huge=10m',
+                             'vault', 'critical', 'huge', 'rest', 'pending'])
+        for id, name, size in [('id_1', 'critical', 1024),
+                               ('id_2', 'huge', 1024 ** 3),
+                               ('id_3', 'rest', 1024),
+                               ('id_4', 'pending', 1024)]:
+            self.cache.add_archive('vault', name, size, Mock(id=id))
+        vault = self.resource.Vault.return_value
+        vault.name = 'vault'
+        pending_job = make_job('job', archive_id='id_4',
+                               creation_date=datetime.datetime.utcnow()
+                                   .strftime('%Y-%m-%dT%H:%M:%SZ'))
+        pending_job.tier = 'Standard'
+        vault.jobs.all.return_value = [pending_job]
+        initiate = vault.Archive.return_value.initiate_archive_retrieval
+        initiate.side_effect = [
+            botocore.exceptions.ClientError(
+                {'Error': {'Code': 'InsufficientCapacityException'}},
+                'InitiateJob'),
+            Mock(id='job_1'), Mock(id='job_2'), Mock(id='job_3')]
+        with nose.tools.assert_raises(cli.RetryConsoleError) as cm:
+            app.archive_retrieve()
+        nose.tools.assert_equals(
+            [(call[1]['jobParameters']['ArchiveId'],
+              call[1]['jobParameters']['Tier'])
+             for call in initiate.call_args_list],
+            [('id_1', 'Expedited'), ('id_1', 'Standard'),
+             ('id_2', 'Standard'), ('id_3', 'Bulk')])
+        nose.tools.assert_equals(str(cm.exception).splitlines(), [
+            "queued Standard retrieval job for archive 'critical'",
+            "queued Standard retrieval job for archive 'huge'",
+            "queued Bulk retrieval job for archive 'rest'",
+            "job still pending for archive 'pending'"])
+
+    def test_archive_retrieve_tier_replaces_slower_job(self):
+        app = self.init_app(['archive', 'retrieve', '--tier', 'expedited',
+                             'vault', 'one'])
+        self.cache.add_archive('vault', 'one', 1024, Mock(id='id_1'))
+        vault = self.resource.Vault.return_value
+        vault.name = 'vault'
+        pending_job = make_job('job', archive_id='id_1',
+                               creation_date=datetime.datetime.utcnow()
+                                   .strftime('%Y-%m-%dT%H:%M:%SZ'))
+        pending_job.tier = 'Bulk'
+        vault.jobs.all.return_value = [pending_job]
+        initiate = vault.Archive.return_value.initiate_archive_retrieval
+        initiate.return_value = Mock(id='job_1')
+        nose.tools.assert_raises(cli.RetryConsoleError, app.archive_retrieve)
+        nose.tools.assert_equals(
+            initiate.call_args[1]['jobParameters']['Tier'], 'Expedited')
+        job, = [job for job in self.cache.get_jobs('vault')
+                if job.id == 'job_1']
+        nose.tools.assert_equals(json.loads(job.description)['Tier'],
+                                 'Expedited')
+
+    def test_refresh_jobs_incrementally(self):
+        app = self.init_app(['job', 'list'])
+        vault = Mock()
+        vault.name = 'vault'
+        self.cache.replace_jobs('vault', [
+            make_job('finished', archive_id='id_1',
+                     creation_date='2017-05-31T00:00:00.000Z').meta.data,
+            make_job('expired', archive_id='id_2').meta.data,
+            make_job('pending', archive_id='id_3').meta.data,
+        ], listed=int(time.time()))
+        vault.jobs_in_progress.all.return_value = [
+            make_job('pending', archive_id='id_3'),
+            make_job('started_elsewhere', archive_id='id_4')]
+
+        def describe_job(job_id):
+            job = Mock(id=job_id)
+            job.meta.data = None
+            if job_id == 'finished':
+                job.load.side_effect = lambda: setattr(
+                    job.meta, 'data',
+                    make_job(job_id, archive_id='id_1', completed=True,
+                             creation_date='2017-05-31T00:00:00.000Z',
+                             completion_date=datetime.datetime.utcnow()
+                                 .strftime('%Y-%m-%dT%H:%M:%SZ')).meta.data)
+            elif job_id == 'expired':
+                job.load.side_effect = botocore.exceptions.ClientError(
+                    {'Error': {'Code': 'ResourceNotFoundException'}},
+                    'DescribeJob')
+            return job
+        vault.Job.side_effect = describe_job
+
+        jobs = app._refresh_jobs(vault)
+        nose.tools.assert_false(vault.jobs.all.called)
+        nose.tools.assert_equals(
+            sorted(call[0][0] for call in vault.Job.call_args_list
+                   if call[0][0] in ('finished', 'expired', 'pending')),
+            ['expired', 'finished', 'finished', 'pending'])
+        nose.tools.assert_equals(
+            sorted((job.id, job.meta.data['StatusCode']) for job in jobs),
+            [('finished', 'Succeeded'), ('pending', 'InProgress'),
+             ('started_elsewhere', 'InProgress')])
+
+        stdout = StringIO.StringIO()
+        with patch('sys.stdout', stdout):
+            app.job_list()
+        nose.tools.assert_false(self.resource.vaults.all.called)
+        nose.tools.assert_equals(
+            [line.split()[:2] for line in stdout.getvalue().splitlines()],
+            [['a/d', jobs[0].meta.data['CompletionDate']]] +
+            [['a/p', '2017-06-01T00:00:00.000Z']] * 2)
+
+    def test_job_list_refresh(self):
+        app = self.init_app(['job', 'list', '--refresh', '--concurrency', '2'])
+        self.cache.add_archive('first', 'one', 1, Mock(id='id_1'))
+        vaults = []
+        for name, jobs in [
+                ('first', [make_job('a', archive_id='id_1'),
+                           make_job('b', action='InventoryRetrieval')]),
+                ('second', [make_job('c', archive_id='id_2')]),
+                ('empty', [])]:
+            vault = Mock()
+            vault.name = name
+            vault.jobs.all.return_value = jobs
+            vaults.append(vault)
+        self.resource.vaults.all.return_value = vaults
+
+        stdout = StringIO.StringIO()
+        with patch('sys.stdout', stdout), \
+                patch.object(self.cache, 'get_archive_name') as get_name:
+            app.job_list()
+        nose.tools.assert_false(get_name.called)
+        nose.tools.assert_equals(
+            sorted(line.split()[2:] for line in stdout.getvalue().splitlines()),
+            [['first'], ['first', 'one'], ['second', 'id:id_2']])
+        nose.tools.assert_equals(
+            [job.id for job in self.cache.get_jobs()], ['a', 'b', 'c'])
+        for vault in vaults:
+            nose.tools.assert_is_not_none(
+                self.cache.get_job_listing_time(vault.name))
+
+
+class SnapshotsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.snapshots = snapshots.InventorySnapshots(self.tmpdir)
+
+    def test_finish(self):
+        path = self.snapshots.path('vault', 'job', 'text/csv')
+        nose.tools.assert_equals(path, os.path.join('vault', 'job.csv.gz'))
+        writer = self.snapshots.writer(io.BytesIO(b'abcdef'), path)
+        nose.tools.assert_equals(writer.read(2), b'ab')
+        writer.finish(chunk_size=1)
+        writer.discard()
+        nose.tools.assert_equals(writer.size, 6)
+        with self.snapshots.open(path) as body:
+            nose.tools.assert_equals(body.read(), b'abcdef')
+        self.snapshots.remove(path)
+        self.snapshots.remove(path)
+        nose.tools.assert_equals(os.listdir(os.path.join(self.tmpdir, 'vault')),
+                                 [])
+
+    def test_discard(self):
+        path = self.snapshots.path('vault', 'job')
+        writer = self.snapshots.writer(io.BytesIO(b'abcdef'), path)
+        writer.read(2)
+        writer.discard()
+        nose.tools.assert_equals(os.listdir(os.path.join(self.tmpdir, 'vault')),
+                                 [])
+
+
+class AnnexRemoteTestCase(CacheMixin, unittest.TestCase):
+    def run_remote(self, requests, vault_sync=None):
+        self.app = cli.App(['annex-remote'], resource=Mock(),
+                           cache=self.make_cache())
+        self.app._vault_sync = Mock(side_effect=vault_sync)
+        self.app._upload_archive = Mock()
+        self.app.cache.add_archive('vault', 'KEY1', 1, Mock(id='id_1'))
+        output = io.BytesIO()
+        remote = annexremote.AnnexRemote(
+            self.app, io.BytesIO(b''.join(r + b'\n' for r in requests)),
+            output)
+        remote.run()
+        return output.getvalue().splitlines()
+
+    def test_session(self):
+        pending_job = make_job('job', archive_id='id_1')
+        vault = Mock()
+        vault.name = 'vault'
+        vault.jobs.all.return_value = [pending_job]
+        output = None
+        with patch.object(annexremote.AnnexRemote, '_vault',
+                          return_value=vault):
+            output = self.run_remote([
+                b'EXTENSIONS INFO',
+                b'PREPARE', b'VALUE vault', b'VALUE ',
+                b'GETCOST',
+                b'CHECKPRESENT KEY1',
+                b'CHECKPRESENT KEY2',
+                b'TRANSFER RETRIEVE KEY1 /tmp/file with spaces',
+                b'TRANSFER RETRIEVE KEY1 /tmp/file with spaces',
+                b'REMOVE KEY2',
+                b'WHATEVER',
+            ])
+        nose.tools.assert_equals(output, [
+            b'VERSION 1',
+            b'EXTENSIONS',
+            b'GETCONFIG vault', b'GETCONFIG maxage', b'PREPARE-SUCCESS',
+            b'COST 1000',
+            b'CHECKPRESENT-SUCCESS KEY1',
+            b'CHECKPRESENT-FAILURE KEY2',
+            b"TRANSFER-FAILURE RETRIEVE KEY1 job still pending for archive u'KEY1'",
+            b"TRANSFER-FAILURE RETRIEVE KEY1 job still pending for archive u'KEY1'",
+            b'REMOVE-SUCCESS KEY2',
+            b'UNSUPPORTED-REQUEST',
+        ])
+        # The job listing is reused and the inventory only synced once
+        nose.tools.assert_equals(vault.jobs.all.call_count, 1)
+        nose.tools.assert_equals(self.app._vault_sync.call_count, 1)
+
+    def test_prepare_bad_maxage(self):
+        output = self.run_remote([
+            b'PREPARE', b'VALUE vault', b'VALUE 3 days',
+            b'GETCOST',
+        ])
+        nose.tools.assert_equals(output[-2:], [
+            b"PREPARE-FAILURE maxage must be a whole number of hours, "
+            b"not u'3 days'",
+            b'COST 1000',
+        ])
+
+    def test_errors(self):
+        for requests, reply in [
+                (b'ERROR something broke\nGETCOST\n',
+                 b'ERROR git-annex reported an error: something broke'),
+                (b'PREPARE\njunk\n',
+                 b"ERROR expected VALUE but got u'junk'")]:
+            output = io.BytesIO()
+            remote = annexremote.AnnexRemote(Mock(), io.BytesIO(requests),
+                                             output)
+            nose.tools.assert_raises(annexremote.ProtocolError, remote.run)
+            # The error is the last thing sent; later requests are not read
+            nose.tools.assert_equals(output.getvalue().splitlines()[-1],
+                                     reply)
+
+    def test_sync_refreshes_jobs(self):
+        vault = Mock()
+        vault.name = 'vault'
+        vault.jobs.all.return_value = []
+        vault.jobs_in_progress.all.return_value = []
+        clock = [1000000]
+        listings = []
+
+        def sync(**kwargs):
+            listings.append(vault.jobs.all.call_count +
+                            vault.jobs_in_progress.all.call_count)
+            clock[0] += annexremote.SYNC_INTERVAL + 1
+            raise cli.RetryConsoleError('job still pending')
+        with patch.object(annexremote.AnnexRemote, '_vault',
+                          return_value=vault), \
+                patch('time.time', side_effect=lambda: clock[0]):
+            self.run_remote([
+                b'PREPARE', b'VALUE vault', b'VALUE ',
+                b'CHECKPRESENT KEY2',
+                b'CHECKPRESENT KEY2',
+            ], vault_sync=sync)
+        # Each sync, an hour apart, sees the vault's jobs listed afresh
+        nose.tools.assert_equals(listings, [1, 2])
+
+    def test_store(self):
+        path = os.path.join(self.tmpdir, 'content')
+        with open(path, 'wb') as f:
+            f.write(b'content')
+        output = self.run_remote([
+            b'PREPARE', b'VALUE vault', b'VALUE 10',
+            b'TRANSFER STORE KEY3 ' + path.encode('utf-8'),
+        ])
+        nose.tools.assert_equals(output[-1], b'TRANSFER-SUCCESS STORE KEY3')
+        nose.tools.assert_equals(self.app._upload_archive.call_count, 1)
+        nose.tools.assert_equals(
+            self.app._upload_archive.call_args[0][:2], ('vault', 'KEY3'))
+
+
+class FakeSQS(object):
+    """An in-memory stand-in for the parts of an SQS client that
+    JobNotifications uses. Received messages stay invisible until deleted,
+    as if the visibility timeout were very long."""
+
+    def __init__(self, bodies):
+        self.messages = [{'MessageId': str(i), 'ReceiptHandle': 'r%d' % i,
+                          'Body': body} for i, body in enumerate(bodies)]
+        self.in_flight = set()
+        self.receive_calls = 0
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages, WaitTimeSeconds):
+        assert 0 <= WaitTimeSeconds <= 20
+        self.receive_calls += 1
+        visible = [message for message in self.messages
+                   if message['MessageId'] not in self.in_flight]
+        visible = visible[:MaxNumberOfMessages]
+        self.in_flight.update(message['MessageId'] for message in visible)
+        return {'Messages': visible} if visible else {}
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        self.messages = [message for message in self.messages
+                         if message['ReceiptHandle'] != ReceiptHandle]
+
+
+class NotificationsTestCase(unittest.TestCase):
+    def test_parse_job_notification(self):
+        description = {'JobId': 'job', 'StatusCode': 'Succeeded'}
+        nose.tools.assert_equals(
+            notifications.parse_job_notification(json.dumps(description)),
+            description)
+        envelope = {'Type': 'Notification',
+                    'Message': json.dumps(description)}
+        nose.tools.assert_equals(
+            notifications.parse_job_notification(json.dumps(envelope)),
+            description)
+        nose.tools.assert_is_none(
+            notifications.parse_job_notification('not json'))
+        nose.tools.assert_is_none(
+            notifications.parse_job_notification('{"Message": "[]"}'))
+
+    def test_wait(self):
+        sqs = FakeSQS([
+            json.dumps({'JobId': 'someone_elses'}),
+            'junk',
+            json.dumps({'Message': json.dumps({'JobId': 'mine'})}),
+        ])
+        job_notifications = notifications.JobNotifications(sqs, 'queue')
+        nose.tools.assert_equals(job_notifications.wait(['mine'], 60),
+                                 set(['mine']))
+        # Only the notification that was waited for is consumed
+        nose.tools.assert_equals(len(sqs.messages), 2)
+
+    def test_wait_timeout(self):
+        sqs = FakeSQS([])
+        job_notifications = notifications.JobNotifications(sqs, 'queue')
+        with patch('time.time', side_effect=[0, 0, 20, 40, 61]):
+            nose.tools.assert_equals(job_notifications.wait(['mine'], 60),
+                                     set())
+        nose.tools.assert_equals(sqs.receive_calls, 3)
+
+
+class WaitTestCase(unittest.TestCase):
+    def make_jobs(self, polls_until_complete):
+        job = make_job('job', completion_date='2017-06-01T00:00:00Z')
+        polls = []
+
+        def reload():
+            polls.append(None)
+            if len(polls) >= polls_until_complete:
+                job.completed = True
+        job.reload.side_effect = reload
+        return [job]
+
+    def test_polling_backoff(self):
+        jobs = self.make_jobs(polls_until_complete=5)
+        with patch('time.sleep') as sleep:
+            completed = list(cli.iter_completed_jobs(
+                [('job', jobs)], sleep=30, max_sleep=100))
+        nose.tools.assert_equals(completed, [('job', jobs[0])])
+        nose.tools.assert_equals([call[0][0] for call in sleep.call_args_list],
+                                 [30, 60, 100, 100])
+
+    def test_timeout(self):
+        jobs = self.make_jobs(polls_until_complete=100)
+        with patch('time.sleep'), \
+                patch('time.time', side_effect=[0, 0, 50, 100]):
+            nose.tools.assert_raises(
+                RuntimeError, list,
+                cli.iter_completed_jobs([('job', jobs)], timeout=100))
+
+    def test_notification_wakes_up(self):
+        jobs = self.make_jobs(polls_until_complete=2)
+        job_notifications = Mock()
+        job_notifications.wait.return_value = set(['job'])
+        with patch('time.sleep') as sleep:
+            completed = list(cli.iter_completed_jobs(
+                [('job', jobs)], notifications=job_notifications, sleep=30))
+        nose.tools.assert_equals(completed, [('job', jobs[0])])
+        nose.tools.assert_false(sleep.called)
+        job_notifications.wait.assert_called_once_with(['job'], 30)
+
+    def test_notification_reloads_notified_jobs(self):
+        jobs = [make_job('job_%d' % i,
+                         completion_date='2017-06-01T00:00:00Z')
+                for i in range(10)]
+        notified = set()
+        for job in jobs:
+            job.reload.side_effect = lambda job=job: setattr(
+                job, 'completed', job.id in notified)
+
+        def wait(ids, timeout):
+            notified.add(ids[0])
+            return set(ids[:1])
+        job_notifications = Mock()
+        job_notifications.wait.side_effect = wait
+        with patch('time.sleep') as sleep:
+            completed = list(cli.iter_completed_jobs(
+                [(job.id, [job]) for job in jobs],
+                notifications=job_notifications))
+        nose.tools.assert_equals(completed, [(job.id, job) for job in jobs])
+        nose.tools.assert_false(sleep.called)
+        # Once at the start, then only on its own notification
+        nose.tools.assert_equals([job.reload.call_count for job in jobs],
+                                 [2] * 10)
+
+    def test_job_parameters(self):
+        app = cli.App(['job', 'list'], resource=Mock(), cache=Mock())
+        with patch.dict(cli.configuration['notifications'],
+                        {'sns_topic': ''}):
+            nose.tools.assert_equals(
+                app._job_parameters('archive-retrieval', ArchiveId='id'),
+                {'Type': 'archive-retrieval', 'ArchiveId': 'id'})
+        with patch.dict(cli.configuration['notifications'],
+                        {'sns_topic': 'arn:topic'}):
+            nose.tools.assert_equals(
+                app._job_parameters('inventory-retrieval'),
+                {'Type': 'inventory-retrieval', 'SNSTopic': 'arn:topic'})
+
+
+class TiersTestCase(unittest.TestCase):
+    def test_plan_tier(self):
+        small, large = 1024, 1024 ** 3
+        nose.tools.assert_equals(tiers.plan_tier(small, 10 * 60), 'Expedited')
+        nose.tools.assert_equals(tiers.plan_tier(small, 6 * 60 * 60),
+                                 'Standard')
+        nose.tools.assert_equals(tiers.plan_tier(small, 24 * 60 * 60), 'Bulk')
+        # Too large to expedite, or of unknown size: the fastest other tier
+        nose.tools.assert_equals(tiers.plan_tier(large, 10 * 60), 'Standard')
+        nose.tools.assert_equals(tiers.plan_tier(None, 10 * 60), 'Standard')
+
+    def test_expected_completion(self):
+        nose.tools.assert_equals(tiers.expected_completion('Bulk', 100),
+                                 100 + 12 * 60 * 60)
+        nose.tools.assert_equals(tiers.expected_completion(None, 100),
+                                 100 + 5 * 60 * 60)
+
+    def test_parse_duration(self):
+        nose.tools.assert_equals(utils.parse_duration('90s'), 90)
+        nose.tools.assert_equals(utils.parse_duration('30m'), 30 * 60)
+        nose.tools.assert_equals(utils.parse_duration('2D'), 2 * 24 * 60 * 60)
+        nose.tools.assert_equals(utils.parse_duration('1.5'), 1.5 * 60 * 60)
+        for text in ['', 'h', '-1h', 'soon']:
+            nose.tools.assert_raises(ValueError, utils.parse_duration, text)
+
+
+class CredentialsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.environ = {
+            'AWS_CONFIG_FILE': os.path.join(self.tmpdir, 'config'),
+            'AWS_SHARED_CREDENTIALS_FILE': os.path.join(self.tmpdir,
+                                                        'credentials'),
+        }
+
+    def write(self, name, content):
+        with open(os.path.join(self.tmpdir, name), 'w') as f:
+            f.write(content)
+
+    def test_environment(self):
+        self.environ['AWS_ACCESS_KEY_ID'] = 'AKENV'
+        self.write('credentials', '[default]\naws_access_key_id = AKFILE\n')
+        nose.tools.assert_equals(credentials.find_access_key(self.environ),
+                                 'AKENV')
+
+    def test_profiles(self):
+        self.write('credentials', '[default]\naws_access_key_id = AKDEF\n'
+                                  '[other]\naws_access_key_id = AKOTHER\n')
+        self.write('config', '[profile third]\naws_access_key_id = AKCONF\n')
+        nose.tools.assert_equals(credentials.find_access_key(self.environ),
+                                 'AKDEF')
+        self.environ['AWS_PROFILE'] = 'other'
+        nose.tools.assert_equals(credentials.find_access_key(self.environ),
+                                 'AKOTHER')
+        self.environ['AWS_PROFILE'] = 'third'
+        nose.tools.assert_equals(credentials.find_access_key(self.environ),
+                                 'AKCONF')
+
+    def test_needs_boto3(self):
+        nose.tools.assert_is_none(credentials.find_access_key(self.environ))
+        self.write('credentials', '[default]\naws_access_key_id = AKDEF\n')
+        self.write('config', '[default]\nrole_arn = arn:aws:iam::1:role/r\n')
+        nose.tools.assert_is_none(credentials.find_access_key(self.environ))
+
+
+class StartupTestCase(unittest.TestCase):
+    def run_glacier(self, env, argv):
+        code = ('import sys\n'
+                'from glacier.cli import App\n'
+                'App(sys.argv[1:]).main()\n'
+                'print(sorted(name for name in sys.modules\n'
+                '             if name.split(".")[0] in\n'
+                '             ("boto3", "botocore", "alembic", "pkg_resources")))')
+        process = subprocess.Popen(
+            [sys.executable, '-c', code] + argv, env=env,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        nose.tools.assert_equals(process.returncode, 0, stderr)
+        return stdout.strip()
+
+    def test_cache_only_commands_avoid_heavy_imports(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        env = dict(os.environ, XDG_CACHE_HOME=tmpdir, XDG_CONFIG_HOME=tmpdir,
+                   AWS_ACCESS_KEY_ID='AKTEST', AWS_SECRET_ACCESS_KEY='secret')
+        # Creating the cache runs the migrations, so create it first
+        self.run_glacier(env, ['archive', 'list', 'vault'])
+        for argv in [['archive', 'list', 'vault'], ['archive', 'ls', 'vault']]:
+            nose.tools.assert_equals(self.run_glacier(env, argv), b'[]')
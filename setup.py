@@ -60,6 +60,9 @@ setup(
     tests_require=tests_require,
     test_suite = 'nose.collector',
     packages=['glacier'],
-    entry_points={'console_scripts': ['glacier=glacier.cli:main']},
+    entry_points={'console_scripts': [
+        'glacier=glacier.cli:main',
+        'git-annex-remote-glacier-cli=glacier.cli:annex_remote_main',
+    ]},
     package_data={'glacier': ['migrations/*', 'migrations/versions/*', 'alembic.ini']},
 )